@@ -9,10 +9,13 @@ import sys
 from flask import Flask, request, render_template, redirect, url_for, flash, send_file, jsonify
 from werkzeug.utils import secure_filename
 import uuid
+import threading
 from datetime import datetime
+from job_queue import JobQueue, DONE, FAILED
 
-# Add DeOldify to path
-sys.path.insert(0, 'deoldify_core')
+# Add DeOldify to path (resolved once, so nothing depends on the working directory)
+DEOLDIFY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'deoldify_core')
+sys.path.insert(0, DEOLDIFY_PATH)
 
 # Import AI modules
 try:
@@ -51,80 +54,206 @@ colorizer = SimpleColorizer() if SimpleColorizer else None
 image_generator = AIImageGenerator() if AIImageGenerator else None
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
+# Colorizer models stay loaded between requests; least recently used ones are
+# evicted once their weights exceed this budget (0 = unlimited)
+COLORIZER_MEMORY_BUDGET_MB = int(os.environ.get('COLORIZER_MEMORY_BUDGET_MB', 0))
+# Concurrent requests for the same model and render size share one forward pass
+COLORIZER_MAX_BATCH = int(os.environ.get('COLORIZER_MAX_BATCH', 4))
+COLORIZER_BATCH_WAIT_MS = int(os.environ.get('COLORIZER_BATCH_WAIT_MS', 10))
+# Finished results are cached on disk by input pixels and settings (0 = disabled)
+COLORIZER_CACHE_DIR = os.path.abspath(os.environ.get('COLORIZER_CACHE_DIR', 'cache'))
+COLORIZER_CACHE_MB = int(os.environ.get('COLORIZER_CACHE_MB', 1024))
+# Fold normalization layers into the conv weights when a model is loaded (0 = run the model as trained)
+COLORIZER_OPTIMIZE = os.environ.get('COLORIZER_OPTIMIZE', '1') == '1'
+# Run int8 colorizers on the CPU: 'dynamic', 'static' (needs quantize_model.py first) or empty for fp32
+COLORIZER_QUANTIZE = os.environ.get('COLORIZER_QUANTIZE', '') or None
+# Colorizer runtime: 'torch' or 'onnx' (ONNX Runtime on the CPU, exported on first use)
+COLORIZER_BACKEND = os.environ.get('COLORIZER_BACKEND', 'torch')
+# Render factors to run as compiled TorchScript graphs, e.g. '25,35' (empty = eager only).
+# Needs COLORIZER_OPTIMIZE; the artistic model is compiled at startup and the graph is cached on disk.
+COLORIZER_COMPILE_RENDER_FACTORS = [
+    int(rf) for rf in os.environ.get('COLORIZER_COMPILE_RENDER_FACTORS', '').split(',') if rf.strip()
+]
+# Upsample colors along the original's edges with a guided filter (1) instead of bilinearly (0)
+COLORIZER_GUIDED_UPSAMPLING = os.environ.get('COLORIZER_GUIDED_UPSAMPLING', '0') == '1'
+# Add detail from overlapping tiles of this size (a multiple of 16, e.g. 512) to large images (0 = off)
+COLORIZER_TILE_SIZE = int(os.environ.get('COLORIZER_TILE_SIZE', 0))
+# Cap on the memory one colorizer forward may plan to use (0 = whatever is available). Requests predicted
+# not to fit are rendered at a lower render factor; needs a table from calibrate_memory.py to predict
+COLORIZER_MEMORY_LIMIT_MB = int(os.environ.get('COLORIZER_MEMORY_LIMIT_MB', 0))
+# Target seconds from upload to result when the render factor is 'auto': the largest render factor
+# expected to make it, queue wait included, is picked from the latencies measured on this host
+COLORIZER_LATENCY_BUDGET_S = float(os.environ.get('COLORIZER_LATENCY_BUDGET_S', 30))
+# Render factors timed on the artistic model at startup, so 'auto' has measurements to go on (empty = none)
+COLORIZER_LATENCY_PROBE_RENDER_FACTORS = [
+    int(rf) for rf in os.environ.get('COLORIZER_LATENCY_PROBE_RENDER_FACTORS', '10,25').split(',') if rf.strip()
+]
+# Render factor of the form's slider, and of 'auto' until a model has been timed
+DEFAULT_RENDER_FACTOR = 25
+# Number of colorization jobs processed in parallel
+COLORIZER_WORKERS = int(os.environ.get('COLORIZER_WORKERS', 2))
+
+try:
+    import torch
+    from deoldify.registry import model_registry
+    from deoldify.batching import BatchScheduler
+    from deoldify.cache import ResultCache
+    
+    # The colorizer device is chosen here once, instead of overwriting
+    # fastai's global default device on every request. Quantized and ONNX models are CPU only.
+    COLORIZER_DEVICE = torch.device(
+        'cuda' if torch.cuda.is_available() and not COLORIZER_QUANTIZE and COLORIZER_BACKEND == 'torch' else 'cpu'
+    )
+    print(f"✅ DeOldify imported successfully (device: {COLORIZER_DEVICE})")
+    
+    if COLORIZER_MEMORY_BUDGET_MB:
+        model_registry.memory_budget = COLORIZER_MEMORY_BUDGET_MB * 1024 * 1024
+    model_registry.optimize = COLORIZER_OPTIMIZE
+    model_registry.compile_render_factors = COLORIZER_COMPILE_RENDER_FACTORS or None
+    model_registry.guided_upsampling = COLORIZER_GUIDED_UPSAMPLING
+    model_registry.tile_size = COLORIZER_TILE_SIZE or None
+    model_registry.memory_limit = COLORIZER_MEMORY_LIMIT_MB * 1024 * 1024 or None
+    if COLORIZER_MAX_BATCH > 1:
+        model_registry.batcher = BatchScheduler(
+            max_batch_size=COLORIZER_MAX_BATCH, max_wait=COLORIZER_BATCH_WAIT_MS / 1000
+        )
+    result_cache = ResultCache(COLORIZER_CACHE_DIR, max_bytes=COLORIZER_CACHE_MB * 1024 * 1024) if COLORIZER_CACHE_MB else None
+except ImportError as e:
+    print(f"⚠️ Failed to import DeOldify: {e}")
+    model_registry = None
+    result_cache = None
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def colorize_image_web(input_path, output_path, render_factor=25, model_type='artistic'):
+def colorize_image_web(input_path, output_path, render_factor=25, model_type='artistic', report=None):
     """
     Colorize image for web interface
+    
+    Safe to call from several threads at once: it does not change the working
+    directory, sys.path or fastai's global defaults.
+    If given, `report` is filled in with the render factor actually used and the
+    settings lowered to fit in memory ('degradations').
     """
+    if model_registry is None:
+        print("Error in colorization: DeOldify is not available")
+        return False
+    
     try:
-        # Save current directory and change to DeOldify
-        original_dir = os.getcwd()
-        deoldify_path = os.path.join(original_dir, 'deoldify_core')
-        os.chdir(deoldify_path)
-        
-        # Import DeOldify
-        from deoldify.visualize import get_image_colorizer
-        
         print(f"Loading {model_type} colorizer...")
         
-        # Get colorizer with map_location handling
-        import torch
-        import sys
-        sys.path.insert(0, deoldify_path)
-        from fastai.core import defaults
-        device = 'cpu' if torch.cuda.device_count() == 0 else 'cuda'
-        defaults.device = torch.device(device)
-        print(f"Using device: {device}")
-        
-        if model_type.lower() == 'artistic':
-            colorizer = get_image_colorizer(artistic=True)
-        else:
-            colorizer = get_image_colorizer(artistic=False)
-        
-        print("Colorizer loaded successfully")
-        
-        # Convert input path to relative path from DeOldify directory
-        input_rel_path = os.path.join('..', input_path)
-        
-        print(f"Colorizing: {input_rel_path}")
-        
-        # Colorize the image
-        result_path = colorizer.plot_transformed_image(
-            path=input_rel_path, 
-            render_factor=render_factor,
-            display_render_factor=True,
-            figsize=(20,20)
+        # Models are loaded once per process and reused by later requests
+        colorizer = model_registry.get_image_colorizer(
+            root_folder=DEOLDIFY_PATH,
+            artistic=model_type.lower() == 'artistic',
+            results_dir=None,
+            cache=result_cache,
+            device=COLORIZER_DEVICE,
+            quantize=COLORIZER_QUANTIZE,
+            backend=COLORIZER_BACKEND
         )
         
-        # Change back to original directory
-        os.chdir(original_dir)
-        
-        # Copy result to output path
-        import shutil
-        deoldify_result_dir = os.path.join('deoldify_core', 'result_images')
-        
-        # Find the result file (should be the newest file in result_images)
-        if os.path.exists(deoldify_result_dir):
-            import glob
-            result_files = glob.glob(os.path.join(deoldify_result_dir, '*'))
-            if result_files:
-                newest_result = max(result_files, key=os.path.getmtime)
-                shutil.copy2(newest_result, output_path)
-                return True
-        
-        return False
+        print(f"Colorizing: {input_path}")
+        
+        # Colorize in memory and write the result straight to its final location
+        result = colorizer.colorize(input_path, render_factor=render_factor)
+        degradations = result.info.get('degradations', [])
+        for degradation in degradations:
+            print(f"⚠️ Changed {degradation['setting']} from {degradation['from']} to {degradation['to']} "
+                  f"to fit in memory ({degradation['cause']})")
+        if report is not None:
+            report['render_factor'] = result.info.get('render_factor', render_factor)
+            report['degradations'] = degradations
+        result.save(output_path)
+        result.close()
+        return True
         
     except Exception as e:
         print(f"Error in colorization: {e}")
-        # Make sure to change back to original directory
-        try:
-            os.chdir(original_dir)
-        except:
-            pass
         return False
 
+def warm_up_colorizer(model_type='artistic'):
+    """Load the colorizer, compile its graphs and time it before the first request needs them"""
+    try:
+        print(f"Warming up {model_type} colorizer for render factors {COLORIZER_COMPILE_RENDER_FACTORS}...")
+        filtr = model_registry.get_filter(
+            root_folder=DEOLDIFY_PATH,
+            artistic=model_type == 'artistic',
+            device=COLORIZER_DEVICE,
+            quantize=COLORIZER_QUANTIZE,
+            backend=COLORIZER_BACKEND
+        )
+        if COLORIZER_LATENCY_PROBE_RENDER_FACTORS:
+            print(f"Timing {model_type} colorizer at render factors {COLORIZER_LATENCY_PROBE_RENDER_FACTORS}...")
+            filtr.measure_latency(COLORIZER_LATENCY_PROBE_RENDER_FACTORS)
+        print(f"✅ {model_type} colorizer ready")
+    except Exception as e:
+        print(f"⚠️ Colorizer warmup failed: {e}")
+
+def loaded_colorizer(model_type='artistic'):
+    """The colorizer filter for `model_type` if it is loaded already, without waiting for a load"""
+    if model_registry is None:
+        return None
+    return model_registry.loaded_filter(
+        root_folder=DEOLDIFY_PATH,
+        artistic=model_type.lower() == 'artistic',
+        device=COLORIZER_DEVICE,
+        quantize=COLORIZER_QUANTIZE,
+        backend=COLORIZER_BACKEND
+    )
+
+def estimate_run_time(image_size, render_factor, model_type='artistic'):
+    """Seconds colorizing an image of `image_size` should take on this host, or None until the model has been timed"""
+    filtr = loaded_colorizer(model_type)
+    if filtr is None:
+        return None
+    return filtr.estimate_latency(render_factor, image_size)
+
+def choose_render_factor(image_size, model_type='artistic'):
+    """
+    Pick the render factor for 'auto': the largest one expected to finish within
+    COLORIZER_LATENCY_BUDGET_S of now, given the queue ahead and the image's size
+    """
+    filtr = loaded_colorizer(model_type)
+    if filtr is None:
+        return DEFAULT_RENDER_FACTOR
+    wait = colorize_jobs.expected_wait(lambda job: job.params['estimated_run_time'])
+    render_factor = filtr.choose_render_factor(COLORIZER_LATENCY_BUDGET_S - wait, image_size)
+    return DEFAULT_RENDER_FACTOR if render_factor is None else render_factor
+
+def run_colorize_job(job):
+    """Worker entry point for queued colorization jobs"""
+    params = job.params
+    job.result = {}
+    return colorize_image_web(
+        params['input_path'], params['output_path'], params['render_factor'], params['model_type'],
+        report=job.result
+    )
+
+colorize_jobs = JobQueue(run_colorize_job, num_workers=COLORIZER_WORKERS)
+
+_warm_up_lock = threading.Lock()
+_warm_up_started = False
+
+def start_warm_up():
+    """
+    Warm up the colorizer on a background thread, once per process, if there are graphs
+    to compile or latencies to measure
+    """
+    global _warm_up_started
+    with _warm_up_lock:
+        if _warm_up_started:
+            return
+        _warm_up_started = True
+    if model_registry is not None and (COLORIZER_COMPILE_RENDER_FACTORS or COLORIZER_LATENCY_PROBE_RENDER_FACTORS):
+        threading.Thread(target=warm_up_colorizer, name='colorizer-warmup', daemon=True).start()
+
+@app.before_request
+def warm_up_on_first_request():
+    """WSGI servers (gunicorn, waitress) never run the __main__ block, so they warm up on their first request"""
+    if not _warm_up_started:
+        start_warm_up()
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -150,10 +279,27 @@ def upload_file():
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
         file.save(file_path)
         
+        try:
+            from PIL import Image
+            with Image.open(file_path) as image:
+                image_size = image.size
+        except OSError:
+            # Not an image PIL can read, or a corrupt one: nothing to colorize or keep
+            os.remove(file_path)
+            flash('Could not read the uploaded image, please choose a valid image file', 'error')
+            return redirect(url_for('index'))
+        
         # Get parameters with error handling
         try:
-            render_factor = int(request.form.get('render_factor', 25) or 25)
             model_type = request.form.get('model_type', 'artistic')
+            render_factor = request.form.get('render_factor', DEFAULT_RENDER_FACTOR) or DEFAULT_RENDER_FACTOR
+            render_factor_auto = render_factor == 'auto'
+            if render_factor_auto:
+                render_factor = choose_render_factor(image_size, model_type)
+            else:
+                render_factor = int(render_factor)
+            # Jobs queued behind this one count on it to choose their render factors
+            estimated_run_time = estimate_run_time(image_size, render_factor, model_type)
         except (ValueError, TypeError) as e:
             flash(f'Invalid render factor: {str(e)}', 'error')
             return redirect(url_for('index'))
@@ -162,22 +308,86 @@ def upload_file():
         output_filename = f"colorized_{unique_filename}"
         output_path = os.path.join(app.config['RESULT_FOLDER'], output_filename)
         
-        # Colorize the image
-        success = colorize_image_web(file_path, output_path, render_factor, model_type)
+        # Colorize in the background so the request returns immediately
+        job = colorize_jobs.submit(
+            input_path=file_path,
+            output_path=output_path,
+            render_factor=render_factor,
+            render_factor_auto=render_factor_auto,
+            estimated_run_time=estimated_run_time,
+            model_type=model_type,
+            original_file=unique_filename,
+            result_file=output_filename
+        )
         
-        if success:
-            return render_template('result.html', 
-                                 original_file=unique_filename,
-                                 result_file=output_filename,
-                                 render_factor=render_factor,
-                                 model_type=model_type)
-        else:
-            flash('เกิดข้อผิดพลาดในการแปลงภาพ')
-            return redirect(url_for('index'))
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify({
+                'job_id': job.id,
+                'status_url': url_for('job_status', job_id=job.id),
+                'render_factor': render_factor,
+                'render_factor_auto': render_factor_auto,
+                'estimated_run_time': estimated_run_time
+            }), 202
+        return render_template('job.html', job_id=job.id)
     
     flash('ไฟล์ไม่ถูกต้อง กรุณาเลือกไฟล์รูปภาพ')
     return redirect(url_for('index'))
 
+@app.route('/jobs')
+def job_queue_stats():
+    """Report queue depth and job timings"""
+    return jsonify(colorize_jobs.stats())
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Poll the status of a colorization job"""
+    job = colorize_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    status = job.to_dict()
+    status['queue_position'] = colorize_jobs.position(job)
+    status['render_factor'] = job.params['render_factor']
+    status['render_factor_auto'] = job.params['render_factor_auto']
+    status['estimated_run_time'] = job.params['estimated_run_time']
+    status['model_type'] = job.params['model_type']
+    if job.status == DONE:
+        status['result_url'] = url_for('view_file', filename='results/' + job.params['result_file'])
+        status['result_page'] = url_for('job_result', job_id=job.id)
+    return jsonify(status)
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    """Show the result page of a finished colorization job"""
+    job = colorize_jobs.get(job_id)
+    if job is None:
+        flash('ไม่พบงานที่ระบุ')
+        return redirect(url_for('index'))
+    if job.status == FAILED:
+        flash('เกิดข้อผิดพลาดในการแปลงภาพ')
+        return redirect(url_for('index'))
+    if job.status != DONE:
+        return render_template('job.html', job_id=job.id)
+    
+    # The render factor may have been lowered to fit in memory
+    render_factor = (job.result or {}).get('render_factor', job.params['render_factor'])
+    return render_template('result.html', 
+                         original_file=job.params['original_file'],
+                         result_file=job.params['result_file'],
+                         render_factor=render_factor,
+                         requested_render_factor=job.params['render_factor'],
+                         render_factor_auto=job.params['render_factor_auto'],
+                         model_type=job.params['model_type'])
+
+@app.route('/models/stats')
+def model_stats():
+    """Report colorizer model registry hits, misses and load times"""
+    if model_registry is None:
+        return jsonify({'error': 'DeOldify is not available'}), 503
+    stats = model_registry.stats()
+    stats['result_cache'] = result_cache.stats() if result_cache else None
+    return jsonify(stats)
+
 @app.route('/download/<filename>')
 def download_file(filename):
     return send_file(os.path.join(app.config['RESULT_FOLDER'], filename), as_attachment=True)
@@ -335,4 +545,8 @@ if __name__ == '__main__':
     print("🌐 Open your browser and go to: http://localhost:5000")
     print("✨ Ready to colorize and generate images!")
     
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # The debug reloader runs this twice: in a watcher process that never serves, and in the serving child
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_warm_up()
+    
+    app.run(debug=True, host='0.0.0.0', port=5000, threaded=True)
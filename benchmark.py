@@ -0,0 +1,704 @@
+#!/usr/bin/env python3
+"""
+DeOldify Colorizer Benchmarks
+Usage: python benchmark.py attention [--model artistic] [--render_factors 7 15 25 35 45]
+       python benchmark.py coldstart [--model artistic] [--runs 3]
+       python benchmark.py optimize [--model artistic] [--render_factors 15 35] [--grayscale]
+       python benchmark.py overhead [--model artistic] [--render_factors 7 10 15] [--stub]
+       python benchmark.py preprocess [--megapixels 12 50] [--render_factor 35]
+       python benchmark.py postprocess [--megapixels 12 50] [--render_factor 35] [--watermarked]
+       python benchmark.py tiled [--render_factor 20] [--tile_size 512] [--tile_scales 2 3] [--tile_batch_size 4]
+       python benchmark.py watermark [--megapixels 0.9 2 12] [--frames 50]
+       python benchmark.py video [--megapixels 0.9] [--frames 48] [--render_factor 21] [--batch_sizes 1 4 8]
+"""
+
+import sys
+import os
+import time
+import argparse
+import ctypes
+import multiprocessing
+from pathlib import Path
+from statistics import median
+
+# Add DeOldify to path (resolved once, so nothing depends on the working directory)
+DEOLDIFY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'deoldify_core')
+if DEOLDIFY_PATH not in sys.path:
+    sys.path.insert(0, DEOLDIFY_PATH)
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+RENDER_BASE = 16
+DEFAULT_RENDER_FACTORS = [7, 10, 15, 20, 25, 30, 35, 40, 45]
+
+
+WEIGHTS = {'artistic': 'ColorizeArtistic_gen', 'stable': 'ColorizeStable_gen'}
+
+
+def load_model(model_type='artistic', device='cpu'):
+    """Load the colorizer generator the same way the app does"""
+    import torch
+    from deoldify.generators import gen_model_deep, gen_model_wide
+
+    gen_model = gen_model_deep if model_type == 'artistic' else gen_model_wide
+    return gen_model(root_folder=Path(DEOLDIFY_PATH), weights_name=WEIGHTS[model_type], device=torch.device(device))
+
+
+def peak_memory(device):
+    """Peak bytes allocated on `device` (CUDA) or peak process RSS (CPU) so far"""
+    import torch
+
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device)
+    try:
+        # Linux: unlike ru_maxrss, this one can be reset (see reset_peak_memory)
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak_memory(device):
+    """Restart peak tracking on `device`, returning the memory in use now, or None where CPU peaks can't be reset"""
+    import torch
+
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+        return torch.cuda.memory_allocated(device)
+    try:
+        # Linux only: hands freed heap back to the OS, so reused memory counts too,
+        # then sets the peak RSS back to the current RSS
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return None
+    return peak_memory(device)
+
+
+def time_forward(model, x, repeat):
+    """Median seconds per forward of `model` on `x`"""
+    import torch
+
+    times = []
+    with torch.no_grad():
+        for _ in range(repeat):
+            start = time.perf_counter()
+            model(x)
+            if x.is_cuda:
+                torch.cuda.synchronize()
+            times.append(time.perf_counter() - start)
+    return median(times)
+
+
+def _attention_sweep(model_type, device, render_factors, repeat, chunked):
+    """Run in a fresh process so CPU peak RSS is not inherited from the other mode"""
+    import torch
+    from deoldify.layers import ChunkedSelfAttention
+
+    device = torch.device(device)
+    if not chunked:
+        ChunkedSelfAttention.chunk_size = None
+    model = load_model(model_type, device)
+    base = peak_memory(device)
+
+    # Render factors run in ascending order, so on CPU the process peak is that of the current size.
+    rows = []
+    for render_factor in sorted(render_factors):
+        sz = render_factor * RENDER_BASE
+        x = torch.randn(1, 3, sz, sz, device=device)
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats(device)
+            base = torch.cuda.memory_allocated(device)
+        try:
+            latency = time_forward(model, x, repeat)
+        except RuntimeError as e:
+            if 'memory' not in str(e):
+                raise
+            rows.append((render_factor, None, None))
+            continue
+        peak = peak_memory(device)
+        rows.append((render_factor, latency, None if peak is None else peak - base))
+    return rows
+
+
+def _format_latency(seconds, digits=0):
+    return 'OOM' if seconds is None else f'{seconds * 1000:.{digits}f} ms'
+
+
+def _format_bytes(nbytes):
+    return 'n/a' if nbytes is None else f'{nbytes / 2 ** 20:.0f} MB'
+
+
+def benchmark_attention(args):
+    """Compare full and chunked decoder self-attention across render factors"""
+    ctx = multiprocessing.get_context('spawn')
+    results = {}
+    for chunked in (False, True):
+        with ctx.Pool(1) as pool:
+            results[chunked] = pool.apply(
+                _attention_sweep, (args.model, args.device, args.render_factors, args.repeat, chunked)
+            )
+
+    print(f"📊 Self-attention: {args.model} model on {args.device}")
+    print(f"{'rf':>4} {'size':>6} {'full':>10} {'full peak':>10} {'chunked':>10} {'chunk peak':>10}")
+    for (rf, full_t, full_m), (_, chunk_t, chunk_m) in zip(results[False], results[True]):
+        print(f"{rf:>4} {rf * RENDER_BASE:>6} {_format_latency(full_t):>10} {_format_bytes(full_m):>10} "
+              f"{_format_latency(chunk_t):>10} {_format_bytes(chunk_m):>10}")
+
+
+def _cold_start(model_type, device, builder):
+    """Import and load a colorizer in this fresh process, returning (import seconds, build seconds)"""
+    start = time.perf_counter()
+    import torch
+    from deoldify import generators
+    imported = time.perf_counter()
+
+    kind = 'deep' if model_type == 'artistic' else 'wide'
+    if builder == 'learner':
+        # The Learner path builds its dummy DataBunch from ./dummy/
+        os.chdir(DEOLDIFY_PATH)
+        gen = getattr(generators, f'gen_inference_{kind}')
+    else:
+        gen = getattr(generators, f'gen_model_{kind}')
+    gen(root_folder=Path(DEOLDIFY_PATH), weights_name=WEIGHTS[model_type], device=torch.device(device))
+    return imported - start, time.perf_counter() - imported
+
+
+def benchmark_coldstart(args):
+    """Time process-fresh model loads through the Learner and the bare inference builder"""
+    ctx = multiprocessing.get_context('spawn')
+    print(f"🚀 Cold start: {args.model} model on {args.device}, median of {args.runs} runs")
+    for builder, label in (('learner', 'gen_inference (Learner)'), ('bare', 'gen_model (bare UNet)')):
+        runs = []
+        for _ in range(args.runs):
+            with ctx.Pool(1) as pool:
+                try:
+                    runs.append(pool.apply(_cold_start, (args.model, args.device, builder)))
+                except Exception as e:
+                    print(f"{label:>24}: ❌ {e}")
+                    break
+        if len(runs) == args.runs:
+            import_time = median(r[0] for r in runs)
+            build_time = median(r[1] for r in runs)
+            print(f"{label:>24}: import {import_time:.2f}s + build/load {build_time:.2f}s")
+
+
+def benchmark_optimize(args):
+    """Latency and output difference of the model before and after optimize_for_inference"""
+    import torch
+    from fastai.vision.data import imagenet_stats, normalize_funcs
+    from deoldify.optimize import optimize_for_inference
+
+    device = torch.device(args.device)
+    model = load_model(args.model, device)
+    # weight_norm modules can't be deep-copied, so the optimized model is loaded separately
+    optimized = optimize_for_inference(load_model(args.model, device), grayscale=args.grayscale)
+    norm, denorm = normalize_funcs(*imagenet_stats)
+
+    def baseline(x):
+        x, _ = norm((x / 255, x), do_x=True)
+        return denorm(model(x), do_x=True).clamp_(min=0, max=1)
+
+    print(f"⚡ Inference optimization: {args.model} model on {args.device}")
+    print(f"{'rf':>4} {'size':>6} {'original':>10} {'optimized':>10} {'speedup':>8} {'max diff':>9}")
+    for render_factor in args.render_factors:
+        sz = render_factor * RENDER_BASE
+        # Grayscale input, as the colorizer sees it
+        x = torch.randint(0, 256, (1, 1, sz, sz), device=device).float().expand(1, 3, sz, sz).contiguous()
+        x_optimized = x[:, :1].contiguous() if args.grayscale else x
+        with torch.no_grad():
+            diff = (baseline(x) - optimized(x_optimized)).abs().max().item() * 255
+        original_t = time_forward(baseline, x, args.repeat)
+        optimized_t = time_forward(optimized, x_optimized, args.repeat)
+        print(f"{render_factor:>4} {sz:>6} {_format_latency(original_t):>10} {_format_latency(optimized_t):>10} "
+              f"{original_t / optimized_t:>7.2f}x {diff:>9.4f}")
+
+
+def benchmark_overhead(args):
+    """Per-call cost around the model forward: Learner.pred_batch against the filter's direct path.
+    With --stub the model is a single 1x1 conv, so the timings are nearly all overhead."""
+    import torch
+    import numpy as np
+    from PIL import Image
+    from fastai.basic_data import DatasetType
+    from fastai.vision.data import imagenet_stats, normalize_funcs
+    from fastai.vision.image import image2np, pil2tensor
+    from deoldify import generators
+    from deoldify.filters import ColorizerFilter
+
+    device = torch.device(args.device)
+    # The Learner builds its dummy DataBunch from ./dummy/
+    os.chdir(DEOLDIFY_PATH)
+    kind = 'deep' if args.model == 'artistic' else 'wide'
+    learn = getattr(generators, f'gen_inference_{kind}')(
+        root_folder=Path(DEOLDIFY_PATH), weights_name=WEIGHTS[args.model], device=device
+    )
+    if args.stub:
+        learn.model = torch.nn.Conv2d(3, 3, 1).to(device).eval()
+    filtr = ColorizerFilter(learn=learn, device=device)
+    norm, denorm = normalize_funcs(*imagenet_stats)
+
+    def pred_batch(image):
+        # The filter's former path, through the Learner
+        x = pil2tensor(image, np.float32).to(device)
+        x.div_(255)
+        x, y = norm((x, x), do_x=True)
+        result = learn.pred_batch(ds_type=DatasetType.Valid, batch=(x[None], y[None]), reconstruct=True)
+        return image2np(denorm(result[0].px, do_x=False) * 255).astype(np.uint8)
+
+    def direct(image):
+        with torch.inference_mode():
+            return filtr._model_predict([np.array(image)])[0]
+
+    print(f"⏱️ Per-call overhead: {'1x1 conv stub' if args.stub else args.model + ' model'} on {args.device}")
+    print(f"{'rf':>4} {'size':>6} {'forward':>10} {'pred_batch':>11} {'overhead':>9} {'direct':>10} {'overhead':>9} {'same':>5}")
+    for render_factor in args.render_factors:
+        sz = render_factor * RENDER_BASE
+        gray = np.random.RandomState(render_factor).randint(0, 256, (sz, sz), dtype=np.uint8)
+        image = Image.fromarray(gray).convert('RGB')
+        x = norm((pil2tensor(image, np.float32).div_(255), None), do_x=True)[0][None].to(device)
+        forward_t = time_forward(learn.model, x, args.repeat)
+        legacy_t = time_forward(lambda _: pred_batch(image), x, args.repeat)
+        direct_t = time_forward(lambda _: direct(image), x, args.repeat)
+        same = np.array_equal(pred_batch(image), direct(image))
+        print(f"{render_factor:>4} {sz:>6} {_format_latency(forward_t, 2):>10} {_format_latency(legacy_t, 2):>11} "
+              f"{_format_latency(legacy_t - forward_t, 2):>9} {_format_latency(direct_t, 2):>10} "
+              f"{_format_latency(direct_t - forward_t, 2):>9} {'yes' if same else 'no':>5}")
+
+
+def _synthetic_photo(megapixels, seed=0):
+    """JPEG bytes of a smooth grayscale-looking photo stored as RGB, as scans usually are"""
+    import numpy as np
+    from io import BytesIO
+    from PIL import Image
+
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    height = int(width * 3 / 4)
+    rng = np.random.RandomState(seed)
+    image = Image.fromarray(rng.randint(0, 256, (30, 40), dtype=np.uint8)).resize((width, height), Image.BICUBIC)
+    buffer = BytesIO()
+    image.convert('RGB').save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def _watermark_path(folder):
+    """The app's watermark, or a synthetic 400x120 RGBA logo written to `folder` if there is none"""
+    import cv2
+    import numpy as np
+
+    path = Path(DEOLDIFY_PATH) / 'resource_images' / 'watermark.png'
+    if path.exists():
+        return path
+    rng = np.random.RandomState(0)
+    logo = rng.randint(0, 256, (120, 400, 4), dtype=np.uint8)
+    path = Path(folder) / 'watermark.png'
+    cv2.imwrite(str(path), logo)
+    return path
+
+
+def _former_watermarked(pil_image, watermark_path):
+    """Watermarking as `visualize.get_watermarked` used to: logo read from disk, full frame overlay and blend"""
+    import cv2
+    import numpy as np
+    from PIL import Image
+
+    image = cv2.cvtColor(np.array(pil_image), cv2.COLOR_RGB2BGR)
+    (h, w) = image.shape[:2]
+    image = np.dstack([image, np.ones((h, w), dtype="uint8") * 255])
+    pct = 0.05
+    full_watermark = cv2.imread(str(watermark_path), cv2.IMREAD_UNCHANGED)
+    (fwH, fwW) = full_watermark.shape[:2]
+    wH = int(pct * h)
+    wW = int((pct * h / fwH) * fwW)
+    watermark = cv2.resize(full_watermark, (wH, wW), interpolation=cv2.INTER_AREA)
+    overlay = np.zeros((h, w, 4), dtype="uint8")
+    (wH, wW) = watermark.shape[:2]
+    overlay[h - wH - 10 : h - 10, 10 : 10 + wW] = watermark
+    output = image.copy()
+    cv2.addWeighted(overlay, 0.5, output, 1.0, 0, output)
+    return Image.fromarray(cv2.cvtColor(output, cv2.COLOR_BGR2RGB))
+
+
+def _preprocess_run(pipeline, data, render_factor, repeat):
+    """Time one preprocessing pipeline on encoded `data` in this fresh process, with its allocations"""
+    import torch
+    import numpy as np
+    from io import BytesIO
+    from PIL import Image
+    from fastai.vision.data import imagenet_stats, normalize_funcs
+    from fastai.vision.image import pil2tensor
+    from deoldify.filters import ColorizerFilter
+    from deoldify.visualize import ModelImageVisualizer
+
+    sz = render_factor * RENDER_BASE
+    device = torch.device('cpu')
+    norm, _ = normalize_funcs(*imagenet_stats)
+    vis = ModelImageVisualizer(None)
+    filtr = ColorizerFilter(model=torch.nn.Conv2d(1, 3, 1), device=device)
+
+    def chained():
+        # The former chain: RGB decode, RGB resize, LA and back to RGB, then tensor conversion and normalization
+        orig = Image.open(BytesIO(data)).convert('RGB')
+        model_image = orig.resize((sz, sz), resample=Image.BILINEAR).convert('LA').convert('RGB')
+        x = pil2tensor(model_image, np.float32).to(device)
+        x.div_(255)
+        x, _ = norm((x, x), do_x=True)
+        return orig, x
+
+    def fused():
+        orig = vis._to_luminance_image(data)
+        with torch.inference_mode():
+            return orig, filtr._model_input([np.array(filtr._get_model_ready_image(orig, sz))], 1)
+
+    run = chained if pipeline == 'chained' else fused
+    base = reset_peak_memory(device)
+    Image.core.reset_stats()
+    run()
+    images = Image.core.get_stats()['new_count']
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return median(times), images, None if base is None else peak_memory(device) - base
+
+
+def benchmark_preprocess(args):
+    """Decode-to-model-input time and allocations of the former chained and the fused preprocessing"""
+    ctx = multiprocessing.get_context('spawn')
+    print(f"🖼️ Preprocessing to a {args.render_factor * RENDER_BASE}px model input, median of {args.repeat} runs")
+    print(f"{'input':>7} {'pipeline':>9} {'time':>10} {'PIL images':>11} {'peak':>8}")
+    for megapixels in args.megapixels:
+        data = _synthetic_photo(megapixels)
+        for pipeline in ('chained', 'fused'):
+            # Fresh process each, so the peak RSS is this pipeline's own
+            with ctx.Pool(1) as pool:
+                latency, images, peak = pool.apply(_preprocess_run, (pipeline, data, args.render_factor, args.repeat))
+            print(f"{megapixels:>5}MP {pipeline:>9} {_format_latency(latency):>10} {images:>11} {_format_bytes(peak):>8}")
+
+
+def _postprocess_run(pipeline, data, render_factor, watermarked, repeat):
+    """Time one post-processor merging a model output with the original in this fresh process"""
+    import cv2
+    import numpy as np
+    import tempfile
+    import torch
+    from io import BytesIO
+    from PIL import Image
+    from deoldify.filters import ColorizerFilter
+    from deoldify.watermark import Watermark
+
+    watermark_path = _watermark_path(tempfile.mkdtemp())
+
+    sz = render_factor * RENDER_BASE
+    orig = Image.open(BytesIO(data)).convert('L')
+    rng = np.random.RandomState(0)
+    colors = rng.randint(0, 256, (sz // 32, sz // 32, 3), dtype=np.uint8)
+    model_image = Image.fromarray(colors).resize((sz, sz), Image.BICUBIC)
+    filtr = ColorizerFilter(model=torch.nn.Conv2d(1, 3, 1), guided_upsampling=pipeline == 'guided')
+
+    def former():
+        # Full RGB resize, then YUV conversion, copy and conversion back at full resolution
+        raw_color = model_image.resize(orig.size, resample=Image.BILINEAR)
+        color_yuv = cv2.cvtColor(np.asarray(raw_color), cv2.COLOR_RGB2YUV)
+        orig_yuv = cv2.cvtColor(np.asarray(orig.convert('RGB')), cv2.COLOR_RGB2YUV)
+        hires = np.copy(orig_yuv)
+        hires[:, :, 1:3] = color_yuv[:, :, 1:3]
+        final = Image.fromarray(cv2.cvtColor(hires, cv2.COLOR_YUV2RGB))
+        return _former_watermarked(final, watermark_path) if watermarked else final
+
+    def strips():
+        stamp = Watermark(watermark_path).stamper(orig.size) if watermarked else None
+        return filtr._post_process(filtr._chroma(model_image), orig, stamp)
+
+    run = former if pipeline == 'former' else strips
+    base = reset_peak_memory(torch.device('cpu'))
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return median(times), None if base is None else peak_memory(torch.device('cpu')) - base
+
+
+def benchmark_postprocess(args):
+    """Time and peak memory of merging model colors with full resolution luminance"""
+    ctx = multiprocessing.get_context('spawn')
+    print(f"🎨 Post-processing a {args.render_factor * RENDER_BASE}px model output"
+          f"{', watermarked' if args.watermarked else ''}, median of {args.repeat} runs")
+    print(f"{'input':>7} {'pipeline':>9} {'time':>10} {'peak':>8}")
+    for megapixels in args.megapixels:
+        data = _synthetic_photo(megapixels)
+        for pipeline in ('former', 'bilinear', 'guided'):
+            with ctx.Pool(1) as pool:
+                latency, peak = pool.apply(
+                    _postprocess_run, (pipeline, data, args.render_factor, args.watermarked, args.repeat)
+                )
+            print(f"{megapixels:>5}MP {pipeline:>9} {_format_latency(latency):>10} {_format_bytes(peak):>8}")
+
+
+def _tiled_run(model_type, device, data, render_factor, tile_size, tile_scale, tile_batch_size, repeat):
+    """Time one colorization of `data` in this fresh process, untiled if `tile_size` is None, with its peak memory"""
+    import torch
+    from deoldify.filters import ColorizerFilter
+    from deoldify.optimize import optimize_for_inference
+    from deoldify.visualize import ModelImageVisualizer
+
+    device = torch.device(device)
+    model = optimize_for_inference(load_model(model_type, device), grayscale=True)
+    filtr = ColorizerFilter(
+        model=model, device=device, tile_size=tile_size, tile_scale=tile_scale, tile_batch_size=tile_batch_size
+    )
+    orig = ModelImageVisualizer(None)._to_luminance_image(data)
+    # Warm-up, so one-off allocator and kernel setup is not counted
+    filtr.filter(orig, orig, render_factor)
+    base = reset_peak_memory(device)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        filtr.filter(orig, orig, render_factor)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return median(times), None if base is None else peak_memory(device) - base
+
+
+def benchmark_tiled(args):
+    """Time and peak memory of reaching a higher effective resolution with tiles instead of a larger render factor"""
+    ctx = multiprocessing.get_context('spawn')
+    data = _synthetic_photo(args.megapixels)
+    print(f"🧩 {args.model} model on {args.device}, {args.megapixels}MP input, {args.tile_size}px tiles "
+          f"in batches of {args.tile_batch_size}, median of {args.repeat} runs")
+    print(f"{'scale':>6} {'mode':>7} {'render':>12} {'time':>10} {'peak':>8}")
+    for tile_scale in args.tile_scales:
+        # Untiled, the whole image has to be rendered at the scaled size to reach the same resolution
+        untiled_rf = round(args.render_factor * tile_scale)
+        runs = [
+            ('untiled', untiled_rf, None, f'rf {untiled_rf}'),
+            ('tiled', args.render_factor, args.tile_size, f'rf {args.render_factor}+tiles'),
+        ]
+        for mode, render_factor, tile_size, label in runs:
+            with ctx.Pool(1) as pool:
+                latency, peak = pool.apply(
+                    _tiled_run,
+                    (args.model, args.device, data, render_factor, tile_size, tile_scale, args.tile_batch_size,
+                     args.repeat),
+                )
+            print(f"{tile_scale:>5}x {mode:>7} {label:>12} {_format_latency(latency):>10} {_format_bytes(peak):>8}")
+
+
+def benchmark_watermark(args):
+    """Per-frame time of watermarking: as before, with the cached compositor, and stamped in place"""
+    import tempfile
+    import numpy as np
+    from io import BytesIO
+    from PIL import Image
+    from deoldify.watermark import Watermark
+
+    watermark_path = _watermark_path(tempfile.mkdtemp())
+    print(f"💧 Watermarking {args.frames} frames with {watermark_path.name}, per frame")
+    print(f"{'input':>7} {'former':>10} {'cached':>10} {'in place':>10} {'same':>5}")
+    for megapixels in args.megapixels:
+        frame = Image.open(BytesIO(_synthetic_photo(megapixels))).convert('RGB')
+        # A fresh compositor, so reading and sizing the logo is counted once, as in a new process
+        watermark = Watermark(watermark_path)
+        pixels = np.array(frame)
+        runs = {
+            'former': lambda: _former_watermarked(frame, watermark_path),
+            'cached': lambda: watermark.apply(frame),
+            'in place': lambda: watermark.stamp(pixels, frame.size),
+        }
+        times = {}
+        for name, run in runs.items():
+            start = time.perf_counter()
+            for _ in range(args.frames):
+                run()
+            times[name] = (time.perf_counter() - start) / args.frames
+        former = _former_watermarked(frame, watermark_path)
+        same = np.array_equal(np.asarray(former), np.asarray(watermark.apply(frame)))
+        print(f"{megapixels:>5}MP {_format_latency(times['former'], 2):>10} {_format_latency(times['cached'], 2):>10} "
+              f"{_format_latency(times['in place'], 3):>10} {'yes' if same else 'no':>5}")
+
+
+def _video_frames(folder, megapixels, count):
+    """`count` JPEG frames of a slow pan across a synthetic photo, named as `_extract_raw_frames` names them"""
+    from io import BytesIO
+    from PIL import Image
+
+    photo = Image.open(BytesIO(_synthetic_photo(megapixels * 1.5))).convert('RGB')
+    width = int((megapixels * 1e6 * 16 / 9) ** 0.5)
+    height = int(width * 9 / 16)
+    folder.mkdir(parents=True, exist_ok=True)
+    for i in range(count):
+        left = (i * 4) % (photo.width - width)
+        photo.crop((left, 0, left + width, height)).save(folder / f'{i + 1:05d}.jpg', quality=95)
+    return width, height
+
+
+def _former_colorize_raw_frames(vis, bwframes_folder, colorframes_folder, render_factor):
+    """The loop `VideoColorizer._colorize_raw_frames` used to run: one `get_transformed_image` call per frame"""
+    for img in os.listdir(str(bwframes_folder)):
+        img_path = bwframes_folder / img
+        if os.path.isfile(str(img_path)):
+            color_image = vis.get_transformed_image(str(img_path), render_factor=render_factor)
+            color_image.save(str(colorframes_folder / img))
+
+
+def benchmark_video(args):
+    """Frames per second of colorizing extracted video frames: the former per-frame loop vs `FramePipeline`"""
+    import shutil
+    import tempfile
+    import torch
+    import numpy as np
+    from PIL import Image
+    from deoldify.filters import ColorizerFilter, MasterFilter
+    from deoldify.optimize import optimize_for_inference
+    from deoldify import visualize
+    from deoldify.visualize import ModelImageVisualizer, VideoColorizer
+
+    # Without the frame progress bar, which would print into the table
+    visualize.progress_bar = lambda gen, total=None: gen
+    device = torch.device(args.device)
+    model = optimize_for_inference(load_model(args.model, device), grayscale=True)
+    vis = ModelImageVisualizer(MasterFilter([ColorizerFilter(model=model, device=device)], args.render_factor))
+    workfolder = Path(tempfile.mkdtemp())
+    # Only its name is used: the frames are extracted already
+    source = Path('benchmark.mp4')
+    bwframes = workfolder / 'bwframes' / source.stem
+    colorframes = workfolder / 'colorframes' / source.stem
+    colorframes.mkdir(parents=True)
+    reference = workfolder / 'reference'
+    width, height = _video_frames(bwframes, args.megapixels, args.frames)
+    # Warm-up, so one-off allocator and kernel setup is not counted
+    vis.get_transformed_image(bwframes / '00001.jpg', render_factor=args.render_factor)
+
+    runs = [('per frame', lambda: _former_colorize_raw_frames(vis, bwframes, colorframes, args.render_factor))]
+    for batch_size in args.batch_sizes:
+        colorizer = VideoColorizer(vis, workfolder=workfolder, batch_size=batch_size, workers=args.workers)
+        runs.append((f'batch {batch_size}', lambda c=colorizer: c._colorize_raw_frames(source, args.render_factor)))
+
+    print(f"🎞️ {args.model} model on {args.device}, {args.frames} frames of {width}x{height} at render factor "
+          f"{args.render_factor}, {args.workers} post-processing workers")
+    print(f"{'mode':>10} {'time':>10} {'fps':>7} {'speedup':>8} {'max diff':>9}")
+    baseline = None
+    for mode, run in runs:
+        for frame in colorframes.iterdir():
+            frame.unlink()
+        start = time.perf_counter()
+        run()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        seconds = time.perf_counter() - start
+        if baseline is None:
+            baseline = seconds
+            shutil.copytree(colorframes, reference)
+        # Against the per-frame loop's frames: batched forwards may round differently
+        diff = max(
+            int(np.abs(np.asarray(Image.open(frame), dtype=np.int16)
+                       - np.asarray(Image.open(reference / frame.name), dtype=np.int16)).max())
+            for frame in colorframes.iterdir()
+        )
+        print(f"{mode:>10} {_format_latency(seconds):>10} {args.frames / seconds:>7.2f} "
+              f"{baseline / seconds:>7.2f}x {diff:>9}")
+    shutil.rmtree(workfolder)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark DeOldify colorizer inference')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    attention = subparsers.add_parser('attention', help='Peak memory and latency of full vs chunked self-attention')
+    attention.add_argument('--model', choices=['artistic', 'stable'], default='artistic',
+                           help='Model type to use')
+    attention.add_argument('--device', default='cpu', help='Torch device, e.g. cpu or cuda')
+    attention.add_argument('--render_factors', type=int, nargs='+', default=DEFAULT_RENDER_FACTORS,
+                           help='Render factors to measure (7-45)')
+    attention.add_argument('--repeat', type=int, default=3, help='Timed forwards per render factor')
+    attention.set_defaults(func=benchmark_attention)
+
+    coldstart = subparsers.add_parser('coldstart', help='Model load time with and without the fastai Learner')
+    coldstart.add_argument('--model', choices=['artistic', 'stable'], default='artistic',
+                           help='Model type to use')
+    coldstart.add_argument('--device', default='cpu', help='Torch device, e.g. cpu or cuda')
+    coldstart.add_argument('--runs', type=int, default=3, help='Fresh processes per builder')
+    coldstart.set_defaults(func=benchmark_coldstart)
+
+    optimize = subparsers.add_parser('optimize', help='Speedup and output difference of optimize_for_inference')
+    optimize.add_argument('--model', choices=['artistic', 'stable'], default='artistic',
+                          help='Model type to use')
+    optimize.add_argument('--device', default='cpu', help='Torch device, e.g. cpu or cuda')
+    optimize.add_argument('--render_factors', type=int, nargs='+', default=[15, 35],
+                          help='Render factors to measure (7-45)')
+    optimize.add_argument('--repeat', type=int, default=3, help='Timed forwards per render factor')
+    optimize.add_argument('--grayscale', action='store_true', help='Feed the optimized model a single gray channel')
+    optimize.set_defaults(func=benchmark_optimize)
+
+    overhead = subparsers.add_parser('overhead', help='Per-call overhead of Learner.pred_batch vs the direct path')
+    overhead.add_argument('--model', choices=['artistic', 'stable'], default='artistic',
+                          help='Model type to use')
+    overhead.add_argument('--device', default='cpu', help='Torch device, e.g. cpu or cuda')
+    overhead.add_argument('--render_factors', type=int, nargs='+', default=[7, 10, 15],
+                          help='Render factors to measure (7-45)')
+    overhead.add_argument('--repeat', type=int, default=5, help='Timed calls per render factor')
+    overhead.add_argument('--stub', action='store_true', help='Replace the model by a 1x1 conv to isolate the overhead')
+    overhead.set_defaults(func=benchmark_overhead)
+
+    preprocess = subparsers.add_parser('preprocess', help='Time and allocations of chained vs fused preprocessing')
+    preprocess.add_argument('--megapixels', type=float, nargs='+', default=[12, 50],
+                            help='Synthetic JPEG input sizes')
+    preprocess.add_argument('--render_factor', type=int, default=35, help='Render factor of the model input')
+    preprocess.add_argument('--repeat', type=int, default=5, help='Timed runs per pipeline')
+    preprocess.set_defaults(func=benchmark_preprocess)
+
+    postprocess = subparsers.add_parser('postprocess', help='Time and memory of the full-resolution color merge')
+    postprocess.add_argument('--megapixels', type=float, nargs='+', default=[12, 50],
+                             help='Synthetic JPEG input sizes')
+    postprocess.add_argument('--render_factor', type=int, default=35, help='Render factor of the model output')
+    postprocess.add_argument('--watermarked', action='store_true', help='Include watermarking the output')
+    postprocess.add_argument('--repeat', type=int, default=5, help='Timed runs per pipeline')
+    postprocess.set_defaults(func=benchmark_postprocess)
+
+    tiled = subparsers.add_parser('tiled', help='Tiled vs untiled colorization at the same effective resolution')
+    tiled.add_argument('--model', choices=['artistic', 'stable'], default='artistic')
+    tiled.add_argument('--device', default='cpu', help='Torch device, e.g. cpu or cuda')
+    tiled.add_argument('--megapixels', type=float, default=12, help='Synthetic JPEG input size')
+    tiled.add_argument('--render_factor', type=int, default=20, help='Render factor of the whole image pass')
+    tiled.add_argument('--tile_size', type=int, default=512)
+    tiled.add_argument('--tile_batch_size', type=int, default=4, help='Tiles per forward')
+    tiled.add_argument('--tile_scales', type=float, nargs='+', default=[2, 3],
+                       help='Effective resolutions, as multiples of the render size')
+    tiled.add_argument('--repeat', type=int, default=3, help='Timed runs per mode')
+    tiled.set_defaults(func=benchmark_tiled)
+
+    watermark = subparsers.add_parser('watermark', help='Per-frame cost of the former vs cached watermark compositor')
+    watermark.add_argument('--megapixels', type=float, nargs='+', default=[0.9, 2, 12],
+                           help='Synthetic frame sizes (0.9MP is 720p, 2MP is 1080p)')
+    watermark.add_argument('--frames', type=int, default=50, help='Frames watermarked per compositor')
+    watermark.set_defaults(func=benchmark_watermark)
+
+    video = subparsers.add_parser('video', help='Frames per second of the per-frame loop vs batched video frames')
+    video.add_argument('--model', choices=['artistic', 'stable'], default='artistic')
+    video.add_argument('--device', default='cpu', help='Torch device, e.g. cpu or cuda')
+    video.add_argument('--megapixels', type=float, default=0.9, help='Synthetic frame size (0.9MP is 720p)')
+    video.add_argument('--frames', type=int, default=48, help='Frames colorized per mode')
+    video.add_argument('--render_factor', type=int, default=21, help='Render factor (the video default)')
+    video.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4, 8], help='Frames per forward')
+    video.add_argument('--workers', type=int, default=2, help='Post-processing threads')
+    video.set_defaults(func=benchmark_video)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
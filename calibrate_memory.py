@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+DeOldify Memory Calibration
+Usage: python calibrate_memory.py [--model artistic] [--device cpu] [--render_factors 7 15 25 35 45]
+
+Measures the peak memory of the colorizer at several render sizes, loaded the way the web
+app loads it, and writes deoldify_core/models/memory/<model>-<device>.json. With that table,
+requests that would not fit in the memory available are rendered at a lower render factor
+(with tiles making up the resolution) instead of running out of memory. Calibrate again on
+each host, after changing the model settings, and after upgrading torch or onnxruntime.
+"""
+
+import sys
+import os
+import argparse
+from pathlib import Path
+
+# Add DeOldify to path (resolved once, so nothing depends on the working directory)
+DEOLDIFY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'deoldify_core')
+if DEOLDIFY_PATH not in sys.path:
+    sys.path.insert(0, DEOLDIFY_PATH)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Calibrate the pre-flight memory estimates of a DeOldify colorizer')
+    parser.add_argument('--model', choices=['artistic', 'stable'], default='artistic',
+                        help='Model type to calibrate')
+    parser.add_argument('--device', default=None, help='Torch device, e.g. cpu or cuda (default: as the app picks)')
+    parser.add_argument('--quantize', choices=['dynamic', 'static'], default=None,
+                        help='Calibrate the int8 model (as COLORIZER_QUANTIZE)')
+    parser.add_argument('--backend', choices=['torch', 'onnx'], default='torch',
+                        help='Calibrate on PyTorch or ONNX Runtime (as COLORIZER_BACKEND)')
+    parser.add_argument('--no_optimize', action='store_true',
+                        help='Calibrate the model as trained (as COLORIZER_OPTIMIZE=0)')
+    parser.add_argument('--render_factors', type=int, nargs='+', default=[7, 15, 25, 35, 45],
+                        help='Render factors to measure (7-45); at least two')
+    args = parser.parse_args()
+
+    if len(args.render_factors) < 2:
+        print("Error: At least two render factors are needed")
+        return 1
+
+    import torch
+    from deoldify.memory import calibrate_memory
+    from deoldify.registry import ModelRegistry
+
+    if args.device is None:
+        use_cuda = torch.cuda.is_available() and not args.quantize and args.backend == 'torch'
+        args.device = 'cuda' if use_cuda else 'cpu'
+
+    print(f"Loading {args.model} model on {args.device}...")
+    registry = ModelRegistry(optimize=not args.no_optimize)
+    model_args = dict(
+        root_folder=Path(DEOLDIFY_PATH),
+        artistic=args.model == 'artistic',
+        device=torch.device(args.device),
+        quantize=args.quantize,
+        backend=args.backend,
+    )
+    filtr = registry.get_filter(**model_args)
+
+    print(f"Measuring render factors {sorted(args.render_factors)}...")
+    sizes = [rf * filtr.render_base for rf in args.render_factors]
+    try:
+        estimator = calibrate_memory(filtr, sizes)
+    except ValueError as e:
+        print(f"❌ Calibration failed: {e}")
+        return 1
+
+    path = registry.memory_table_path(**model_args)
+    estimator.save(path, device=str(filtr.device), torch=torch.__version__)
+    print(f"✅ Saved {path}")
+    print(f"{'render':>8} {'peak':>10}")
+    for pixels, nbytes in estimator.points:
+        print(f"{int(pixels ** 0.5) // filtr.render_base:>8} {nbytes / 2 ** 20:>7.0f} MB")
+    print("Restart the app to pick up the new table.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,91 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+from fastai.torch_core import *
+import threading
+import time
+
+__all__ = ['BatchScheduler']
+
+
+class _PendingRequest:
+    def __init__(self, x: Tensor):
+        self.x = x
+        self.future = Future()
+        self.arrived = time.perf_counter()
+
+
+class _PendingGroup:
+    def __init__(self, model: nn.Module):
+        self.model = model
+        self.requests = []
+
+
+class BatchScheduler:
+    "Groups concurrent single-image forwards by (model, input shape) and runs them as one batch."
+
+    def __init__(self, max_batch_size: int = 8, max_wait: float = 0.01):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._groups = OrderedDict()
+        self._cond = threading.Condition()
+        self._worker = None
+        self.batches = 0
+        self.requests = 0
+
+    def submit(self, model: nn.Module, x: Tensor) -> Future:
+        "Queue `x` (a single CxHxW input already on the model's device) for `model`; the future holds its output."
+        request = _PendingRequest(x)
+        # The model itself rather than its id, which a model loaded after this one is evicted could reuse
+        key = (model, tuple(x.shape), x.device)
+        with self._cond:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._work, name='deoldify-batcher', daemon=True)
+                self._worker.start()
+            group = self._groups.get(key)
+            if group is None:
+                group = self._groups[key] = _PendingGroup(model)
+            group.requests.append(request)
+            self._cond.notify()
+        return request.future
+
+    def _next_batch(self) -> Tuple[nn.Module, List[_PendingRequest]]:
+        "Wait for a group to fill up or for the oldest one to time out, then pop up to `max_batch_size` of its requests."
+        with self._cond:
+            while True:
+                while not self._groups:
+                    self._cond.wait()
+                full = [(k, g) for k, g in self._groups.items() if len(g.requests) >= self.max_batch_size]
+                key, group = full[0] if full else next(iter(self._groups.items()))
+                remaining = group.requests[0].arrived + self.max_wait - time.perf_counter()
+                if full or remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            requests = group.requests[: self.max_batch_size]
+            del group.requests[: self.max_batch_size]
+            if not group.requests:
+                del self._groups[key]
+            return group.model, requests
+
+    def _work(self):
+        while True:
+            model, requests = self._next_batch()
+            try:
+                with torch.inference_mode():
+                    out = model(torch.stack([r.x for r in requests]))
+            except Exception as e:
+                for r in requests:
+                    r.future.set_exception(e)
+                continue
+            with self._cond:
+                self.batches += 1
+                self.requests += len(requests)
+            for i, r in enumerate(requests):
+                r.future.set_result(out[i])
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                'batches': self.batches,
+                'requests': self.requests,
+                'avg_batch_size': self.requests / self.batches if self.batches else None,
+            }
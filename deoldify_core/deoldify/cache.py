@@ -0,0 +1,157 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+from fastai.core import *
+from PIL import Image as PilImage
+import threading
+import time
+import logging
+
+__all__ = ['ResultCache']
+
+# Temporary files older than this are left from writes cut short, not ones still in progress in another process
+_STALE_TMP_SECONDS = 3600
+
+
+class ResultCache:
+    "Disk cache of finished colorizations keyed by input pixels and render settings, LRU-evicted above `max_bytes`."
+
+    def __init__(self, cache_dir: Path, max_bytes: int = 1024 ** 3):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._index = OrderedDict()
+        self._nbytes = 0
+        # Sweep the temporary files of writes cut short by a crash
+        for path in self.cache_dir.glob('*/*.tmp'):
+            try:
+                if time.time() - path.stat().st_mtime > _STALE_TMP_SECONDS:
+                    path.unlink()
+            except OSError:
+                pass
+        # Rebuild recency order from the files left by previous runs, oldest first.
+        files = sorted(self.cache_dir.glob('*/*.png'), key=lambda p: p.stat().st_mtime)
+        for path in files:
+            self._index[path.stem] = path.stat().st_size
+            self._nbytes += self._index[path.stem]
+
+    def make_key(
+        self,
+        image: PilImage,
+        model_id: str,
+        render_factor: int,
+        post_process: bool,
+        watermarked: bool,
+    ) -> str:
+        "Hash of the decoded pixels of `image` together with everything that changes the result."
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update('{0}|{1}|{2}|{3}|{4}|{5}|'.format(
+            image.mode, image.size, model_id, render_factor, post_process, watermarked
+        ).encode())
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / (key + '.png')
+
+    def get(self, key: str) -> Optional[PilImage]:
+        with self._lock:
+            if key not in self._index:
+                return None
+            self._index.move_to_end(key)
+        path = self._path(key)
+        try:
+            image = PilImage.open(path)
+            image.load()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self._nbytes -= self._index.pop(key, 0)
+            return None
+        return image
+
+    def put(self, key: str, image: PilImage):
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        # Unique to the writer, as several processes may share the cache directory
+        tmp_path = path.with_suffix('.{0}-{1}.tmp'.format(os.getpid(), threading.get_ident()))
+        try:
+            image.save(tmp_path, format='PNG')
+            os.replace(tmp_path, path)
+        finally:
+            # Left behind if saving failed part way, e.g. with the disk full
+            tmp_path.unlink(missing_ok=True)
+        with self._lock:
+            self._nbytes -= self._index.pop(key, 0)
+            self._index[key] = path.stat().st_size
+            self._nbytes += self._index[key]
+            evicted = self._evict_over_budget()
+        for old in evicted:
+            try:
+                self._path(old).unlink()
+            except OSError:
+                pass
+
+    def _evict_over_budget(self) -> List[str]:
+        evicted = []
+        while len(self._index) > 1 and self._nbytes > self.max_bytes:
+            old, size = self._index.popitem(last=False)
+            self._nbytes -= size
+            evicted.append(old)
+        return evicted
+
+    def get_or_compute(
+        self, key: str, compute: Callable[[], PilImage], cacheable: Callable[[PilImage], bool] = None
+    ) -> PilImage:
+        """Return the cached result for `key`, running `compute` only once for concurrent identical requests.
+        Computed results for which `cacheable` returns False are handed out but not stored."""
+        image = self.get(key)
+        if image is not None:
+            with self._lock:
+                self.hits += 1
+            return image
+
+        with self._lock:
+            pending = self._inflight.get(key)
+            if pending is None:
+                pending = self._inflight[key] = Future()
+                owner = True
+                self.misses += 1
+            else:
+                owner = False
+                self.coalesced += 1
+
+        if not owner:
+            # Callers are free to close what they get back, so each one gets its own copy.
+            return pending.result().copy()
+
+        try:
+            image = compute()
+            try:
+                if cacheable is None or cacheable(image):
+                    self.put(key, image)
+            except OSError as e:
+                logging.warning('Could not write colorization result to cache: {0}'.format(e))
+            pending.set_result(image.copy())
+            return image
+        except BaseException as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'entries': len(self._index),
+                'nbytes': self._nbytes,
+                'max_bytes': self.max_bytes,
+            }
@@ -0,0 +1,98 @@
+from fastai.torch_core import *
+from .optimize import OptimizedUnet
+import logging
+
+__all__ = ['CompiledColorizer', 'compiled_cache_dir']
+
+# Bumped when the traced graph changes, so graphs saved by earlier versions are traced again
+# 2: self-attention traced as the chunked loop of `ChunkedSelfAttention` rather than the full matrix
+_GRAPH_VERSION = 2
+
+
+def compiled_cache_dir(root_folder: Path, weights_name: str) -> Path:
+    "Where the TorchScript graph for `weights_name` is kept. Graphs don't carry across torch versions."
+    return Path(root_folder) / 'models' / 'torchscript' / f'{weights_name}-torch{torch.__version__}'
+
+
+class CompiledColorizer(nn.Module):
+    """An `OptimizedUnet` run as a frozen TorchScript graph, without the Python overhead of the UNet's
+    layer loop, for the render sizes passed to `compile`. Other sizes run eagerly.
+    The graph is saved in `cache_dir` and reused by later processes unless `source` (the checkpoint) is newer."""
+
+    def __init__(self, model: OptimizedUnet, cache_dir: Optional[Path] = None, source: Optional[Path] = None):
+        super().__init__()
+        self.model = model
+        self.cache_dir = None if cache_dir is None else Path(cache_dir)
+        self.source = None if source is None else Path(source)
+        self.graph = None
+        # Bytes of the graph's own copy of the weights, when it was loaded from disk
+        self.graph_nbytes = 0
+        self._sizes = set()
+
+    @property
+    def grayscale(self) -> bool:
+        return self.model.grayscale
+
+    @property
+    def sizes(self) -> List[int]:
+        return sorted(self._sizes)
+
+    def _artifact_path(self, device: torch.device) -> Optional[Path]:
+        if self.cache_dir is None:
+            return None
+        return self.cache_dir / f'{device.type}-v{_GRAPH_VERSION}.pt'
+
+    def _load_graph(self, path: Optional[Path], device: torch.device) -> Optional[torch.jit.ScriptModule]:
+        if path is None or not path.exists():
+            return None
+        if self.source is not None and self.source.exists() and path.stat().st_mtime < self.source.stat().st_mtime:
+            return None
+        try:
+            graph = torch.jit.load(str(path), map_location=device)
+        except RuntimeError as e:
+            logging.warning('Ignoring unreadable compiled graph {0}: {1}'.format(path, e))
+            return None
+        self.graph_nbytes = path.stat().st_size
+        return graph
+
+    def _example(self, size: int, device: torch.device) -> Tensor:
+        return torch.randint(0, 256, (1, 1 if self.grayscale else 3, size, size), device=device).float()
+
+    def _trace(self, size: int, device: torch.device) -> torch.jit.ScriptModule:
+        """The frozen graph of the model, traced at `size` but serving every size. Self-attention is traced as
+        the chunked loop of `ChunkedSelfAttention`, so the graph needs the same memory as the eager model and shares
+        its memory table. The tradeoff is a loop in the graph where the full matrix would be one `bmm`: the chunks
+        run one after another, at whatever `chunk_size` was set when tracing, even for inputs small enough for one."""
+        logging.info('Tracing colorizer at {0}x{0}'.format(size))
+        with torch.no_grad():
+            traced = torch.jit.trace(self.model.eval(), self._example(size, device), check_trace=False)
+        return torch.jit.freeze(traced)
+
+    def compile(self, sizes: Collection[int]):
+        "Load or trace the graph, then warm it up for square inputs of each of `sizes`."
+        sizes = [size for size in sizes if size not in self._sizes]
+        if not sizes:
+            return
+        device = next(self.model.parameters()).device
+        if self.graph is None:
+            path = self._artifact_path(device)
+            graph = self._load_graph(path, device)
+            if graph is None:
+                graph = self._trace(sizes[0], device)
+                if path is not None:
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    torch.jit.save(graph, str(path))
+            self.graph = graph
+        for size in sizes:
+            # The profiling executor specializes the graph for a shape over its first runs,
+            # which should happen here rather than on a request
+            with torch.no_grad():
+                for _ in range(2):
+                    self.graph(self._example(size, device))
+            self._sizes.add(size)
+
+    def forward(self, x: Tensor) -> Tensor:
+        h, w = x.shape[-2:]
+        if h == w and h in self._sizes:
+            return self.graph(x)
+        return self.model(x)
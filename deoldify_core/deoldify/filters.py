@@ -1,4 +1,3 @@
-from fastai.basic_data import DatasetType
 from fastai.basic_train import Learner
 from abc import ABC, abstractmethod
 from fastai.core import *
@@ -9,6 +8,15 @@ from fastai import *
 import cv2
 from PIL import Image as PilImage
 from deoldify import device as device_settings
+import math
+import threading
+import time
+from .batching import BatchScheduler
+from .compiled import CompiledColorizer
+from .latency import LatencyModel
+from .memory import MemoryEstimator, is_out_of_memory, memory_reservations
+from .optimize import OptimizedUnet
+from .runtime import OnnxColorizer
 import logging
 
 
@@ -21,15 +29,35 @@ class IFilter(ABC):
 
 
 class BaseFilter(IFilter):
-    def __init__(self, learn: Learner, stats: tuple = imagenet_stats):
+    def __init__(
+        self,
+        learn: Learner = None,
+        stats: tuple = imagenet_stats,
+        batcher: BatchScheduler = None,
+        device: torch.device = None,
+        model: nn.Module = None,
+    ):
         super().__init__()
+        # Either a `Learner` or a bare generator from `gen_model_*` can drive the filter
         self.learn = learn
+        self.model = learn.model if learn is not None else model
+        self.batcher = batcher
         
-        if not device_settings.is_gpu():
-            self.learn.model = self.learn.model.cpu()
-        
-        self.device = next(self.learn.model.parameters()).device
-        self.norm, self.denorm = normalize_funcs(*stats)
+        if isinstance(self.model, OnnxColorizer):
+            # ONNX Runtime sessions take and return CPU tensors
+            self.device = torch.device('cpu')
+        else:
+            if device is not None:
+                self.model = self.model.to(device)
+            elif not device_settings.is_gpu():
+                self.model = self.model.cpu()
+            if self.learn is not None:
+                self.learn.model = self.model
+            self.device = next(self.model.parameters()).device
+            self.model.eval()
+        self.mean, self.std = [torch.tensor(s, device=self.device)[:, None, None] for s in stats]
+        # Input tensors are reused between calls of the same size, one per calling thread
+        self._buffers = threading.local()
 
     def _transform(self, image: PilImage) -> PilImage:
         return image
@@ -45,26 +73,52 @@ class BaseFilter(IFilter):
         result = self._transform(result)
         return result
 
+    def _forward(self, x: Tensor) -> Tensor:
+        if self.batcher is None:
+            return self.model(x)
+        # The scheduler stacks these with any concurrent forwards of the same size
+        futures = [self.batcher.submit(self.model, xi) for xi in x]
+        return torch.stack([future.result() for future in futures])
+
+    @property
+    def _optimized(self) -> bool:
+        # An `OptimizedUnet` (compiled or exported to ONNX) does its own scaling, normalization and denormalization
+        return isinstance(self.model, (OptimizedUnet, CompiledColorizer, OnnxColorizer))
+
+    def _model_input(self, images: List[np.ndarray], channels: int) -> Tensor:
+        """`images` (HxW or HxWxC uint8, all the same size) as an NxCxHxW float tensor in a buffer reused
+        for its shape. Single channel images are broadcast to `channels` by the same copy."""
+        shape = (len(images), channels, *images[0].shape[:2])
+        x = getattr(self._buffers, 'x', None)
+        if x is None or x.shape != shape:
+            # Only the last size is kept: render sizes rarely change between calls
+            x = self._buffers.x = torch.empty(shape, dtype=torch.float32, device=self.device)
+        for xi, image in zip(x, images):
+            pixels = torch.from_numpy(image)
+            xi.copy_(pixels.expand(shape[1:]) if image.ndim == 2 else pixels.permute(2, 0, 1))
+        return x
+
+    def _model_predict(self, images: List[np.ndarray]) -> np.ndarray:
+        "Run the model on `images` as one batch and return their colors as an NxHxWx3 uint8 array."
+        optimized = self._optimized
+        x = self._model_input(images, 1 if optimized and self.model.grayscale else 3)
+        if optimized:
+            out = self._forward(x)
+        else:
+            x.div_(255).sub_(self.mean).div_(self.std)
+            out = self._forward(x).mul_(self.std).add_(self.mean).clamp_(min=0, max=1)
+        # Truncated like `image2np(out * 255).astype(np.uint8)`
+        return out.mul_(255).to(torch.uint8).permute(0, 2, 3, 1).contiguous().cpu().numpy()
+
     def _model_process(self, orig: PilImage, sz: int) -> PilImage:
         model_image = self._get_model_ready_image(orig, sz)
-        x = pil2tensor(model_image, np.float32)
-        x = x.to(self.device)
-        x.div_(255)
-        x, y = self.norm((x, x), do_x=True)
-        
-        try:
-            result = self.learn.pred_batch(
-                ds_type=DatasetType.Valid, batch=(x[None], y[None]), reconstruct=True
-            )
-        except RuntimeError as rerr:
-            if 'memory' not in str(rerr):
-                raise rerr
-            logging.warn('Warning: render_factor was set too high, and out of memory error resulted. Returning original image.')
-            return model_image
-            
-        out = result[0]
-        out = self.denorm(out.px, do_x=False)
-        out = image2np(out * 255).astype(np.uint8)
+        if self._optimized and self.model.grayscale and model_image.mode != 'L':
+            # A gray image in RGB carries all of it in its L channel
+            model_image = model_image.convert('L')
+        # The model runs directly, not through `Learner.pred_batch` and its callbacks and data lookups.
+        # Running out of memory raises: what to do then is up to the filter (see `ColorizerFilter.filter`).
+        with torch.inference_mode():
+            out = self._model_predict([np.array(model_image)])[0]
         return PilImage.fromarray(out)
 
     def _unsquare(self, image: PilImage, orig: PilImage) -> PilImage:
@@ -73,42 +127,446 @@ class BaseFilter(IFilter):
         return image
 
 
+def _resize_rows(src: np.ndarray, size: Tuple[int, int], top: int, bottom: int, dst: np.ndarray = None) -> np.ndarray:
+    """Rows `top` to `bottom` of `src` (hxw or hxwxC) bilinearly resized to `size` (w, h), without resizing
+    the other rows. Pixel centers map as in `cv2.resize`, and each row comes out the same whatever strip it is in."""
+    w, h = size
+    # Vertically, the two source rows of each output row are blended exactly...
+    fy = np.maximum((np.arange(top, bottom) + 0.5) * src.shape[0] / h - 0.5, 0)
+    y0 = np.minimum(fy.astype(int), src.shape[0] - 1)
+    y1 = np.minimum(y0 + 1, src.shape[0] - 1)
+    wy = (fy - y0).astype(np.float32).reshape(-1, *([1] * (src.ndim - 1)))
+    rows = src[y0].astype(np.float32)
+    rows += (src[y1] - rows) * wy
+    # ...then horizontally, one row at a time. OpenCV rounds a lone row slightly differently, so it is doubled.
+    n = bottom - top
+    rows = cv2.resize(rows if n > 1 else np.repeat(rows, 2, axis=0), (w, max(n, 2)), interpolation=cv2.INTER_LINEAR)[:n]
+    if src.dtype == np.uint8:
+        rows += 0.5
+    if dst is None:
+        return rows.astype(src.dtype)
+    np.copyto(dst, rows, casting='unsafe')
+    return dst
+
+
+def _shrink(src: np.ndarray, size: Tuple[int, int]) -> np.ndarray:
+    "`src` shrunk by area to at most `size` (w, h) where it is larger, as bilinear sampling alone would alias."
+    w, h = size
+    if w < src.shape[1] or h < src.shape[0]:
+        return cv2.resize(src, (min(w, src.shape[1]), min(h, src.shape[0])), interpolation=cv2.INTER_AREA)
+    return src
+
+
+def _paste_rows(image: PilImage, rows: np.ndarray, top: int):
+    "Copy `rows` (hxwx3 RGB uint8) into `image`, from row `top` down."
+    image.paste(PilImage.frombuffer('RGB', rows.shape[1::-1], rows, 'raw', 'RGB', 0, 1), (0, top))
+
+
+def _guided_coefficients(
+    small_guide: np.ndarray, src: np.ndarray, radius: int, eps: float
+) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """Fast guided filter fits of the planes of `src` (hxwx2 uint8) on `small_guide` (hxw uint8), made at
+    low resolution. Each plane upsampled along a full resolution guide is a * guide + b, in 0-255 levels,
+    with its (a, b) resized to the guide's size, so chroma edges follow the full resolution luminance edges."""
+    ksize = (2 * radius + 1, 2 * radius + 1)
+    i = small_guide.astype(np.float32) / 255
+    mean_i = cv2.blur(i, ksize)
+    var_i = cv2.blur(i * i, ksize) - mean_i * mean_i
+    coefficients = []
+    for c in range(src.shape[2]):
+        p = src[:, :, c].astype(np.float32) / 255
+        mean_p = cv2.blur(p, ksize)
+        a = (cv2.blur(i * p, ksize) - mean_i * mean_p) / (var_i + eps)
+        b = mean_p - a * mean_i
+        coefficients.append((cv2.blur(a, ksize), cv2.blur(b * 255 + 0.5, ksize)))
+    return coefficients
+
+
+def _degradation(cause: str, setting: str, before: Any, after: Any, **info) -> dict:
+    "Record of a setting changed to fit in memory, for the result's `info['degradations']`."
+    logging.warning(
+        'Colorizer {0} changed from {1} to {2} to fit in memory ({3})'.format(setting, before, after, cause)
+    )
+    return {'cause': cause, 'setting': setting, 'from': before, 'to': after, **info}
+
+
+def _tile_starts(length: int, tile: int, overlap: int) -> List[int]:
+    "Evenly spaced starts of tiles covering `length`, each overlapping the next by at least `overlap`."
+    if length <= tile:
+        return [0]
+    count = math.ceil((length - overlap) / (tile - overlap))
+    return [round(i * (length - tile) / (count - 1)) for i in range(count)]
+
+
+def _feather_window(h: int, w: int, overlap: int) -> np.ndarray:
+    "HxW blend weights ramping up over `overlap` pixels from each edge, never reaching zero."
+    ramps = [np.minimum(np.minimum(np.arange(1, n + 1), np.arange(n, 0, -1)) / (overlap + 1), 1) for n in (h, w)]
+    return np.outer(*ramps).astype(np.float32)
+
+
 class ColorizerFilter(BaseFilter):
-    def __init__(self, learn: Learner, stats: tuple = imagenet_stats):
-        super().__init__(learn=learn, stats=stats)
+    def __init__(
+        self,
+        learn: Learner = None,
+        stats: tuple = imagenet_stats,
+        batcher: BatchScheduler = None,
+        device: torch.device = None,
+        model: nn.Module = None,
+        guided_upsampling: bool = False,
+        guided_radius: int = 2,
+        guided_eps: float = 1e-3,
+        tile_size: Optional[int] = None,
+        tile_overlap: int = 64,
+        tile_scale: float = 2.0,
+        tile_batch_size: int = 4,
+        strip_rows: int = 256,
+        memory_estimator: Optional[MemoryEstimator] = None,
+        min_render_factor: int = 7,
+        fallback_tile_size: Optional[int] = 256,
+    ):
+        super().__init__(learn=learn, stats=stats, batcher=batcher, device=device, model=model)
         self.render_base = 16
+        # Upsample the chroma along the original's luminance edges instead of bilinearly.
+        # The radius is in model pixels.
+        self.guided_upsampling = guided_upsampling
+        self.guided_radius = guided_radius
+        self.guided_eps = guided_eps
+        # With `tile_size`, images are also colorized in overlapping tile_size squares at `tile_scale` times
+        # the render size, `tile_batch_size` tiles per forward (see `_tiled_process`)
+        if tile_size is not None and (tile_size % self.render_base or tile_overlap >= tile_size):
+            raise ValueError('tile_size must be a multiple of {0} larger than tile_overlap'.format(self.render_base))
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.tile_scale = tile_scale
+        self.tile_batch_size = tile_batch_size
+        # Full resolution outputs are written `strip_rows` at a time, straight into the result image
+        self.strip_rows = strip_rows
+        # Requests predicted by `memory_estimator` not to fit, or running out of memory, are rendered at
+        # a lower render_factor (down to `min_render_factor`), with tiles of `fallback_tile_size` making up
+        # the requested resolution if the filter has no tiles of its own (see `_plan`)
+        if fallback_tile_size is not None and (
+            fallback_tile_size % self.render_base or tile_overlap >= fallback_tile_size
+        ):
+            raise ValueError(
+                'fallback_tile_size must be a multiple of {0} larger than tile_overlap'.format(self.render_base)
+            )
+        self.memory_estimator = memory_estimator
+        self.min_render_factor = min_render_factor
+        self.fallback_tile_size = fallback_tile_size
+        # Timings of every call, for `estimate_latency`
+        self.latency = LatencyModel()
 
     def filter(
-        self, orig_image: PilImage, filtered_image: PilImage, render_factor: int, post_process: bool = True) -> PilImage:
-        render_sz = render_factor * self.render_base
-        model_image = self._model_process(orig=filtered_image, sz=render_sz)
-        raw_color = self._unsquare(model_image, orig_image)
+        self,
+        orig_image: PilImage,
+        filtered_image: PilImage,
+        render_factor: int,
+        post_process: bool = True,
+        stamp: Callable[[np.ndarray, int], None] = None,
+    ) -> PilImage:
+        """`stamp`, if given, is called with each RGB strip of the output and its top row, and can draw
+        on it in place (see `visualize.watermark_stamp`).
+        The result's `info` holds the 'render_factor' it was rendered at and its 'degradations': the settings
+        changed to fit in memory, each a dict of the 'cause' ('estimate' or 'out_of_memory'), the 'setting'
+        and its value 'from' and 'to'. Out of memory errors at `min_render_factor` are raised."""
+        requested_sz = render_factor * self.render_base
+        # Tiles make up for a lowered render_factor at the requested resolution, or add detail above it
+        work_sz = requested_sz if self.tile_size is None else requested_sz * self.tile_scale
+        degradations = []
+        # Planned and reserved in one step, so that concurrent requests plan against what is left
+        with memory_reservations.lock:
+            render_factor, tile_size, tile_batch_size = self._plan(render_factor, degradations)
+            reserved = self._planned_bytes(render_factor, tile_size, tile_batch_size)
+            memory_reservations.add(self.device, reserved)
+        try:
+            while True:
+                try:
+                    start = time.perf_counter()
+                    model_image = self._model_process(orig=filtered_image, sz=render_factor * self.render_base)
+                    self.latency.record_forward(render_factor * self.render_base, time.perf_counter() - start)
+                    break
+                except (RuntimeError, MemoryError) as err:
+                    if not is_out_of_memory(err) or render_factor <= self.min_render_factor:
+                        raise
+                    smaller = max(self.min_render_factor, render_factor * 3 // 4)
+                    degradations.append(_degradation('out_of_memory', 'render_factor', render_factor, smaller))
+                    render_factor = smaller
+                    if tile_size is None and self.fallback_tile_size is not None:
+                        degradations.append(
+                            _degradation('out_of_memory', 'tile_size', None, self.fallback_tile_size)
+                        )
+                        tile_size = self.fallback_tile_size
+                # Only reached after an error, once the failed forward's tensors are released along with it
+                self._release_memory()
+            render_sz = render_factor * self.render_base
+
+            yuv = None
+            while tile_size is not None:
+                try:
+                    start = time.perf_counter()
+                    yuv = self._tiled_process(
+                        filtered_image, model_image, render_sz, work_sz, tile_size, tile_batch_size
+                    )
+                    if yuv is not None:
+                        self.latency.record_pixels('tiles', yuv.shape[0] * yuv.shape[1], time.perf_counter() - start)
+                    break
+                except (RuntimeError, MemoryError) as err:
+                    if not is_out_of_memory(err):
+                        raise
+                    if tile_batch_size > 1:
+                        degradations.append(
+                            _degradation('out_of_memory', 'tile_batch_size', tile_batch_size, tile_batch_size // 2)
+                        )
+                        tile_batch_size //= 2
+                    else:
+                        degradations.append(_degradation('out_of_memory', 'tile_size', tile_size, None))
+                        tile_size = None
+                self._release_memory()
+        finally:
+            # Post-processing is outside the memory table, which measures forwards
+            memory_reservations.release(self.device, reserved)
 
+        result = self._finish(orig_image, model_image, yuv, post_process, stamp)
+        result.info['render_factor'] = render_factor
+        result.info['degradations'] = degradations
+        return result
+
+    def _finish(
+        self, orig_image: PilImage, model_image: PilImage, yuv: Optional[np.ndarray], post_process: bool,
+        stamp: Callable = None,
+    ) -> PilImage:
+        "The full resolution result from the model's output, or the tiles' `yuv` if not None."
+        start = time.perf_counter()
         if post_process:
-            return self._post_process(raw_color, orig_image)
+            chroma = self._chroma(model_image) if yuv is None else yuv[:, :, 1:]
+            result = self._post_process(chroma, orig_image, stamp)
         else:
-            return raw_color
+            colors = np.asarray(model_image) if yuv is None else cv2.cvtColor(yuv, cv2.COLOR_YUV2RGB)
+            result = self._upsample(colors, orig_image.size, stamp)
+        self.latency.record_pixels('post_process', orig_image.width * orig_image.height, time.perf_counter() - start)
+        return result
 
-    def _transform(self, image: PilImage) -> PilImage:
-        return image.convert('LA').convert('RGB')
+    def _plan(self, render_factor: int, degradations: List[dict]) -> Tuple[int, Optional[int], int]:
+        """Pre-flight check of a request against the memory available now, as predicted by `memory_estimator`.
+        Returns the render_factor, tile size and tile batch size to run with, recording any change made
+        to the requested ones in `degradations`: the render_factor is lowered to the highest that fits,
+        and tiles are switched to (or their batches shrunk, or dropped) so that they fit as well.
+        Call with `memory_reservations.lock` held, and reserve the `_planned_bytes` of the plan before releasing it."""
+        tile_size, tile_batch_size = self.tile_size, self.tile_batch_size
+        budget = None if self.memory_estimator is None else self.memory_estimator.budget(self.device)
+        if budget is None:
+            return render_factor, tile_size, tile_batch_size
+        estimate = self._forward_bytes
+
+        requested_bytes = estimate(render_factor * self.render_base)
+        if requested_bytes > budget and render_factor > self.min_render_factor:
+            lower = range(render_factor - 1, self.min_render_factor - 1, -1)
+            fitting = next((rf for rf in lower if estimate(rf * self.render_base) <= budget), self.min_render_factor)
+            degradations.append(
+                _degradation(
+                    'estimate', 'render_factor', render_factor, fitting,
+                    estimated_bytes=requested_bytes, budget_bytes=budget,
+                )
+            )
+            render_factor = fitting
+            if tile_size is None and self.fallback_tile_size is not None:
+                batches = [n for n in range(tile_batch_size, 0, -1) if estimate(self.fallback_tile_size, n) <= budget]
+                if batches:
+                    degradations.append(
+                        _degradation('estimate', 'tile_size', None, self.fallback_tile_size, tile_batch_size=batches[0])
+                    )
+                    return render_factor, self.fallback_tile_size, batches[0]
+
+        if tile_size is not None and estimate(tile_size, tile_batch_size) > budget:
+            batches = [n for n in range(tile_batch_size - 1, 0, -1) if estimate(tile_size, n) <= budget]
+            if batches:
+                degradations.append(_degradation('estimate', 'tile_batch_size', tile_batch_size, batches[0]))
+                tile_batch_size = batches[0]
+            else:
+                degradations.append(_degradation('estimate', 'tile_size', tile_size, None))
+                tile_size = None
+        return render_factor, tile_size, tile_batch_size
+
+    def _forward_bytes(self, size: int, count: int = 1) -> int:
+        """Peak bytes to plan for `count` square inputs of `size` pixels in a forward. A shared `batcher` may stack
+        them with the inputs of other requests, up to its `max_batch_size`, so each input is planned at the most
+        that any such stack costs per input: the stack then never costs more than its requests planned together."""
+        estimate = self.memory_estimator.estimate
+        if self.batcher is None:
+            return estimate(size, count)
+        per_input = max(estimate(size, n) / n for n in range(1, self.batcher.max_batch_size + 1))
+        return math.ceil(count * per_input)
+
+    def _planned_bytes(self, render_factor: int, tile_size: Optional[int], tile_batch_size: int) -> int:
+        "Bytes to reserve for a plan of `_plan`: its largest forward, as the image pass and the tiles run in turn."
+        if self.memory_estimator is None:
+            return 0
+        planned = self._forward_bytes(render_factor * self.render_base)
+        if tile_size is not None:
+            planned = max(planned, self._forward_bytes(tile_size, tile_batch_size))
+        return planned
+
+    def estimate_latency(self, render_factor: int, size: Tuple[int, int]) -> Optional[float]:
+        "Predicted seconds to colorize an image of `size` (w, h) at `render_factor`, or None until measured."
+        render_sz = render_factor * self.render_base
+        seconds = self.latency.forward_time(render_sz)
+        if seconds is None:
+            return None
+        if self.tile_size is not None:
+            work = self._work_size(size, render_sz, render_sz * self.tile_scale)
+            if work is not None:
+                seconds += self.latency.pixel_time('tiles', work[0] * work[1]) or 0.0
+        return seconds + (self.latency.pixel_time('post_process', size[0] * size[1]) or 0.0)
+
+    def choose_render_factor(
+        self, budget: float, size: Tuple[int, int], max_render_factor: int = 45
+    ) -> Optional[int]:
+        """The largest render_factor up to `max_render_factor` expected to colorize an image of `size` (w, h)
+        within `budget` seconds on this host, `min_render_factor` if none is, or None until measured."""
+        for render_factor in range(max_render_factor, self.min_render_factor - 1, -1):
+            seconds = self.estimate_latency(render_factor, size)
+            if seconds is None:
+                return None
+            if seconds <= budget:
+                return render_factor
+        return self.min_render_factor
+
+    def measure_latency(self, render_factors: Collection[int], size: Tuple[int, int] = (1024, 768)):
+        "Colorize a blank image of `size` twice at each of `render_factors`, so estimates start from measurements."
+        image = PilImage.new('L', size, 128)
+        for render_factor in render_factors:
+            for _ in range(2):
+                self.filter(image, image, render_factor).close()
+
+    def _release_memory(self):
+        if self.device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+    def _get_model_ready_image(self, orig: PilImage, sz: int) -> PilImage:
+        # The model only sees luminance, so the image is reduced to it before the one resize
+        gray = orig if orig.mode == 'L' else orig.convert('L')
+        return self._scale_to_square(gray, sz)
+
+    # This takes advantage of the fact that human eyes are much less sensitive to
+    # imperfections in chrominance compared to luminance.  This means we can
+    # save a lot on memory and processing in the model, yet get a great high
+    # resolution result at the end.  This is primarily intended just for
+    # inference
+    def _tiled_process(
+        self, orig: PilImage, model_image: PilImage, render_sz: int, work_sz: int, tile_size: int, tile_batch_size: int
+    ) -> Optional[np.ndarray]:
+        """Colorize `orig` at `work_sz` (on its shorter side, never above its own size) in overlapping
+        `tile_size` tiles, and return the feather-blended result as an HxWx3 YUV uint8 array.
+        The tiles only add detail: their low frequency chroma is replaced by that of `model_image`,
+        the whole image pass, so colors stay consistent across tiles that each see only part of the scene.
+        The model's memory is bounded by the tile size and batch; the blend buffers by the working size.
+        Returns None if the working size adds nothing over `render_sz`."""
+        work = self._work_size(orig.size, render_sz, work_sz)
+        if work is None:
+            return None
+        w, h = work
+        gray = orig if orig.mode == 'L' else orig.convert('L')
+        luma = np.asarray(gray.resize((w, h), resample=PIL.Image.BILINEAR))
+        # The whole image chroma, stretched back from the render square to the working size
+        context = cv2.resize(self._chroma(model_image), (w, h), interpolation=cv2.INTER_LINEAR).astype(np.float32)
+        boxes = [
+            (x, y, min(tile_size, w), min(tile_size, h))
+            for y in _tile_starts(h, tile_size, self.tile_overlap)
+            for x in _tile_starts(w, tile_size, self.tile_overlap)
+        ]
+        blend = np.zeros((h, w, 3), dtype=np.float32)
+        weights = np.zeros((h, w), dtype=np.float32)
+        tile_sz = (tile_size, tile_size)
+        with torch.inference_mode():
+            for i in range(0, len(boxes), tile_batch_size):
+                batch = boxes[i : i + tile_batch_size]
+                # Tiles narrower than tile_size (on small images) are stretched to the square
+                tiles = [cv2.resize(luma[y : y + th, x : x + tw], tile_sz) for x, y, tw, th in batch]
+                for (x, y, tw, th), out in zip(batch, self._model_predict(tiles)):
+                    yuv = cv2.cvtColor(cv2.resize(out, (tw, th)), cv2.COLOR_RGB2YUV).astype(np.float32)
+                    # Low frequencies at the resolution of the whole image pass
+                    low_sz = (max(1, round(tw * render_sz / w)), max(1, round(th * render_sz / h)))
+                    low = cv2.resize(cv2.resize(yuv[:, :, 1:], low_sz, interpolation=cv2.INTER_AREA), (tw, th))
+                    yuv[:, :, 1:] += context[y : y + th, x : x + tw] - low
+                    window = _feather_window(th, tw, self.tile_overlap)
+                    blend[y : y + th, x : x + tw] += yuv * window[:, :, None]
+                    weights[y : y + th, x : x + tw] += window
+        blend /= weights[:, :, None]
+        np.clip(blend + 0.5, 0, 255, out=blend)
+        return blend.astype(np.uint8)
+
+    def _work_size(self, size: Tuple[int, int], render_sz: int, work_sz: int) -> Optional[Tuple[int, int]]:
+        "The (w, h) an image of `size` is tiled at for `work_sz`, or None if that adds nothing over `render_sz`."
+        scale = min(1.0, work_sz / min(size))
+        w, h = round(size[0] * scale), round(size[1] * scale)
+        if w <= render_sz and h <= render_sz:
+            return None
+        return w, h
+
+    def _chroma(self, model_image: PilImage) -> np.ndarray:
+        "The two chroma planes of `model_image` as an hxwx2 uint8 array, converted at model resolution."
+        return np.ascontiguousarray(cv2.cvtColor(np.asarray(model_image), cv2.COLOR_RGB2YUV)[:, :, 1:])
+
+    def _strips(self, h: int) -> Iterator[Tuple[int, int]]:
+        for top in range(0, h, self.strip_rows):
+            yield top, min(top + self.strip_rows, h)
+
+    def _upsample(self, colors: np.ndarray, size: Tuple[int, int], stamp: Callable = None) -> PilImage:
+        "`colors` (hxwx3 RGB uint8) bilinearly resized to `size`, strip by strip."
+        w, h = size
+        colors = _shrink(colors, size)
+        final = PilImage.new('RGB', size)
+        for top, bottom in self._strips(h):
+            strip = _resize_rows(colors, (w, h), top, bottom)
+            if stamp is not None:
+                stamp(strip, top)
+            _paste_rows(final, strip, top)
+        return final
 
     # This takes advantage of the fact that human eyes are much less sensitive to
     # imperfections in chrominance compared to luminance.  This means we can
     # save a lot on memory and processing in the model, yet get a great high
     # resolution result at the end.  This is primarily intended just for
     # inference
-    def _post_process(self, raw_color: PilImage, orig: PilImage) -> PilImage:
-        color_np = np.asarray(raw_color)
-        orig_np = np.asarray(orig)
-        color_yuv = cv2.cvtColor(color_np, cv2.COLOR_RGB2YUV)
-        # do a black and white transform first to get better luminance values
-        orig_yuv = cv2.cvtColor(orig_np, cv2.COLOR_RGB2YUV)
-        hires = np.copy(orig_yuv)
-        hires[:, :, 1:3] = color_yuv[:, :, 1:3]
-        final = cv2.cvtColor(hires, cv2.COLOR_YUV2RGB)
-        final = PilImage.fromarray(final)
+    def _post_process(self, chroma: np.ndarray, orig: PilImage, stamp: Callable = None) -> PilImage:
+        """Merge `chroma` (hxwx2 uint8), upsampled on its own, with the full resolution luminance of `orig`.
+        Only `strip_rows` rows of the original and of the upsampled chroma are held at a time."""
+        w, h = orig.size
+        chroma = np.ascontiguousarray(_shrink(chroma, orig.size))
+        if self.guided_upsampling:
+            small = np.asarray(orig.resize(chroma.shape[1::-1], resample=PIL.Image.BOX))
+            small_luma = small if orig.mode == 'L' else cv2.cvtColor(small, cv2.COLOR_RGB2YUV)[:, :, 0]
+            coefficients = _guided_coefficients(small_luma, chroma, self.guided_radius, self.guided_eps)
+        final = PilImage.new('RGB', orig.size)
+        for top, bottom in self._strips(h):
+            rows = np.asarray(orig.crop((0, top, w, bottom)))
+            if orig.mode == 'L':
+                # Decoded straight to luminance, which is the Y channel
+                luma = rows
+            else:
+                # do a black and white transform first to get better luminance values
+                luma = cv2.cvtColor(rows, cv2.COLOR_RGB2YUV)[:, :, 0]
+            if self.guided_upsampling:
+                u, v = [self._guided_rows(a, b, luma, (w, h), top, bottom) for a, b in coefficients]
+            else:
+                rows = _resize_rows(chroma, (w, h), top, bottom)
+                u, v = rows[:, :, 0], rows[:, :, 1]
+            strip = cv2.merge((luma, u, v))
+            cv2.cvtColor(strip, cv2.COLOR_YUV2RGB, strip)
+            if stamp is not None:
+                stamp(strip, top)
+            _paste_rows(final, strip, top)
         return final
 
+    def _guided_rows(
+        self, a: np.ndarray, b: np.ndarray, luma: np.ndarray, size: Tuple[int, int], top: int, bottom: int
+    ) -> np.ndarray:
+        plane = _resize_rows(a, size, top, bottom)
+        np.multiply(plane, luma, out=plane)
+        plane += _resize_rows(b, size, top, bottom)
+        np.clip(plane, 0, 255, out=plane)
+        return plane.astype(np.uint8)
+
 
 class MasterFilter(BaseFilter):
     def __init__(self, filters: List[IFilter], render_factor: int):
@@ -116,9 +574,15 @@ class MasterFilter(BaseFilter):
         self.render_factor = render_factor
 
     def filter(
-        self, orig_image: PilImage, filtered_image: PilImage, render_factor: int = None, post_process: bool = True) -> PilImage:
+        self,
+        orig_image: PilImage,
+        filtered_image: PilImage,
+        render_factor: int = None,
+        post_process: bool = True,
+        stamp: Callable[[np.ndarray, int], None] = None,
+    ) -> PilImage:
         render_factor = self.render_factor if render_factor is None else render_factor
         for filter in self.filters:
-            filtered_image = filter.filter(orig_image, filtered_image, render_factor, post_process)
+            filtered_image = filter.filter(orig_image, filtered_image, render_factor, post_process, stamp=stamp)
 
         return filtered_image
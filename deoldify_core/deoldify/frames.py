@@ -0,0 +1,226 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from fastai.torch_core import *
+from PIL import Image as PilImage
+from typing import Iterable
+from .cache import ResultCache
+from .filters import ColorizerFilter
+from .memory import is_out_of_memory, memory_reservations
+import queue
+import threading
+import logging
+
+__all__ = ['FramePipeline']
+
+
+class FramePipeline:
+    """Colorizes a sequence of frames sharing a size with a `ColorizerFilter`, in three overlapping stages:
+    frames are read and scaled to the render size on a prefetch thread, `batch_size` at a time, up to
+    `prefetch` batches ahead; the model runs each batch as one forward; and post-processing (with the
+    watermark) runs on a pool of `workers` threads while the model moves on to the next batch.
+    Filters with tiles colorize frame by frame, as tiles are batched within a frame already.
+    With a `ResultCache`, frames are looked up on the prefetch thread and only the misses go through the model.
+    Unlike `ModelImageVisualizer.colorize`, a frame being colorized by another request at the same time
+    is not waited for, but colorized again."""
+
+    def __init__(self, filtr: ColorizerFilter, batch_size: int = 4, workers: int = 2, prefetch: int = 2):
+        if batch_size < 1 or workers < 1 or prefetch < 1:
+            raise ValueError('batch_size, workers and prefetch must be at least 1')
+        self.filter = filtr
+        self.batch_size = batch_size
+        self.workers = workers
+        self.prefetch = prefetch
+        # Lowered for the rest of a `colorize` call once a batch runs out of memory
+        self._batch_limit = batch_size
+
+    def colorize(
+        self,
+        frames: Iterable[PilImage.Image],
+        render_factor: int,
+        post_process: bool = True,
+        stamp: Callable[[np.ndarray, int], None] = None,
+        cache: ResultCache = None,
+        key: Callable[[PilImage.Image], str] = None,
+    ) -> Iterator[PilImage.Image]:
+        """The colorized `frames` (luminance images, all the same size), in order, as `ColorizerFilter.filter`
+        returns them. `frames` is iterated on the prefetch thread, and closed once done if it has a `close`.
+        With `cache`, results are read from and stored under `key(frame)`, except those degraded to fit in memory."""
+        render_sz = render_factor * self.filter.render_base
+        self._batch_limit = self.batch_size
+        batches = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        reader = threading.Thread(
+            target=self._prefetch,
+            args=(frames, render_sz, cache, key, batches, stop),
+            name='deoldify-frames',
+            daemon=True,
+        )
+        reader.start()
+        try:
+            with ThreadPoolExecutor(self.workers, thread_name_prefix='deoldify-postprocess') as pool:
+                pending = deque()
+                while True:
+                    batch = batches.get()
+                    if batch is None:
+                        break
+                    if isinstance(batch, BaseException):
+                        raise batch
+                    pending.extend(self._colorize_batch(batch, render_factor, post_process, stamp, cache, pool))
+                    # The batch just submitted is post-processed during the next forward; the ones before are done
+                    while len(pending) > len(batch):
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+        finally:
+            stop.set()
+            # Unblock the reader if it is waiting for room in the queue
+            while True:
+                try:
+                    batches.get_nowait()
+                except queue.Empty:
+                    break
+            reader.join()
+
+    def _prefetch(
+        self,
+        frames: Iterable[PilImage.Image],
+        render_sz: int,
+        cache: Optional[ResultCache],
+        key: Optional[Callable],
+        batches: queue.Queue,
+        stop: threading.Event,
+    ):
+        """Read `frames` into batches of (frame, model input, cache key) triples, then None, or the error that
+        stopped it. Frames found in the cache come as (result, None, key), and don't count towards `batch_size`."""
+        frames = iter(frames)
+        try:
+            batch, misses = [], 0
+            for frame in frames:
+                if stop.is_set():
+                    return
+                cache_key = None if cache is None else key(frame)
+                cached = None if cache is None else cache.get(cache_key)
+                if cached is not None:
+                    batch.append((cached, None, cache_key))
+                else:
+                    # Scaled here, off the model's thread: this is the preprocessing `_model_process` does
+                    batch.append((frame, np.array(self.filter._get_model_ready_image(frame, render_sz)), cache_key))
+                    misses += 1
+                # A run of cached frames is passed on too, rather than held until enough misses fill a batch
+                if misses == self.batch_size or len(batch) - misses == self.batch_size:
+                    if not self._put(batches, batch, stop):
+                        return
+                    batch, misses = [], 0
+            if batch and not self._put(batches, batch, stop):
+                return
+            self._put(batches, None, stop)
+        except Exception as e:
+            self._put(batches, e, stop)
+        finally:
+            if hasattr(frames, 'close'):
+                frames.close()
+
+    def _put(self, batches: queue.Queue, item: Any, stop: threading.Event) -> bool:
+        "Queue `item` once there is room, unless stopped first."
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _colorize_batch(
+        self,
+        batch: List[Tuple[PilImage.Image, Optional[np.ndarray], Optional[str]]],
+        render_factor: int,
+        post_process: bool,
+        stamp: Optional[Callable],
+        cache: Optional[ResultCache],
+        pool: ThreadPoolExecutor,
+    ) -> List[Future]:
+        "Run the model over the frames of `batch` not in the cache, and submit each one's post-processing to `pool`."
+        filtr = self.filter
+        inputs = [x for _, x, _ in batch if x is not None]
+        predicted = None if filtr.tile_size is not None or not inputs else self._predict(inputs, render_factor)
+        colors = iter(predicted or [])
+        futures = []
+        for frame, x, cache_key in batch:
+            if x is not None and predicted is not None:
+                futures.append(
+                    pool.submit(self._finish, frame, next(colors), render_factor, post_process, stamp, cache, cache_key)
+                )
+                continue
+            future = Future()
+            if x is None:
+                future.set_result(frame)
+            else:
+                # Through `filter`, which tiles the frames or lowers their render_factor until they fit in memory
+                result = filtr.filter(frame, frame, render_factor, post_process, stamp=stamp)
+                future.set_result(self._store(result, cache, cache_key))
+            futures.append(future)
+        return futures
+
+    def _predict(self, inputs: List[np.ndarray], render_factor: int) -> Optional[List[np.ndarray]]:
+        """The model's colors for `inputs`, in forwards of as many as fit in memory, or None if not even one
+        does at `render_factor`. The memory table, if any, sizes the forwards; running out of memory halves them."""
+        filtr = self.filter
+        render_sz = render_factor * filtr.render_base
+        # Sized and reserved in one step, like the plans of `ColorizerFilter.filter`
+        with memory_reservations.lock:
+            batch_size = min(self._batch_limit, self._fitting_batch_size(render_sz))
+            has_table = filtr.memory_estimator is not None and batch_size > 0
+            reserved = filtr._forward_bytes(render_sz, batch_size) if has_table else 0
+            memory_reservations.add(filtr.device, reserved)
+        outputs = []
+        try:
+            while len(outputs) < len(inputs) and batch_size > 0:
+                chunk = inputs[len(outputs) : len(outputs) + batch_size]
+                try:
+                    with torch.inference_mode():
+                        outputs.extend(filtr._model_predict(chunk))
+                except (RuntimeError, MemoryError) as err:
+                    if not is_out_of_memory(err):
+                        raise
+                    logging.warning('Frame batch of {0} ran out of memory, halving it'.format(len(chunk)))
+                    self._batch_limit = batch_size = len(chunk) // 2
+                    filtr._release_memory()
+        finally:
+            memory_reservations.release(filtr.device, reserved)
+        if len(outputs) < len(inputs):
+            return None
+        # Not recorded in the filter's latency model: per frame, a batch is faster than the single images it estimates
+        return outputs
+
+    def _fitting_batch_size(self, render_sz: int) -> int:
+        "Up to `batch_size` frames that `memory_estimator` expects to fit in one forward now; `batch_size` without one."
+        filtr = self.filter
+        budget = None if filtr.memory_estimator is None else filtr.memory_estimator.budget(filtr.device)
+        if budget is None:
+            return self.batch_size
+        return next((n for n in range(self.batch_size, 0, -1) if filtr._forward_bytes(render_sz, n) <= budget), 0)
+
+    def _finish(
+        self,
+        frame: PilImage.Image,
+        colors: np.ndarray,
+        render_factor: int,
+        post_process: bool,
+        stamp: Optional[Callable],
+        cache: Optional[ResultCache],
+        cache_key: Optional[str],
+    ) -> PilImage.Image:
+        result = self.filter._finish(frame, PilImage.fromarray(colors), None, post_process, stamp)
+        result.info['render_factor'] = render_factor
+        result.info['degradations'] = []
+        return self._store(result, cache, cache_key)
+
+    def _store(self, image: PilImage.Image, cache: Optional[ResultCache], cache_key: Optional[str]) -> PilImage.Image:
+        "Keep `image` in `cache`, unless it was degraded to fit in memory, as `ModelImageVisualizer.colorize` does."
+        if cache is None or image.info.get('degradations'):
+            return image
+        try:
+            cache.put(cache_key, image)
+        except OSError as e:
+            logging.warning('Could not write colorization result to cache: {0}'.format(e))
+        return image
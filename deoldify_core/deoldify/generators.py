@@ -5,18 +5,57 @@ from fastai.torch_core import SplitFuncOrIdxList, apply_init, to_device
 from fastai.vision import *
 from fastai.vision.learner import cnn_config, create_body
 from torch import nn
-from .unet import DynamicUnetWide, DynamicUnetDeep
+from .unet import DynamicUnetWide, DynamicUnetDeep, encoder_sizes
 from .dataset import *
 
-# Weights are implicitly read from ./models/ folder
+def _load_inference_weights(
+    model: nn.Module, root_folder: Path, weights_name: str, device: torch.device = None
+) -> nn.Module:
+    "Load `weights_name`, saved by `Learner.save` with or without optimizer state, into `model` for inference."
+    device = ifnone(device, defaults.device)
+    state = torch.load(Path(root_folder) / 'models' / f'{weights_name}.pth', map_location=device)
+    if set(state.keys()) == {'model', 'opt'}:
+        state = state['model']
+    model.load_state_dict(state)
+    return model.to(device).eval()
+
+
+def build_unet_wide(nf_factor: int = 2, arch=models.resnet101) -> DynamicUnetWide:
+    "Untrained `DynamicUnetWide` with the generator's layout, for loading weights into."
+    body = create_body(arch, pretrained=False)
+    return DynamicUnetWide(
+        body,
+        n_classes=3,
+        blur=True,
+        norm_type=NormType.Spectral,
+        self_attention=True,
+        y_range=(-3.0, 3.0),
+        nf_factor=nf_factor,
+        encoder_sizes=encoder_sizes(arch, body),
+    )
+
+
+# Weights are read from the models/ folder under `root_folder`
+def gen_model_wide(
+    root_folder: Path, weights_name: str, nf_factor: int = 2, arch=models.resnet101, device: torch.device = None
+) -> nn.Module:
+    "Bare `DynamicUnetWide` generator, built without a `DataBunch`, `Learner` or pretrained download."
+    model = build_unet_wide(arch=arch, nf_factor=nf_factor)
+    return _load_inference_weights(model, root_folder, weights_name, device)
+
+
+# Weights are read from the models/ folder under `root_folder`
 def gen_inference_wide(
-    root_folder: Path, weights_name: str, nf_factor: int = 2, arch=models.resnet101) -> Learner:
+    root_folder: Path, weights_name: str, nf_factor: int = 2, arch=models.resnet101, device: torch.device = None
+) -> Learner:
     data = get_dummy_databunch()
     learn = gen_learner_wide(
         data=data, gen_loss=F.l1_loss, nf_factor=nf_factor, arch=arch
     )
     learn.path = root_folder
-    learn.load(weights_name)
+    learn.load(weights_name, device=device)
+    if device is not None:
+        learn.model.to(device)
     learn.model.eval()
     return learn
 
@@ -68,6 +107,7 @@ def unet_learner_wide(
             last_cross=last_cross,
             bottle=bottle,
             nf_factor=nf_factor,
+            encoder_sizes=encoder_sizes(arch, body),
         ),
         data.device,
     )
@@ -81,15 +121,42 @@ def unet_learner_wide(
 
 # ----------------------------------------------------------------------
 
-# Weights are implicitly read from ./models/ folder
+def build_unet_deep(arch=models.resnet34, nf_factor: float = 1.5) -> DynamicUnetDeep:
+    "Untrained `DynamicUnetDeep` with the generator's layout, for loading weights into."
+    body = create_body(arch, pretrained=False)
+    return DynamicUnetDeep(
+        body,
+        n_classes=3,
+        blur=True,
+        norm_type=NormType.Spectral,
+        self_attention=True,
+        y_range=(-3.0, 3.0),
+        nf_factor=nf_factor,
+        encoder_sizes=encoder_sizes(arch, body),
+    )
+
+
+# Weights are read from the models/ folder under `root_folder`
+def gen_model_deep(
+    root_folder: Path, weights_name: str, arch=models.resnet34, nf_factor: float = 1.5, device: torch.device = None
+) -> nn.Module:
+    "Bare `DynamicUnetDeep` generator, built without a `DataBunch`, `Learner` or pretrained download."
+    model = build_unet_deep(arch=arch, nf_factor=nf_factor)
+    return _load_inference_weights(model, root_folder, weights_name, device)
+
+
+# Weights are read from the models/ folder under `root_folder`
 def gen_inference_deep(
-    root_folder: Path, weights_name: str, arch=models.resnet34, nf_factor: float = 1.5) -> Learner:
+    root_folder: Path, weights_name: str, arch=models.resnet34, nf_factor: float = 1.5, device: torch.device = None
+) -> Learner:
     data = get_dummy_databunch()
     learn = gen_learner_deep(
         data=data, gen_loss=F.l1_loss, arch=arch, nf_factor=nf_factor
     )
     learn.path = root_folder
-    learn.load(weights_name)
+    learn.load(weights_name, device=device)
+    if device is not None:
+        learn.model.to(device)
     learn.model.eval()
     return learn
 
@@ -141,6 +208,7 @@ def unet_learner_deep(
             last_cross=last_cross,
             bottle=bottle,
             nf_factor=nf_factor,
+            encoder_sizes=encoder_sizes(arch, body),
         ),
         data.device,
     )
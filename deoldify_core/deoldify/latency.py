@@ -0,0 +1,60 @@
+from fastai.torch_core import *
+import bisect
+import threading
+
+__all__ = ['LatencyModel']
+
+
+class LatencyModel:
+    """Running estimates of how long colorizing takes on this host, from the timings recorded as it runs:
+    the model pass by render size, and other stages (tiles, post-processing) per pixel they cover.
+    Each is an exponential moving average with weight `smoothing` on the newest timing, so estimates
+    follow the load the host is under."""
+
+    def __init__(self, smoothing: float = 0.3):
+        self.smoothing = smoothing
+        self._forward = {}
+        self._per_pixel = {}
+        self._lock = threading.Lock()
+
+    def _update(self, table: dict, key: Any, value: float):
+        old = table.get(key)
+        table[key] = value if old is None else old + self.smoothing * (value - old)
+
+    def record_forward(self, size: int, seconds: float):
+        "Record a model pass on a square input of `size` pixels, preprocessing included."
+        with self._lock:
+            self._update(self._forward, size, seconds)
+
+    def record_pixels(self, stage: str, pixels: int, seconds: float):
+        if pixels > 0:
+            with self._lock:
+                self._update(self._per_pixel, stage, seconds / pixels)
+
+    def forward_time(self, size: int) -> Optional[float]:
+        """Seconds of a model pass at `size`, None until one was recorded. The cost grows with the pixels,
+        so this interpolates linearly in size squared between the recorded sizes, and extrapolates along
+        the nearest two (or in proportion, from a single one)."""
+        with self._lock:
+            points = sorted((s * s, t) for s, t in self._forward.items())
+        if not points:
+            return None
+        pixels = size * size
+        if len(points) == 1:
+            return points[0][1] * pixels / points[0][0]
+        i = min(max(bisect.bisect_left([p for p, _ in points], pixels), 1), len(points) - 1)
+        (p0, t0), (p1, t1) = points[i - 1], points[i]
+        return max(0.0, t0 + (t1 - t0) * (pixels - p0) / (p1 - p0))
+
+    def pixel_time(self, stage: str, pixels: int) -> Optional[float]:
+        "Seconds `stage` takes over `pixels`, None until it was recorded."
+        with self._lock:
+            per_pixel = self._per_pixel.get(stage)
+        return None if per_pixel is None else per_pixel * pixels
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'forward_seconds': {size: self._forward[size] for size in sorted(self._forward)},
+                'seconds_per_megapixel': {stage: t * 1e6 for stage, t in self._per_pixel.items()},
+            }
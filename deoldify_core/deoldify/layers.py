@@ -5,6 +5,42 @@ from fastai.torch_core import *
 # The code below is meant to be merged into fastaiv1 ideally
 
 
+@torch.jit.script
+def _chunked_attention(f: Tensor, g: Tensor, h: Tensor, chunk_size: int) -> Tensor:
+    "`SelfAttention`'s `bmm(h, softmax(bmm(f, g)))`, `chunk_size` columns of the attention matrix at a time."
+    n = g.size(2)
+    o = torch.empty_like(h)
+    # The softmax runs over the input positions (dim 1), so every output column is independent.
+    for start in range(0, n, chunk_size):
+        end = min(start + chunk_size, n)
+        beta = F.softmax(torch.bmm(f, g[:, :, start:end]), dim=1)
+        o[:, :, start:end] = torch.bmm(h, beta)
+    return o
+
+
+class ChunkedSelfAttention(SelfAttention):
+    """`SelfAttention` that builds the attention matrix `chunk_size` output positions at a time, so memory grows
+    linearly with image area. The chunk loop is a TorchScript function, so traced models (see `CompiledColorizer`)
+    keep it, with the trip count taken from the input size rather than baked in at the traced size.
+    ONNX exports (see `export_onnx`) build the full matrix instead, as one MatMul whose memory grows quadratically."""
+    # Set to None to always materialize the full (HW)x(HW) matrix, as fastai does.
+    chunk_size = 1024
+
+    def forward(self, x):
+        size = x.size()
+        n = size[2:].numel()
+        if self.chunk_size is None or torch.onnx.is_in_onnx_export():
+            return super().forward(x)
+        # A trace records whichever branch its example input takes, so it always takes the chunked one
+        if n <= self.chunk_size and not torch.jit.is_tracing():
+            return super().forward(x)
+        x = x.view(*size[:2], -1)
+        f, g, h = self.query(x), self.key(x), self.value(x)
+        o = _chunked_attention(f.permute(0, 2, 1).contiguous(), g, h, self.chunk_size)
+        o = self.gamma * o + x
+        return o.view(*size).contiguous()
+
+
 def custom_conv_layer(
     ni: int,
     nf: int,
@@ -42,5 +78,5 @@ def custom_conv_layer(
     if bn:
         layers.append((nn.BatchNorm1d if is_1d else nn.BatchNorm2d)(nf))
     if self_attention:
-        layers.append(SelfAttention(nf))
+        layers.append(ChunkedSelfAttention(nf))
     return nn.Sequential(*layers)
@@ -0,0 +1,185 @@
+from fastai.torch_core import *
+import bisect
+import ctypes
+import json
+import logging
+import threading
+
+__all__ = [
+    'MemoryEstimator',
+    'MemoryReservations',
+    'available_memory',
+    'calibrate_memory',
+    'is_out_of_memory',
+    'memory_reservations',
+    'memory_table_path',
+]
+
+# Share of the available memory a forward may plan to use. The rest covers whatever else
+# the process allocates meanwhile (other requests, post-processing, the allocator's slack).
+_HEADROOM = 0.9
+
+
+def memory_table_path(root_folder: Path, model_id: str, device_type: str) -> Path:
+    return Path(root_folder) / 'models' / 'memory' / f'{model_id}-{device_type}.json'
+
+
+def is_out_of_memory(err: BaseException) -> bool:
+    "Whether `err` is the model running out of memory (CUDA or CPU allocators) rather than a bug."
+    return isinstance(err, MemoryError) or (isinstance(err, RuntimeError) and 'memory' in str(err))
+
+
+def _cgroup_available() -> Optional[int]:
+    # Containers see the host's MemAvailable, but are killed at their own cgroup (v2) limit
+    try:
+        limit = Path('/sys/fs/cgroup/memory.max').read_text().strip()
+        if limit == 'max':
+            return None
+        return int(limit) - int(Path('/sys/fs/cgroup/memory.current').read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def available_memory(device: torch.device) -> Optional[int]:
+    "Bytes a forward on `device` could allocate right now, or None where that can't be told."
+    device = torch.device(device)
+    if device.type == 'cuda':
+        free, _ = torch.cuda.mem_get_info(device)
+        # Blocks cached by torch's allocator are free to reuse as well
+        return free + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+    if device.type != 'cpu':
+        return None
+    try:
+        with open('/proc/meminfo') as f:
+            available = next(int(line.split()[1]) * 1024 for line in f if line.startswith('MemAvailable:'))
+    except (OSError, StopIteration):
+        return None
+    cgroup = _cgroup_available()
+    return available if cgroup is None else min(available, cgroup)
+
+
+class MemoryReservations:
+    """Bytes set aside per device for the forwards of requests in flight. Requests plan against the memory
+    available less what the others reserved, and take `lock` to plan and reserve in one step, so that two
+    requests can't both plan for the same free memory. A forward that has started allocating is counted
+    both in the available memory and in its reservation, which errs on the side of degrading."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._reserved = collections.Counter()
+
+    def reserved(self, device: torch.device) -> int:
+        with self.lock:
+            return self._reserved[str(torch.device(device))]
+
+    def add(self, device: torch.device, nbytes: int):
+        with self.lock:
+            self._reserved[str(torch.device(device))] += nbytes
+
+    def release(self, device: torch.device, nbytes: int):
+        with self.lock:
+            self._reserved[str(torch.device(device))] -= nbytes
+
+
+# Shared by every colorizer in the process, as they share its devices
+memory_reservations = MemoryReservations()
+
+
+class MemoryEstimator:
+    """Predicts the peak memory of a forward from a calibration table of (pixels, bytes) points, where
+    pixels is batch size * render size squared and bytes is the peak allocated on top of the loaded model.
+    Activations grow with the pixels, so it interpolates linearly between the points and extrapolates
+    along the nearest two."""
+
+    def __init__(self, points: Collection[Tuple[int, int]], limit: Optional[int] = None):
+        self.points = sorted((int(pixels), int(nbytes)) for pixels, nbytes in points)
+        if len(self.points) < 2:
+            raise ValueError('A memory table needs at least two calibration points')
+        # Caps the budget below the available memory, e.g. for workers sharing a host
+        self.limit = limit
+
+    def estimate(self, size: int, batch_size: int = 1) -> int:
+        "Peak bytes of a forward of `batch_size` square inputs of `size` pixels."
+        pixels = batch_size * size * size
+        i = min(max(bisect.bisect_left([p for p, _ in self.points], pixels), 1), len(self.points) - 1)
+        (p0, b0), (p1, b1) = self.points[i - 1], self.points[i]
+        return max(0, round(b0 + (b1 - b0) * (pixels - p0) / (p1 - p0)))
+
+    def budget(self, device: torch.device) -> Optional[int]:
+        "Bytes a forward may plan to use on `device` now, less those reserved by others in flight, or None if unknown."
+        available = available_memory(device)
+        if available is not None:
+            available = max(0, int(available * _HEADROOM) - memory_reservations.reserved(device))
+        if self.limit is None:
+            return available
+        return self.limit if available is None else min(available, self.limit)
+
+    def fits(self, size: int, device: torch.device, batch_size: int = 1) -> bool:
+        budget = self.budget(device)
+        return budget is None or self.estimate(size, batch_size) <= budget
+
+    def to_dict(self) -> dict:
+        return {'points': self.points}
+
+    def save(self, path: Path, **info):
+        "Write the table to `path` as JSON, with `info` (model, device, versions) kept alongside for reference."
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps({**info, **self.to_dict()}, indent=2))
+
+    @classmethod
+    def load(cls, path: Path, limit: Optional[int] = None) -> Optional['MemoryEstimator']:
+        "The table saved at `path`, or None if there is none (the pre-flight check is then skipped)."
+        path = Path(path)
+        if not path.exists():
+            return None
+        try:
+            return cls(json.loads(path.read_text())['points'], limit=limit)
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning('Ignoring unreadable memory table {0}: {1}'.format(path, e))
+            return None
+
+
+def _peak_memory(device: torch.device) -> int:
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device)
+    with open('/proc/self/status') as f:
+        return next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmHWM:'))
+
+
+def _reset_peak_memory(device: torch.device) -> int:
+    "Restart peak tracking and return the memory in use now."
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+        return torch.cuda.memory_allocated(device)
+    # Linux only: hand freed heap back to the OS so that reusing it counts, then reset the peak RSS
+    ctypes.CDLL('libc.so.6').malloc_trim(0)
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    return _peak_memory(device)
+
+
+def calibrate_memory(filtr, sizes: Collection[int], batch_size: int = 1) -> MemoryEstimator:
+    """Measure the peak memory of `filtr` (a `ColorizerFilter`) colorizing batches of `batch_size` gray
+    squares of each of `sizes`, after a warm-up forward each. The first size to run out of memory ends
+    the calibration, and larger ones are extrapolated. CPU peaks are measured on Linux only."""
+    device = filtr.device
+    if device.type not in ('cpu', 'cuda'):
+        raise ValueError('Memory can only be calibrated on CPU or CUDA devices, got {0}'.format(device))
+    points = []
+    for size in sorted(sizes):
+        images = [np.zeros((size, size), dtype=np.uint8)] * batch_size
+        try:
+            with torch.inference_mode():
+                filtr._model_predict(images)
+                base = _reset_peak_memory(device)
+                filtr._model_predict(images)
+        except (RuntimeError, MemoryError) as err:
+            if not is_out_of_memory(err):
+                raise
+            logging.warning('Calibration ran out of memory at {0}x{0}'.format(size))
+            break
+        points.append((batch_size * size * size, _peak_memory(device) - base))
+    return MemoryEstimator(points)
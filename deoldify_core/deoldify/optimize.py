@@ -0,0 +1,152 @@
+from collections import OrderedDict
+from fastai.torch_core import *
+from fastai.layers import SigmoidRange
+from fastai.vision.data import imagenet_stats
+from torch.nn.utils import remove_spectral_norm, remove_weight_norm
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.nn.utils.spectral_norm import SpectralNorm, SpectralNormLoadStateDictPreHook
+from torch.nn.utils.weight_norm import WeightNorm
+from torchvision.models.resnet import BasicBlock, Bottleneck
+import logging
+
+__all__ = ['OptimizedUnet', 'optimize_for_inference']
+
+
+class _ChannelAffine(nn.Module):
+    "Per-channel `x * scale + shift`, optionally applied to `sigmoid(x)`."
+
+    def __init__(self, scale: Tensor, shift: Tensor, sigmoid: bool = False):
+        super().__init__()
+        self.register_buffer('scale', scale.view(1, -1, 1, 1))
+        self.register_buffer('shift', shift.view(1, -1, 1, 1))
+        self.sigmoid = sigmoid
+
+    def forward(self, x: Tensor) -> Tensor:
+        if self.sigmoid:
+            x = torch.sigmoid(x)
+        return torch.addcmul(self.shift, x, self.scale)
+
+
+class _LuminanceStem(nn.Module):
+    "`conv` applied to a normalized gray image repeated over 3 channels, computed from the single gray channel."
+
+    def __init__(self, conv: nn.Conv2d, scale: Tensor, shift: Tensor, max_sizes: int = 4):
+        super().__init__()
+        if conv.in_channels != 3 or conv.groups != 1 or conv.padding_mode != 'zeros':
+            raise ValueError('Expected a plain 3 channel first conv, got {0}'.format(conv))
+        weight = conv.weight.detach()
+        self.conv = nn.Conv2d(
+            1, conv.out_channels, conv.kernel_size, conv.stride, conv.padding, conv.dilation, bias=False
+        )
+        self.conv.weight = nn.Parameter((weight * scale.view(1, -1, 1, 1)).sum(dim=1, keepdim=True))
+        self.register_buffer('shift_weight', (weight * shift.view(1, -1, 1, 1)).sum(dim=1, keepdim=True))
+        self.register_buffer('bias', conv.bias.detach() if conv.bias is not None else weight.new_zeros(conv.out_channels))
+        self.max_sizes = max_sizes
+        self._bias_maps = OrderedDict()
+
+    def _compute_bias_map(self, x: Tensor) -> Tensor:
+        ones = x.new_ones(1, 1, *x.shape[-2:])
+        return F.conv2d(
+            ones, self.shift_weight.to(x.dtype), self.bias.to(x.dtype),
+            self.conv.stride, self.conv.padding, self.conv.dilation,
+        )
+
+    def _bias_map(self, x: Tensor) -> Tensor:
+        "The shift's contribution varies near the borders because of zero padding, so it is a map per input size."
+        if torch.jit.is_tracing():
+            # A cached map would be baked into the traced graph as a constant of the example's size
+            return self._compute_bias_map(x)
+        key = (tuple(x.shape[-2:]), x.device, x.dtype)
+        bias_map = self._bias_maps.get(key)
+        if bias_map is None:
+            bias_map = self._bias_maps[key] = self._compute_bias_map(x)
+            while len(self._bias_maps) > self.max_sizes:
+                self._bias_maps.popitem(last=False)
+        return bias_map
+
+    def forward(self, x: Tensor) -> Tensor:
+        return self.conv(x) + self._bias_map(x)
+
+
+class OptimizedUnet(nn.Module):
+    """Colorizer UNet with normalization folded in: takes RGB in [0, 255], returns RGB in [0, 1].
+    With `grayscale` it takes the single gray channel instead and runs a 1 channel first conv."""
+
+    def __init__(self, unet: nn.Module, stats: Tuple[Collection[float], Collection[float]], grayscale: bool = False):
+        super().__init__()
+        mean, std = [torch.tensor(s, dtype=torch.float32) for s in stats]
+        # /255 and (x - mean) / std as a single multiply-add
+        self.input_norm = _ChannelAffine(1 / (255 * std), -mean / std)
+        self.unet = unet
+        self.grayscale = grayscale
+        if grayscale:
+            encoder = unet.layers[0]
+            encoder[0] = _LuminanceStem(encoder[0], self.input_norm.scale.flatten(), self.input_norm.shift.flatten())
+        last = unet.layers[-1]
+        if isinstance(last, SigmoidRange):
+            # denorm(sigmoid_range(x)) is still a per-channel affine of sigmoid(x)
+            scale = (last.high - last.low) * std
+            unet.layers[-1] = _ChannelAffine(scale, last.low * std + mean, sigmoid=True)
+        else:
+            unet.layers.append(_ChannelAffine(std, mean))
+
+    def forward(self, x: Tensor) -> Tensor:
+        if self.grayscale:
+            # The last-cross merge still sees the normalized 3 channel image
+            return self.unet(x, cross=self.input_norm(x)).clamp_(min=0, max=1)
+        return self.unet(self.input_norm(x)).clamp_(min=0, max=1)
+
+
+def _remove_reparametrizations(model: nn.Module):
+    "Replace spectral and weight normalized weights by the static tensors they compute in eval mode."
+    for module in model.modules():
+        for hook in list(module._forward_pre_hooks.values()):
+            if isinstance(hook, SpectralNorm):
+                remove_spectral_norm(module, name=hook.name)
+            elif isinstance(hook, WeightNorm):
+                remove_weight_norm(module, name=hook.name)
+        # Newer torch versions wrap load hooks, so remove_spectral_norm leaves this one behind
+        for key, hook in list(module._load_state_dict_pre_hooks.items()):
+            if isinstance(getattr(hook, 'hook', hook), SpectralNormLoadStateDictPreHook):
+                del module._load_state_dict_pre_hooks[key]
+
+
+def _fuse_sequential(seq: nn.Sequential) -> int:
+    n = 0
+    for i in range(len(seq) - 1):
+        if isinstance(seq[i], nn.Conv2d) and isinstance(seq[i + 1], nn.BatchNorm2d):
+            seq[i] = fuse_conv_bn_eval(seq[i], seq[i + 1])
+            seq[i + 1] = nn.Identity()
+            n += 1
+    return n
+
+
+def _fuse_conv_bn(model: nn.Module) -> int:
+    """Fold each BatchNorm that directly follows a conv into that conv's weights.
+    The decoder's `custom_conv_layer` puts its extra BatchNorm after the ReLU, so only
+    the encoder and the pixel shuffle convs have foldable pairs."""
+    n = 0
+    for module in model.modules():
+        if isinstance(module, nn.Sequential):
+            n += _fuse_sequential(module)
+        elif isinstance(module, (BasicBlock, Bottleneck)):
+            for i in (1, 2, 3):
+                conv, bn = getattr(module, f'conv{i}', None), getattr(module, f'bn{i}', None)
+                if conv is not None and bn is not None:
+                    setattr(module, f'conv{i}', fuse_conv_bn_eval(conv, bn))
+                    setattr(module, f'bn{i}', nn.Identity())
+                    n += 1
+    return n
+
+
+def optimize_for_inference(model: nn.Module, stats: tuple = imagenet_stats, grayscale: bool = False) -> OptimizedUnet:
+    """Bake spectral/weight norm and BatchNorm into static conv weights and fold input/output normalization into `model` (modified in place).
+    `grayscale` collapses the first conv to take a 1 channel image, for inputs whose 3 channels are equal."""
+    model.eval()
+    _remove_reparametrizations(model)
+    n_fused = _fuse_conv_bn(model)
+    logging.info('Folded {0} BatchNorm layers into convolutions'.format(n_fused))
+    optimized = OptimizedUnet(model, stats, grayscale=grayscale).eval()
+    for p in optimized.parameters():
+        p.requires_grad_(False)
+    return optimized
@@ -0,0 +1,238 @@
+from fastai.torch_core import *
+from fastai.vision import models
+from typing import Iterable
+from PIL import Image as PilImage
+from .generators import build_unet_deep, build_unet_wide, gen_model_deep, gen_model_wide
+from .optimize import OptimizedUnet, optimize_for_inference, _LuminanceStem
+import torch.nn.intrinsic as nni
+import torch.quantization as tq
+import io
+import time
+import logging
+
+__all__ = [
+    'QUANTIZE_MODES',
+    'calibration_images',
+    'load_quantized',
+    'quantization_report',
+    'quantize_dynamic',
+    'quantize_static',
+    'quantized_model_path',
+    'get_quantized_model',
+    'save_quantized',
+]
+
+QUANTIZE_MODES = ('dynamic', 'static')
+_IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp'}
+
+
+class _PointwiseLinear(nn.Module):
+    "A 1x1 convolution as `nn.Linear` over the channel dim, so dynamic quantization applies to it."
+
+    def __init__(self, conv: nn.Module):
+        super().__init__()
+        self.linear = nn.Linear(conv.in_channels, conv.out_channels, bias=conv.bias is not None)
+        self.linear.weight = nn.Parameter(conv.weight.detach().flatten(start_dim=1))
+        if conv.bias is not None:
+            self.linear.bias = nn.Parameter(conv.bias.detach())
+
+    def forward(self, x: Tensor) -> Tensor:
+        x = x.movedim(1, -1)
+        shape = x.shape
+        x = self.linear(x.reshape(-1, shape[-1]))
+        return x.view(*shape[:-1], -1).movedim(-1, 1)
+
+
+def _is_pointwise(conv: nn.Module) -> bool:
+    return (
+        isinstance(conv, (nn.Conv1d, nn.Conv2d))
+        and all(k == 1 for k in conv.kernel_size)
+        and all(s == 1 for s in conv.stride)
+        and all(p == 0 for p in conv.padding)
+        and conv.groups == 1
+    )
+
+
+def _replace_pointwise(module: nn.Module) -> int:
+    n = 0
+    for name, child in module.named_children():
+        if isinstance(child, _LuminanceStem):
+            continue
+        if _is_pointwise(child):
+            setattr(module, name, _PointwiseLinear(child))
+            n += 1
+        else:
+            n += _replace_pointwise(child)
+    return n
+
+
+def _fuse_conv_relu(module: nn.Module):
+    "Merge each conv directly followed by a ReLU in a `nn.Sequential` into one `ConvReLU2d`."
+    # Listed up front: the fused modules are themselves Sequentials of a conv and a ReLU
+    for child in list(module.modules()):
+        if not isinstance(child, nn.Sequential) or isinstance(child, nni.ConvReLU2d):
+            continue
+        for i in range(len(child) - 1):
+            if type(child[i]) is nn.Conv2d and isinstance(child[i + 1], nn.ReLU):
+                child[i] = nni.ConvReLU2d(child[i], child[i + 1])
+                child[i + 1] = nn.Identity()
+
+
+def _wrap_convs(module: nn.Module, qconfig) -> int:
+    """Put every conv between its own quantize/dequantize pair. Everything else (residual adds,
+    concatenations, BatchNorm after ReLU, attention) keeps running in fp32 between them."""
+    n = 0
+    for name, child in module.named_children():
+        if isinstance(child, _LuminanceStem):
+            continue
+        if isinstance(child, (nn.Conv1d, nn.Conv2d, nni.ConvReLU2d)):
+            wrapper = tq.QuantWrapper(child)
+            wrapper.qconfig = qconfig
+            setattr(module, name, wrapper)
+            n += 1
+        else:
+            n += _wrap_convs(child, qconfig)
+    return n
+
+
+def quantize_dynamic(model: OptimizedUnet) -> OptimizedUnet:
+    """Dynamic int8 quantization of `model` (modified in place). PyTorch only quantizes `nn.Linear`
+    dynamically, so this covers the 1x1 convs: attention projections, pixel shuffles and the output conv."""
+    n = _replace_pointwise(model.unet)
+    tq.quantize_dynamic(model.unet, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    logging.info('Dynamically quantized {0} pointwise convolutions'.format(n))
+    return model
+
+
+def _prepare_static(model: OptimizedUnet, engine: str) -> OptimizedUnet:
+    torch.backends.quantized.engine = engine
+    _fuse_conv_relu(model.unet)
+    n = _wrap_convs(model.unet, tq.get_default_qconfig(engine))
+    tq.prepare(model.unet, inplace=True)
+    logging.info('Prepared {0} convolutions for static quantization'.format(n))
+    return model
+
+
+def quantize_static(
+    model: OptimizedUnet, calibration: Iterable[Tensor], engine: str = None
+) -> OptimizedUnet:
+    "Static int8 quantization of every conv in `model` (modified in place), calibrated on the `calibration` inputs."
+    engine = ifnone(engine, torch.backends.quantized.engine)
+    _prepare_static(model, engine)
+    n = 0
+    with torch.no_grad():
+        for x in calibration:
+            model(x[None])
+            n += 1
+    if n == 0:
+        raise ValueError('Static quantization needs at least one calibration image')
+    tq.convert(model.unet, inplace=True)
+    return model
+
+
+def calibration_images(folder: Path, render_factor: int = 35, render_base: int = 16) -> Iterator[Tensor]:
+    "Photos in `folder` prepared the way `ColorizerFilter` feeds a grayscale `OptimizedUnet`."
+    sz = render_factor * render_base
+    for path in sorted(Path(folder).iterdir()):
+        if path.suffix.lower() not in _IMAGE_EXTENSIONS:
+            continue
+        image = PilImage.open(path).convert('RGB').resize((sz, sz), resample=PilImage.BILINEAR).convert('L')
+        yield torch.from_numpy(np.asarray(image, dtype=np.float32)[None])
+
+
+def quantized_model_path(root_folder: Path, weights_name: str, mode: str) -> Path:
+    return Path(root_folder) / 'models' / f'{weights_name}_int8_{mode}.pth'
+
+
+def save_quantized(model: OptimizedUnet, path: Path, mode: str, artistic: bool, engine: str = None):
+    "Save a quantized colorizer with what `load_quantized` needs to rebuild its modules."
+    torch.save(
+        {
+            'mode': mode,
+            'artistic': artistic,
+            'engine': ifnone(engine, torch.backends.quantized.engine),
+            'state_dict': model.state_dict(),
+        },
+        path,
+    )
+
+
+def _skeleton(artistic: bool) -> OptimizedUnet:
+    "Untrained optimized colorizer with the same modules as the one that was quantized."
+    unet = build_unet_deep() if artistic else build_unet_wide()
+    return optimize_for_inference(unet, grayscale=True)
+
+
+def load_quantized(path: Path) -> OptimizedUnet:
+    "Load a colorizer saved by `save_quantized`. Quantized models run on the CPU only."
+    state = torch.load(path, map_location='cpu')
+    model = _skeleton(state['artistic'])
+    if state['mode'] == 'dynamic':
+        quantize_dynamic(model)
+    else:
+        _prepare_static(model, state['engine'])
+        tq.convert(model.unet, inplace=True)
+    model.load_state_dict(state['state_dict'])
+    return model.eval()
+
+
+def get_quantized_model(root_folder: Path, weights_name: str, artistic: bool, mode: str) -> OptimizedUnet:
+    """Load the quantized artifact for `weights_name`. Dynamic ones are made from the fp32 weights
+    when missing; static ones need calibration first (see quantize_model.py)."""
+    if mode not in QUANTIZE_MODES:
+        raise ValueError('Unknown quantization mode {0}, expected one of {1}'.format(mode, QUANTIZE_MODES))
+    path = quantized_model_path(root_folder, weights_name, mode)
+    if path.exists():
+        return load_quantized(path)
+    if mode == 'static':
+        raise FileNotFoundError(
+            '{0} not found, run quantize_model.py with a calibration folder to create it'.format(path)
+        )
+    gen_model = gen_model_deep if artistic else gen_model_wide
+    model = gen_model(root_folder=root_folder, weights_name=weights_name, device=torch.device('cpu'))
+    return quantize_dynamic(optimize_for_inference(model, grayscale=True))
+
+
+def _serialized_size(model: nn.Module) -> int:
+    "Bytes of the saved state dict, which also counts packed int8 weights that `parameters()` doesn't see."
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def _time_forward(model: nn.Module, x: Tensor, repeat: int) -> Tuple[Tensor, float]:
+    times = []
+    with torch.no_grad():
+        for _ in range(repeat):
+            start = time.perf_counter()
+            out = model(x)
+            times.append(time.perf_counter() - start)
+    return out, sorted(times)[len(times) // 2]
+
+
+def quantization_report(
+    reference: OptimizedUnet, quantized: OptimizedUnet, inputs: Iterable[Tensor], repeat: int = 3
+) -> dict:
+    """Median latency, saved state dict size and per-pixel deviation (in 0-255 levels) of `quantized` against
+    the fp32 `reference`. The size is that of the weights on disk, not the memory a forward needs."""
+    fp32_times, int8_times, max_diff, total_diff, n_pixels = [], [], 0.0, 0.0, 0
+    for x in inputs:
+        ref, ref_t = _time_forward(reference, x[None], repeat)
+        out, out_t = _time_forward(quantized, x[None], repeat)
+        diff = ((ref - out) * 255).abs()
+        max_diff = max(max_diff, diff.max().item())
+        total_diff += diff.sum().item()
+        n_pixels += diff.numel()
+        fp32_times.append(ref_t)
+        int8_times.append(out_t)
+    if not fp32_times:
+        raise ValueError('The quantization report needs at least one input image')
+    return {
+        'images': len(fp32_times),
+        'fp32_latency': sum(fp32_times) / len(fp32_times),
+        'int8_latency': sum(int8_times) / len(int8_times),
+        'fp32_size_bytes': _serialized_size(reference),
+        'int8_size_bytes': _serialized_size(quantized),
+        'mean_abs_diff': total_diff / n_pixels,
+        'max_abs_diff': max_diff,
+    }
@@ -0,0 +1,315 @@
+from collections import OrderedDict
+from fastai.torch_core import *
+from deoldify import device as device_settings
+from .batching import BatchScheduler
+from .compiled import CompiledColorizer, compiled_cache_dir
+from .cache import ResultCache
+from .filters import ColorizerFilter, MasterFilter
+from .generators import gen_model_deep, gen_model_wide
+from .memory import MemoryEstimator, memory_table_path
+from .optimize import OptimizedUnet, optimize_for_inference
+from .quantize import get_quantized_model
+from .runtime import OnnxColorizer, get_onnx_model
+from .visualize import ModelImageVisualizer
+import threading
+import time
+import logging
+
+__all__ = ['ModelRegistry', 'model_registry']
+
+_DEFAULT_WEIGHTS = {'artistic': 'ColorizeArtistic_gen', 'stable': 'ColorizeStable_gen'}
+BACKENDS = ('torch', 'onnx')
+
+
+def _model_nbytes(model: nn.Module) -> int:
+    "Bytes held by the state of `model`, including int8 weights packed away from `parameters()`."
+    if isinstance(model, OnnxColorizer):
+        return model.nbytes
+    if isinstance(model, CompiledColorizer):
+        return _model_nbytes(model.model) + model.graph_nbytes
+    values = model.state_dict().values()
+    tensors = itertools.chain.from_iterable(v if isinstance(v, tuple) else (v,) for v in values)
+    return sum(t.numel() * t.element_size() for t in tensors if torch.is_tensor(t))
+
+
+class _RegistryEntry:
+    def __init__(self, filtr: ColorizerFilter, nbytes: int, load_time: float):
+        self.filter = filtr
+        self.nbytes = nbytes
+        self.load_time = load_time
+        self.hits = 0
+
+
+class ModelRegistry:
+    "Process-wide cache of loaded colorizer models, kept under `memory_budget` bytes with LRU eviction."
+
+    def __init__(
+        self,
+        memory_budget: Optional[int] = None,
+        batcher: BatchScheduler = None,
+        optimize: bool = False,
+        compile_render_factors: Optional[Collection[int]] = None,
+        guided_upsampling: bool = False,
+        tile_size: Optional[int] = None,
+        memory_limit: Optional[int] = None,
+    ):
+        self.memory_budget = memory_budget
+        # Models loaded after these are set route their forwards through the shared scheduler,
+        # have their normalization layers folded by `optimize_for_inference` and, if optimized,
+        # run TorchScript graphs compiled for `compile_render_factors`, upsample
+        # their chroma with a guided filter if `guided_upsampling` and add tiled detail if `tile_size`.
+        # Models with a memory table (see `memory_table_path`) check each request against the memory
+        # available, capped at `memory_limit` bytes per forward, and degrade those that would not fit.
+        self.batcher = batcher
+        self.optimize = optimize
+        self.compile_render_factors = compile_render_factors
+        self.guided_upsampling = guided_upsampling
+        self.tile_size = tile_size
+        self.memory_limit = memory_limit
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._load_time = 0.0
+
+    def _key(
+        self,
+        root_folder: Path,
+        artistic: bool,
+        weights_name: Optional[str],
+        device: Optional[torch.device],
+        quantize: Optional[str] = None,
+        backend: str = 'torch',
+    ) -> Tuple[str, str, str, str, str, str]:
+        model_type = 'artistic' if artistic else 'stable'
+        weights_name = ifnone(weights_name, _DEFAULT_WEIGHTS[model_type])
+        device = None if device is None else str(torch.device(device))
+        if backend not in BACKENDS:
+            raise ValueError('Unknown backend {0}, expected one of {1}'.format(backend, BACKENDS))
+        if backend == 'onnx' and quantize is not None:
+            raise ValueError('The ONNX backend runs the fp32 model only')
+        if (quantize is not None or backend == 'onnx') and device not in (None, 'cpu'):
+            raise ValueError('Quantized and ONNX colorizers run on the CPU only, got device {0}'.format(device))
+        return (str(Path(root_folder).resolve()), model_type, weights_name, device, quantize, backend)
+
+    def _lookup(self, key: Tuple[str, str, str, str, str, str]) -> Optional[ColorizerFilter]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            entry.hits += 1
+            self._hits += 1
+            return entry.filter
+
+    def _load(self, key: Tuple[str, str, str, str, str, str]) -> _RegistryEntry:
+        root_folder, model_type, weights_name, device, quantize, backend = key
+        logging.info('Loading {0} colorizer weights {1}'.format(model_type, weights_name))
+        start = time.perf_counter()
+        device = None if device is None else torch.device(device)
+        if backend == 'onnx':
+            model = get_onnx_model(Path(root_folder), weights_name, artistic=model_type == 'artistic')
+            device = torch.device('cpu')
+        elif quantize is not None:
+            # Quantized models are built on top of `optimize_for_inference` already
+            model = get_quantized_model(Path(root_folder), weights_name, artistic=model_type == 'artistic', mode=quantize)
+            device = torch.device('cpu')
+        else:
+            gen_model = gen_model_deep if model_type == 'artistic' else gen_model_wide
+            model = gen_model(root_folder=Path(root_folder), weights_name=weights_name, device=device)
+            if self.optimize:
+                # The colorizer always feeds a gray image, so the first conv can take one channel
+                model = optimize_for_inference(model, grayscale=True)
+                if self.compile_render_factors:
+                    model = CompiledColorizer(
+                        model,
+                        cache_dir=compiled_cache_dir(root_folder, weights_name),
+                        source=Path(root_folder) / 'models' / f'{weights_name}.pth',
+                    )
+        filtr = ColorizerFilter(
+            model=model,
+            batcher=self.batcher,
+            device=device,
+            guided_upsampling=self.guided_upsampling,
+            tile_size=self.tile_size,
+        )
+        filtr.memory_estimator = MemoryEstimator.load(
+            memory_table_path(root_folder, self._model_id(key, model), filtr.device.type), limit=self.memory_limit
+        )
+        if isinstance(model, CompiledColorizer):
+            # Compiled on the filter's device, for the sizes `ColorizerFilter` renders at
+            model.compile([rf * filtr.render_base for rf in self.compile_render_factors])
+        load_time = time.perf_counter() - start
+        return _RegistryEntry(filtr, _model_nbytes(model), load_time)
+
+    def _model_id(self, key: Tuple[str, str, str, str, str, str], model: nn.Module = None) -> str:
+        """The weights and how they are run, which is what results and memory use depend on.
+        Without `model`, for the model `_load` would build with the current settings."""
+        _, _, weights_name, _, quantize, backend = key
+        if backend == 'onnx':
+            return weights_name + '-onnx'
+        if quantize is not None:
+            return '{0}-int8-{1}'.format(weights_name, quantize)
+        if self.optimize if model is None else isinstance(model, (OptimizedUnet, CompiledColorizer)):
+            return weights_name + '-optimized'
+        return weights_name
+
+    def _device_type(self, key: Tuple[str, str, str, str, str, str]) -> str:
+        "The type of device the model for `key` runs on, as `ColorizerFilter` places it."
+        _, _, _, device, quantize, backend = key
+        if quantize is not None or backend == 'onnx':
+            return 'cpu'
+        if device is not None:
+            return torch.device(device).type
+        return defaults.device.type if device_settings.is_gpu() else 'cpu'
+
+    def _evict_over_budget(self):
+        "Drop least recently used models until the budget fits, always keeping the newest one."
+        if self.memory_budget is None:
+            return
+        while len(self._entries) > 1 and self.nbytes > self.memory_budget:
+            key, _ = self._entries.popitem(last=False)
+            self._evictions += 1
+            logging.info('Evicted colorizer {0} from model registry'.format(key[1:3]))
+
+    def get_filter(
+        self,
+        root_folder: Path = Path('./'),
+        artistic: bool = True,
+        weights_name: str = None,
+        device: torch.device = None,
+        quantize: str = None,
+        backend: str = 'torch',
+    ) -> ColorizerFilter:
+        """Return the warm `ColorizerFilter` for the model, loading it on first use.
+        `quantize` is None, 'dynamic' or 'static'; `backend` is 'torch' or 'onnx' (ONNX Runtime)."""
+        key = self._key(root_folder, artistic, weights_name, device, quantize, backend)
+        filtr = self._lookup(key)
+        if filtr is not None:
+            return filtr
+        # Loads are serialized so that concurrent misses on the same key only load once.
+        with self._load_lock:
+            filtr = self._lookup(key)
+            if filtr is not None:
+                return filtr
+            entry = self._load(key)
+            with self._lock:
+                self._misses += 1
+                self._load_time += entry.load_time
+                self._entries[key] = entry
+                self._evict_over_budget()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        return entry.filter
+
+    def loaded_filter(
+        self,
+        root_folder: Path = Path('./'),
+        artistic: bool = True,
+        weights_name: str = None,
+        device: torch.device = None,
+        quantize: str = None,
+        backend: str = 'torch',
+    ) -> Optional[ColorizerFilter]:
+        "The `ColorizerFilter` `get_filter` would return, if it is loaded already. Never loads, nor counts as a use."
+        key = self._key(root_folder, artistic, weights_name, device, quantize, backend)
+        with self._lock:
+            entry = self._entries.get(key)
+            return None if entry is None else entry.filter
+
+    def get_image_colorizer(
+        self,
+        root_folder: Path = Path('./'),
+        render_factor: int = 35,
+        artistic: bool = True,
+        weights_name: str = None,
+        results_dir='result_images',
+        cache: ResultCache = None,
+        device: torch.device = None,
+        quantize: str = None,
+        backend: str = 'torch',
+    ) -> ModelImageVisualizer:
+        "Same as `visualize.get_image_colorizer`, but backed by a warm model from the registry."
+        filtr = self.get_filter(
+            root_folder=root_folder,
+            artistic=artistic,
+            weights_name=weights_name,
+            device=device,
+            quantize=quantize,
+            backend=backend,
+        )
+        key = self._key(root_folder, artistic, weights_name, device, quantize, backend)
+        # Folding, quantization, the runtime, guided upsampling and tiling change results, so cached results are kept apart
+        model_id = self._model_id(key, filtr.model)
+        if filtr.guided_upsampling:
+            model_id += '-guided'
+        if filtr.tile_size is not None:
+            model_id += '-tiled{0}'.format(filtr.tile_size)
+        if results_dir is not None:
+            results_dir = Path(root_folder) / results_dir
+        return ModelImageVisualizer(
+            MasterFilter([filtr], render_factor=render_factor),
+            results_dir=results_dir,
+            cache=cache,
+            model_id=model_id,
+        )
+
+    def memory_table_path(
+        self,
+        root_folder: Path = Path('./'),
+        artistic: bool = True,
+        weights_name: str = None,
+        device: torch.device = None,
+        quantize: str = None,
+        backend: str = 'torch',
+    ) -> Path:
+        """Where the memory table of the model `get_filter` returns for the same arguments is read from.
+        Worked out from the arguments and the registry's settings, without loading the model."""
+        key = self._key(root_folder, artistic, weights_name, device, quantize, backend)
+        return memory_table_path(root_folder, self._model_id(key), self._device_type(key))
+
+    @property
+    def nbytes(self) -> int:
+        return sum(entry.nbytes for entry in self._entries.values())
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        "Hit/miss counters, load times and the models currently resident."
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'load_time_total': self._load_time,
+                'memory_budget': self.memory_budget,
+                'memory_used': self.nbytes,
+                'batching': None if self.batcher is None else self.batcher.stats(),
+                'optimize': self.optimize,
+                'compile_render_factors': self.compile_render_factors,
+                'guided_upsampling': self.guided_upsampling,
+                'tile_size': self.tile_size,
+                'memory_limit': self.memory_limit,
+                'models': [
+                    {
+                        'model_type': model_type,
+                        'weights_name': weights_name,
+                        'device': device,
+                        'quantize': quantize,
+                        'backend': backend,
+                        'nbytes': entry.nbytes,
+                        'load_time': entry.load_time,
+                        'hits': entry.hits,
+                        'memory_table': entry.filter.memory_estimator is not None,
+                        'latency': entry.filter.latency.stats(),
+                    }
+                    for (_, model_type, weights_name, device, quantize, backend), entry in self._entries.items()
+                ],
+            }
+
+
+model_registry = ModelRegistry()
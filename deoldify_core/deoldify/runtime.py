@@ -0,0 +1,107 @@
+from pathlib import Path
+from typing import Optional
+import numpy as np
+import torch
+import logging
+
+# Serving through ONNX Runtime needs neither fastai nor the model code: those are
+# only imported when a checkpoint has to be exported first.
+
+__all__ = ['OnnxColorizer', 'export_onnx', 'get_onnx_model', 'load_onnx_model', 'onnx_model_path']
+
+_INPUT_NAME = 'gray'
+_OUTPUT_NAME = 'rgb'
+
+
+def onnx_model_path(root_folder: Path, weights_name: str) -> Path:
+    return Path(root_folder) / 'models' / f'{weights_name}.onnx'
+
+
+def _optimized_model_path(path: Path) -> Path:
+    return path.with_name(path.stem + '_optimized.onnx')
+
+
+def _is_stale(path: Path, source: Path) -> bool:
+    return not path.exists() or (source.exists() and path.stat().st_mtime < source.stat().st_mtime)
+
+
+def export_onnx(model: torch.nn.Module, path: Path, size: int = 256, opset_version: int = 13):
+    """Export a grayscale `OptimizedUnet` to ONNX with a dynamic batch and square spatial size,
+    so one file serves every render_factor. Input: Nx1xSxS gray in [0, 255]; output: Nx3xSxS RGB in [0, 1].
+    Self-attention is exported as the full attention matrix, not `ChunkedSelfAttention`'s chunk loop, so the
+    graph's memory grows quadratically with the size, unlike the torch backends'."""
+    model = model.eval()
+    x = torch.randint(0, 256, (1, 1, size, size)).float()
+    dims = {0: 'batch', 2: 'size', 3: 'size'}
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            x,
+            str(path),
+            input_names=[_INPUT_NAME],
+            output_names=[_OUTPUT_NAME],
+            dynamic_axes={_INPUT_NAME: dims, _OUTPUT_NAME: dims},
+            opset_version=opset_version,
+        )
+
+
+def _session(path: Path, num_threads: Optional[int] = None):
+    """CPU session for `path`. The graph fusions are done once and saved next to it, so later
+    processes start from the fused graph."""
+    try:
+        import onnxruntime as ort
+    except ImportError as e:
+        raise ImportError(
+            'The onnx backend needs ONNX Runtime: pip install -r deoldify_core/requirements-onnx.txt'
+        ) from e
+
+    optimized_path = _optimized_model_path(path)
+    if _is_stale(optimized_path, path):
+        # Only up to the extended level: the layout transforms above it are specific to this CPU
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+        options.optimized_model_filepath = str(optimized_path)
+        ort.InferenceSession(str(path), options, providers=['CPUExecutionProvider'])
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if num_threads:
+        options.intra_op_num_threads = num_threads
+    return ort.InferenceSession(str(optimized_path), options, providers=['CPUExecutionProvider'])
+
+
+class OnnxColorizer:
+    "Runs an exported colorizer on ONNX Runtime. Called like a grayscale `OptimizedUnet`, on CPU tensors."
+
+    grayscale = True
+
+    def __init__(self, session, nbytes: int = 0):
+        self.session = session
+        self.nbytes = nbytes
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        # `InferenceSession.run` is thread-safe, so one session serves every worker
+        x = np.ascontiguousarray(x.detach().cpu().numpy(), dtype=np.float32)
+        out = self.session.run([_OUTPUT_NAME], {_INPUT_NAME: x})[0]
+        return torch.from_numpy(out)
+
+
+def load_onnx_model(path: Path, num_threads: Optional[int] = None) -> OnnxColorizer:
+    path = Path(path)
+    return OnnxColorizer(_session(path, num_threads=num_threads), nbytes=path.stat().st_size)
+
+
+def get_onnx_model(
+    root_folder: Path, weights_name: str, artistic: bool, num_threads: Optional[int] = None
+) -> OnnxColorizer:
+    "ONNX Runtime colorizer for `weights_name`, exported from the checkpoint first if it is missing or older."
+    path = onnx_model_path(root_folder, weights_name)
+    checkpoint = Path(root_folder) / 'models' / f'{weights_name}.pth'
+    if _is_stale(path, checkpoint):
+        from .generators import gen_model_deep, gen_model_wide
+        from .optimize import optimize_for_inference
+
+        logging.info('Exporting {0} to {1}'.format(weights_name, path))
+        gen_model = gen_model_deep if artistic else gen_model_wide
+        model = gen_model(root_folder=root_folder, weights_name=weights_name, device=torch.device('cpu'))
+        export_onnx(optimize_for_inference(model, grayscale=True), path)
+    return load_onnx_model(path, num_threads=num_threads)
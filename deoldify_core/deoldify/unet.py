@@ -7,7 +7,7 @@ from fastai.vision import *
 
 # The code below is meant to be merged into fastaiv1 ideally
 
-__all__ = ['DynamicUnetDeep', 'DynamicUnetWide']
+__all__ = ['DynamicUnetDeep', 'DynamicUnetWide', 'encoder_sizes']
 
 
 def _get_sfs_idxs(sizes: Sizes) -> List[int]:
@@ -21,6 +21,26 @@ def _get_sfs_idxs(sizes: Sizes) -> List[int]:
     return sfs_idxs
 
 
+_RESNET_STEM = [(1, 64, 128, 128)] * 3 + [(1, 64, 64, 64)]
+# Activation sizes of each `create_body(arch)` child for a 256x256 input, so building a
+# generator needs no dummy forward. Other archs are measured once and memoized here.
+_ENCODER_SIZES = {
+    ('resnet18', (256, 256)): _RESNET_STEM + [(1, 64, 64, 64), (1, 128, 32, 32), (1, 256, 16, 16), (1, 512, 8, 8)],
+    ('resnet34', (256, 256)): _RESNET_STEM + [(1, 64, 64, 64), (1, 128, 32, 32), (1, 256, 16, 16), (1, 512, 8, 8)],
+    ('resnet50', (256, 256)): _RESNET_STEM + [(1, 256, 64, 64), (1, 512, 32, 32), (1, 1024, 16, 16), (1, 2048, 8, 8)],
+    ('resnet101', (256, 256)): _RESNET_STEM + [(1, 256, 64, 64), (1, 512, 32, 32), (1, 1024, 16, 16), (1, 2048, 8, 8)],
+    ('resnet152', (256, 256)): _RESNET_STEM + [(1, 256, 64, 64), (1, 512, 32, 32), (1, 1024, 16, 16), (1, 2048, 8, 8)],
+}
+
+
+def encoder_sizes(arch: Callable, encoder: nn.Module, size: Tuple[int, int] = (256, 256)) -> Sizes:
+    "Activation sizes of `encoder`, built by `create_body(arch)`, for an input of `size`."
+    key = (getattr(arch, '__name__', repr(arch)), tuple(size))
+    if key not in _ENCODER_SIZES:
+        _ENCODER_SIZES[key] = [tuple(sz) for sz in model_sizes(encoder, size=size)]
+    return _ENCODER_SIZES[key]
+
+
 class CustomPixelShuffle_ICNR(nn.Module):
     "Upsample by `scale` from `ni` filters to `nf` (default `ni`), using `nn.PixelShuffle`, `icnr` init, and `weight_norm`."
 
@@ -52,6 +72,33 @@ class CustomPixelShuffle_ICNR(nn.Module):
         return self.blur(self.pad(x)) if self.blur else x
 
 
+class _DynamicUnet(SequentialEx):
+    "Shared forward of the dynamic UNets: encoder features are handed to the decoder explicitly."
+
+    def _encode(self, x: Tensor) -> Tuple[Tensor, List[Tensor]]:
+        features = []
+        for i, layer in enumerate(self.layers[0]):
+            x = layer(x)
+            if i in self.sfs_idxs:
+                features.append(x)
+        return x, features
+
+    def forward(self, x: Tensor, cross: Optional[Tensor] = None) -> Tensor:
+        # Nothing is stored on the modules, so one model can serve several threads at once,
+        # and each skip feature is released as soon as its decoder block has used it.
+        # `cross` stands in for `x` at the last-cross merge when the encoder takes another input.
+        cross = ifnone(cross, x)
+        res, sfs = self._encode(x)
+        for layer in self.layers[1:]:
+            if isinstance(layer, (UnetBlockDeep, UnetBlockWide)):
+                res = layer(res, sfs.pop())
+            elif isinstance(layer, MergeLayer):
+                res = torch.cat([res, cross], dim=1) if layer.dense else res + cross
+            else:
+                res = layer(res)
+        return res
+
+
 class UnetBlockDeep(nn.Module):
     "A quasi-UNet block, using `PixelShuffle_ICNR upsampling`."
 
@@ -59,7 +106,6 @@ class UnetBlockDeep(nn.Module):
         self,
         up_in_c: int,
         x_in_c: int,
-        hook: Hook,
         final_div: bool = True,
         blur: bool = False,
         leaky: float = None,
@@ -68,7 +114,6 @@ class UnetBlockDeep(nn.Module):
         **kwargs
     ):
         super().__init__()
-        self.hook = hook
         self.shuf = CustomPixelShuffle_ICNR(
             up_in_c, up_in_c // 2, blur=blur, leaky=leaky, **kwargs
         )
@@ -80,18 +125,19 @@ class UnetBlockDeep(nn.Module):
             nf, nf, leaky=leaky, self_attention=self_attention, **kwargs
         )
         self.relu = relu(leaky=leaky)
+        self.nf = nf
 
-    def forward(self, up_in: Tensor) -> Tensor:
-        s = self.hook.stored
+    def forward(self, up_in: Tensor, s: Tensor) -> Tensor:
         up_out = self.shuf(up_in)
         ssh = s.shape[-2:]
-        if ssh != up_out.shape[-2:]:
+        # A traced graph must handle every input size, so it always resizes (a no-op when they match)
+        if torch.jit.is_tracing() or ssh != up_out.shape[-2:]:
             up_out = F.interpolate(up_out, s.shape[-2:], mode='nearest')
         cat_x = self.relu(torch.cat([up_out, self.bn(s)], dim=1))
         return self.conv2(self.conv1(cat_x))
 
 
-class DynamicUnetDeep(SequentialEx):
+class DynamicUnetDeep(_DynamicUnet):
     "Create a U-Net from a given architecture."
 
     def __init__(
@@ -106,14 +152,15 @@ class DynamicUnetDeep(SequentialEx):
         bottle: bool = False,
         norm_type: Optional[NormType] = NormType.Batch,
         nf_factor: float = 1.0,
+        encoder_sizes: Optional[Sizes] = None,
         **kwargs
     ):
         extra_bn = norm_type == NormType.Spectral
         imsize = (256, 256)
-        sfs_szs = model_sizes(encoder, size=imsize)
+        # Channel counts come from `encoder_sizes` and the block definitions rather than dummy forwards
+        sfs_szs = encoder_sizes if encoder_sizes is not None else model_sizes(encoder, size=imsize)
         sfs_idxs = list(reversed(_get_sfs_idxs(sfs_szs)))
-        self.sfs = hook_outputs([encoder[i] for i in sfs_idxs], detach=False)
-        x = dummy_eval(encoder, imsize).detach()
+        self.sfs_idxs = sfs_idxs
 
         ni = sfs_szs[-1][1]
         middle_conv = nn.Sequential(
@@ -124,18 +171,17 @@ class DynamicUnetDeep(SequentialEx):
                 ni * 2, ni, norm_type=norm_type, extra_bn=extra_bn, **kwargs
             ),
         ).eval()
-        x = middle_conv(x)
         layers = [encoder, batchnorm_2d(ni), nn.ReLU(), middle_conv]
+        up_in_c = ni
 
         for i, idx in enumerate(sfs_idxs):
             not_final = i != len(sfs_idxs) - 1
-            up_in_c, x_in_c = int(x.shape[1]), int(sfs_szs[idx][1])
+            x_in_c = int(sfs_szs[idx][1])
             do_blur = blur and (not_final or blur_final)
             sa = self_attention and (i == len(sfs_idxs) - 3)
             unet_block = UnetBlockDeep(
                 up_in_c,
                 x_in_c,
-                self.sfs[i],
                 final_div=not_final,
                 blur=blur,
                 self_attention=sa,
@@ -145,9 +191,9 @@ class DynamicUnetDeep(SequentialEx):
                 **kwargs
             ).eval()
             layers.append(unet_block)
-            x = unet_block(x)
+            up_in_c = unet_block.nf
 
-        ni = x.shape[1]
+        ni = up_in_c
         if imsize != sfs_szs[0][-2:]:
             layers.append(PixelShuffle_ICNR(ni, **kwargs))
         if last_cross:
@@ -161,9 +207,6 @@ class DynamicUnetDeep(SequentialEx):
             layers.append(SigmoidRange(*y_range))
         super().__init__(*layers)
 
-    def __del__(self):
-        if hasattr(self, "sfs"):
-            self.sfs.remove()
 
 
 # ------------------------------------------------------
@@ -175,7 +218,6 @@ class UnetBlockWide(nn.Module):
         up_in_c: int,
         x_in_c: int,
         n_out: int,
-        hook: Hook,
         final_div: bool = True,
         blur: bool = False,
         leaky: float = None,
@@ -183,7 +225,6 @@ class UnetBlockWide(nn.Module):
         **kwargs
     ):
         super().__init__()
-        self.hook = hook
         up_out = x_out = n_out // 2
         self.shuf = CustomPixelShuffle_ICNR(
             up_in_c, up_out, blur=blur, leaky=leaky, **kwargs
@@ -194,18 +235,19 @@ class UnetBlockWide(nn.Module):
             ni, x_out, leaky=leaky, self_attention=self_attention, **kwargs
         )
         self.relu = relu(leaky=leaky)
+        self.nf = x_out
 
-    def forward(self, up_in: Tensor) -> Tensor:
-        s = self.hook.stored
+    def forward(self, up_in: Tensor, s: Tensor) -> Tensor:
         up_out = self.shuf(up_in)
         ssh = s.shape[-2:]
-        if ssh != up_out.shape[-2:]:
+        # A traced graph must handle every input size, so it always resizes (a no-op when they match)
+        if torch.jit.is_tracing() or ssh != up_out.shape[-2:]:
             up_out = F.interpolate(up_out, s.shape[-2:], mode='nearest')
         cat_x = self.relu(torch.cat([up_out, self.bn(s)], dim=1))
         return self.conv(cat_x)
 
 
-class DynamicUnetWide(SequentialEx):
+class DynamicUnetWide(_DynamicUnet):
     "Create a U-Net from a given architecture."
 
     def __init__(
@@ -220,16 +262,17 @@ class DynamicUnetWide(SequentialEx):
         bottle: bool = False,
         norm_type: Optional[NormType] = NormType.Batch,
         nf_factor: int = 1,
+        encoder_sizes: Optional[Sizes] = None,
         **kwargs
     ):
 
         nf = 512 * nf_factor
         extra_bn = norm_type == NormType.Spectral
         imsize = (256, 256)
-        sfs_szs = model_sizes(encoder, size=imsize)
+        # Channel counts come from `encoder_sizes` and the block definitions rather than dummy forwards
+        sfs_szs = encoder_sizes if encoder_sizes is not None else model_sizes(encoder, size=imsize)
         sfs_idxs = list(reversed(_get_sfs_idxs(sfs_szs)))
-        self.sfs = hook_outputs([encoder[i] for i in sfs_idxs], detach=False)
-        x = dummy_eval(encoder, imsize).detach()
+        self.sfs_idxs = sfs_idxs
 
         ni = sfs_szs[-1][1]
         middle_conv = nn.Sequential(
@@ -240,12 +283,12 @@ class DynamicUnetWide(SequentialEx):
                 ni * 2, ni, norm_type=norm_type, extra_bn=extra_bn, **kwargs
             ),
         ).eval()
-        x = middle_conv(x)
         layers = [encoder, batchnorm_2d(ni), nn.ReLU(), middle_conv]
+        up_in_c = ni
 
         for i, idx in enumerate(sfs_idxs):
             not_final = i != len(sfs_idxs) - 1
-            up_in_c, x_in_c = int(x.shape[1]), int(sfs_szs[idx][1])
+            x_in_c = int(sfs_szs[idx][1])
             do_blur = blur and (not_final or blur_final)
             sa = self_attention and (i == len(sfs_idxs) - 3)
 
@@ -255,7 +298,6 @@ class DynamicUnetWide(SequentialEx):
                 up_in_c,
                 x_in_c,
                 n_out,
-                self.sfs[i],
                 final_div=not_final,
                 blur=blur,
                 self_attention=sa,
@@ -264,9 +306,9 @@ class DynamicUnetWide(SequentialEx):
                 **kwargs
             ).eval()
             layers.append(unet_block)
-            x = unet_block(x)
+            up_in_c = unet_block.nf
 
-        ni = x.shape[1]
+        ni = up_in_c
         if imsize != sfs_szs[0][-2:]:
             layers.append(PixelShuffle_ICNR(ni, **kwargs))
         if last_cross:
@@ -280,6 +322,3 @@ class DynamicUnetWide(SequentialEx):
             layers.append(SigmoidRange(*y_range))
         super().__init__(*layers)
 
-    def __del__(self):
-        if hasattr(self, "sfs"):
-            self.sfs.remove()
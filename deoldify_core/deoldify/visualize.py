@@ -2,12 +2,20 @@ from fastai.core import *
 from fastai.vision import *
 from matplotlib.axes import Axes
 from .filters import IFilter, MasterFilter, ColorizerFilter
-from .generators import gen_inference_deep, gen_inference_wide
+from .cache import ResultCache
+from .frames import FramePipeline
+from .generators import gen_model_deep, gen_model_wide
+from .memory import MemoryEstimator, memory_table_path
+from .quantize import get_quantized_model
+from .runtime import get_onnx_model
+from .watermark import Watermark
 from PIL import Image
+from typing import Iterable
 import ffmpeg
 import yt_dlp as youtube_dl
 import gc
 import requests
+from fractions import Fraction
 from io import BytesIO
 import base64
 from IPython import display as ipythondisplay
@@ -16,39 +24,40 @@ from IPython.display import Image as ipythonimage
 import cv2
 import logging
 
-# adapted from https://www.pyimagesearch.com/2016/04/25/watermarking-images-with-opencv-and-python/
+_WATERMARK_PATH = Path(__file__).resolve().parent.parent / 'resource_images' / 'watermark.png'
+# Decoded once per process and shared by every image and video frame
+_watermark = Watermark(_WATERMARK_PATH)
+
+
 def get_watermarked(pil_image: Image) -> Image:
     try:
-        image = cv2.cvtColor(np.array(pil_image), cv2.COLOR_RGB2BGR)
-        (h, w) = image.shape[:2]
-        image = np.dstack([image, np.ones((h, w), dtype="uint8") * 255])
-        pct = 0.05
-        full_watermark = cv2.imread(
-            './resource_images/watermark.png', cv2.IMREAD_UNCHANGED
-        )
-        (fwH, fwW) = full_watermark.shape[:2]
-        wH = int(pct * h)
-        wW = int((pct * h / fwH) * fwW)
-        watermark = cv2.resize(full_watermark, (wH, wW), interpolation=cv2.INTER_AREA)
-        overlay = np.zeros((h, w, 4), dtype="uint8")
-        (wH, wW) = watermark.shape[:2]
-        overlay[h - wH - 10 : h - 10, 10 : 10 + wW] = watermark
-        # blend the two images together using transparent overlays
-        output = image.copy()
-        cv2.addWeighted(overlay, 0.5, output, 1.0, 0, output)
-        rgb_image = cv2.cvtColor(output, cv2.COLOR_BGR2RGB)
-        final_image = Image.fromarray(rgb_image)
-        return final_image
+        return _watermark.apply(pil_image)
     except:
         # Don't want this to crash everything, so let's just not watermark the image for now.
         return pil_image
 
 
+def watermark_stamp(size: Tuple[int, int]) -> Optional[Callable[[np.ndarray, int], None]]:
+    """The watermark of `get_watermarked` for an image of `size` (w, h), as a `ColorizerFilter` stamp that
+    blends it in place into the RGB output strips it overlaps. None if there is no watermark to apply."""
+    try:
+        return _watermark.stamper(size)
+    except:
+        # Same as `get_watermarked`: no watermark rather than no image
+        return None
+
+
 class ModelImageVisualizer:
-    def __init__(self, filter: IFilter, results_dir: str = None):
+    def __init__(
+        self, filter: IFilter, results_dir: str = None, cache: ResultCache = None, model_id: str = None
+    ):
         self.filter = filter
         self.results_dir = None if results_dir is None else Path(results_dir)
-        self.results_dir.mkdir(parents=True, exist_ok=True)
+        self.cache = cache
+        # Identifies the weights in cache keys, so results of different models never collide
+        self.model_id = model_id
+        if self.results_dir is not None:
+            self.results_dir.mkdir(parents=True, exist_ok=True)
 
     def _clean_mem(self):
         torch.cuda.empty_cache()
@@ -57,6 +66,23 @@ class ModelImageVisualizer:
     def _open_pil_image(self, path: Path) -> Image:
         return PIL.Image.open(path).convert('RGB')
 
+    def _open_luminance_image(self, fp) -> Image:
+        image = PIL.Image.open(fp)
+        # JPEGs decode their Y plane only, without the color conversion
+        image.draft('L', None)
+        return image if image.mode == 'L' else image.convert('L')
+
+    def _to_luminance_image(self, image: Union[Image, np.ndarray, bytes, str, Path]) -> Image:
+        """Accept a PIL image, an HxW or HxWx3 RGB uint8 array, encoded image bytes or a path, as luminance.
+        Colorizing keeps only the luminance of the input, so nothing else is decoded or converted."""
+        if isinstance(image, PIL.Image.Image):
+            return image if image.mode == 'L' else image.convert('L')
+        if isinstance(image, np.ndarray):
+            return PIL.Image.fromarray(image).convert('L')
+        if isinstance(image, (bytes, bytearray)):
+            return self._open_luminance_image(BytesIO(image))
+        return self._open_luminance_image(image)
+
     def _get_image_from_url(self, url: str) -> Image:
         response = requests.get(url, timeout=30, headers={'user-agent':'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/62.0.3202.94 Safari/537.36'})
         img = PIL.Image.open(BytesIO(response.content)).convert('RGB')
@@ -105,15 +131,15 @@ class ModelImageVisualizer:
         result = self.get_transformed_image(
             path, render_factor, post_process=post_process,watermarked=watermarked
         )
-        orig = self._open_pil_image(path)
         if compare:
+            orig = self._open_pil_image(path)
             self._plot_comparison(
                 figsize, render_factor, display_render_factor, orig, result
             )
+            orig.close()
         else:
             self._plot_solo(figsize, render_factor, display_render_factor, result)
 
-        orig.close()
         result_path = self._save_result_image(path, result, results_dir=results_dir)
         result.close()
         return result_path
@@ -170,15 +196,46 @@ class ModelImageVisualizer:
         watermarked: bool = True,
     ) -> Image:
         self._clean_mem()
-        orig_image = self._open_pil_image(path)
-        filtered_image = self.filter.filter(
-            orig_image, orig_image, render_factor=render_factor,post_process=post_process
+        return self.colorize(
+            path, render_factor=render_factor, post_process=post_process, watermarked=watermarked
         )
 
-        if watermarked:
-            return get_watermarked(filtered_image)
+    def colorize(
+        self,
+        image: Union[Image, np.ndarray, bytes, str, Path],
+        render_factor: int = None,
+        post_process: bool = True,
+        watermarked: bool = True,
+    ) -> Image:
+        """Colorize `image` and return the result in memory, without plotting or writing to `results_dir`.
+        Fresh results say in their `info` what they were rendered at (see `ColorizerFilter.filter`); results
+        read back from the cache were rendered as requested."""
+        orig_image = self._to_luminance_image(image)
+        if self.cache is None:
+            return self._filter_image(orig_image, render_factor, post_process, watermarked)
+
+        key = self.cache.make_key(
+            orig_image,
+            model_id=self.model_id,
+            render_factor=ifnone(render_factor, getattr(self.filter, 'render_factor', None)),
+            post_process=post_process,
+            watermarked=watermarked,
+        )
+        # Results degraded to fit in memory are not kept, so that they are redone once there is room
+        return self.cache.get_or_compute(
+            key,
+            lambda: self._filter_image(orig_image, render_factor, post_process, watermarked),
+            cacheable=lambda image: not image.info.get('degradations'),
+        )
 
-        return filtered_image
+    def _filter_image(
+        self, orig_image: Image, render_factor: int, post_process: bool, watermarked: bool
+    ) -> Image:
+        # Watermarked strip by strip as the filter writes its output, not over a copy of the whole image
+        stamp = watermark_stamp(orig_image.size) if watermarked else None
+        return self.filter.filter(
+            orig_image, orig_image, render_factor=render_factor, post_process=post_process, stamp=stamp
+        )
 
     def _plot_image(
         self,
@@ -209,14 +266,28 @@ class ModelImageVisualizer:
 
 
 class VideoColorizer:
-    def __init__(self, vis: ModelImageVisualizer):
+    def __init__(
+        self,
+        vis: ModelImageVisualizer,
+        workfolder: Path = Path('./video'),
+        streaming: bool = False,
+        batch_size: int = 4,
+        workers: int = 2,
+    ):
         self.vis = vis
-        workfolder = Path('./video')
+        workfolder = Path(workfolder)
         self.source_folder = workfolder / "source"
         self.bwframes_root = workfolder / "bwframes"
         self.audio_root = workfolder / "audio"
         self.colorframes_root = workfolder / "colorframes"
         self.result_folder = workfolder / "result"
+        # Streaming pipes raw frames through ffmpeg in memory, instead of through JPEGs in
+        # `bwframes_root` and `colorframes_root`: no lossy round trips, and no disk used per frame.
+        self.streaming = streaming
+        # Frames go through the model `batch_size` at a time, and are post-processed on `workers` threads
+        # (see `FramePipeline`)
+        self.batch_size = batch_size
+        self.workers = workers
 
     def _purge_images(self, dir):
         for f in os.listdir(dir):
@@ -244,6 +315,28 @@ class VideoColorizer:
         )
         return stream_data['avg_frame_rate']
 
+    def _get_stream_info(self, source_path: Path) -> Tuple[Tuple[int, int], str, Optional[int], bool]:
+        "The (w, h) of the decoded frames, the frame rate, the frame count if known and whether there is audio."
+        probe = self._get_ffmpeg_probe(source_path)
+        stream_data = next(
+            (stream for stream in probe['streams'] if stream['codec_type'] == 'video'),
+            None,
+        )
+        size = (int(stream_data['width']), int(stream_data['height']))
+        # ffmpeg turns rotated videos upright as it decodes them, so their frames come out the other way around
+        rotation = stream_data.get('tags', {}).get('rotate') or next(
+            (data['rotation'] for data in stream_data.get('side_data_list', []) if 'rotation' in data), 0
+        )
+        if abs(int(float(rotation))) % 180 == 90:
+            size = (size[1], size[0])
+        # Not every container stores the frame count, but most tell the duration
+        frame_count = int(stream_data['nb_frames']) if 'nb_frames' in stream_data else None
+        duration = stream_data.get('duration', probe.get('format', {}).get('duration'))
+        if frame_count is None and duration is not None and stream_data['avg_frame_rate'] != '0/0':
+            frame_count = round(float(duration) * Fraction(stream_data['avg_frame_rate']))
+        has_audio = any(stream['codec_type'] == 'audio' for stream in probe['streams'])
+        return size, stream_data['avg_frame_rate'], frame_count, has_audio
+
     def _download_video_from_url(self, source_url, source_path: Path):
         if source_path.exists():
             source_path.unlink()
@@ -283,6 +376,36 @@ class VideoColorizer:
             logging.error('Errror while extracting raw frames from source video.  Details: {0}'.format(e), exc_info=True)   
             raise e
 
+    def _colorize_frames(
+        self, frames: Iterable[Image.Image], size: Tuple[int, int], render_factor: int = None,
+        post_process: bool = True, watermarked: bool = True,
+    ) -> Iterator[Image.Image]:
+        """`frames` (luminance images of `size`) colorized, in order: in batches through a `FramePipeline`
+        if the visualizer runs a single `ColorizerFilter`, else one at a time. Either way, frames already
+        in the visualizer's cache are read back from it."""
+        filters = getattr(self.vis.filter, 'filters', [])
+        if len(filters) != 1 or not isinstance(filters[0], ColorizerFilter):
+            return (
+                self.vis.colorize(
+                    frame, render_factor=render_factor, post_process=post_process, watermarked=watermarked
+                )
+                for frame in frames
+            )
+        pipeline = FramePipeline(filters[0], batch_size=self.batch_size, workers=self.workers)
+        # Every frame has the same size, so the watermark is placed once for the whole video
+        stamp = watermark_stamp(size) if watermarked else None
+        render_factor = ifnone(render_factor, self.vis.filter.render_factor)
+        cache = self.vis.cache
+        return pipeline.colorize(
+            frames,
+            render_factor,
+            post_process=post_process,
+            stamp=stamp,
+            cache=cache,
+            # The keys `ModelImageVisualizer.colorize` uses, so frames and images share results
+            key=lambda frame: cache.make_key(frame, self.vis.model_id, render_factor, post_process, watermarked),
+        )
+
     def _colorize_raw_frames(
         self, source_path: Path, render_factor: int = None, post_process: bool = True,
         watermarked: bool = True,
@@ -292,14 +415,20 @@ class VideoColorizer:
         self._purge_images(colorframes_folder)
         bwframes_folder = self.bwframes_root / (source_path.stem)
 
-        for img in progress_bar(os.listdir(str(bwframes_folder))):
-            img_path = bwframes_folder / img
-
-            if os.path.isfile(str(img_path)):
-                color_image = self.vis.get_transformed_image(
-                    str(img_path), render_factor=render_factor, post_process=post_process,watermarked=watermarked
-                )
-                color_image.save(str(colorframes_folder / img))
+        frame_names = sorted(
+            img for img in os.listdir(str(bwframes_folder)) if os.path.isfile(str(bwframes_folder / img))
+        )
+        if not frame_names:
+            return
+        # Read (and decoded straight to luminance) on the pipeline's prefetch thread
+        frames = (self.vis._open_luminance_image(str(bwframes_folder / img)) for img in frame_names)
+        with PIL.Image.open(str(bwframes_folder / frame_names[0])) as first:
+            size = first.size
+        colorized = self._colorize_frames(
+            frames, size, render_factor=render_factor, post_process=post_process, watermarked=watermarked
+        )
+        for img, color_image in zip(frame_names, progress_bar(colorized, total=len(frame_names))):
+            color_image.save(str(colorframes_folder / img))
 
     def _build_video(self, source_path: Path) -> Path:
         colorized_path = self.result_folder / (
@@ -370,6 +499,91 @@ class VideoColorizer:
         logging.info('Video created here: ' + str(result_path))
         return result_path
 
+    def _decode_frames(self, source_path: Path, size: Tuple[int, int], fps: str) -> Iterator[Image.Image]:
+        "The frames of `source_path` as luminance images of `size`, read one at a time from an ffmpeg pipe."
+        (w, h) = size
+        # Gray frames are the full range luminance the colorizer keeps of the JPEG frames, at a third of the bytes.
+        # Resampled to the frame rate the result is encoded at, so that it stays in sync with the audio.
+        process = (
+            ffmpeg
+                .input(str(source_path))
+                .output('pipe:', format='rawvideo', pix_fmt='gray', r=fps)
+                .global_args('-hide_banner')
+                .global_args('-nostats')
+                .global_args('-loglevel', 'error')
+                .run_async(pipe_stdout=True)
+        )
+        finished = False
+        try:
+            while True:
+                frame = process.stdout.read(w * h)
+                if len(frame) < w * h:
+                    break
+                yield PIL.Image.fromarray(np.frombuffer(frame, dtype=np.uint8).reshape(h, w))
+            finished = True
+        finally:
+            if not finished:
+                process.kill()
+            process.stdout.close()
+            process.wait()
+        if process.returncode != 0:
+            raise Exception(
+                'ffmpeg exited with code {0} while decoding {1}'.format(process.returncode, source_path)
+            )
+
+    def _start_encoder(
+        self, source_path: Path, result_path: Path, size: Tuple[int, int], fps: str, has_audio: bool
+    ) -> subprocess.Popen:
+        "An ffmpeg process encoding the RGB frames written to its stdin, with the audio of `source_path` if it has any."
+        streams = [ffmpeg.input('pipe:', format='rawvideo', pix_fmt='rgb24', s='{0}x{1}'.format(*size), framerate=fps)]
+        # Same video and audio settings as `_build_video`, muxed in the same pass
+        output_args = dict(crf=17, vcodec='libx264', pix_fmt='yuv420p')
+        if has_audio:
+            streams.append(ffmpeg.input(str(source_path)).audio)
+            output_args.update(acodec='aac', audio_bitrate='256k', shortest=None)
+        return (
+            ffmpeg
+                .output(*streams, str(result_path), **output_args)
+                .global_args('-hide_banner')
+                .global_args('-nostats')
+                .global_args('-loglevel', 'error')
+                .run_async(pipe_stdin=True, overwrite_output=True)
+        )
+
+    def _colorize_stream(
+        self, source_path: Path, render_factor: int = None, post_process: bool = True,
+        watermarked: bool = True,
+    ) -> Path:
+        """Colorize `source_path` from an ffmpeg decode pipe into an ffmpeg encode pipe.
+        Only the frames in flight are held, in memory; nothing is written to disk but the result."""
+        result_path = self.result_folder / source_path.name
+        result_path.parent.mkdir(parents=True, exist_ok=True)
+        if result_path.exists():
+            result_path.unlink()
+        size, fps, frame_count, has_audio = self._get_stream_info(source_path)
+
+        encoder = self._start_encoder(source_path, result_path, size, fps, has_audio)
+        frames = self._decode_frames(source_path, size, fps)
+        colorized = self._colorize_frames(
+            frames, size, render_factor=render_factor, post_process=post_process, watermarked=watermarked
+        )
+        try:
+            for color_image in colorized if frame_count is None else progress_bar(colorized, total=frame_count):
+                encoder.stdin.write(color_image.tobytes())
+        except Exception as e:
+            logging.error('Error while streaming colorized frames.  Details: {0}'.format(e), exc_info=True)
+            # The pipeline first, as it reads the frames on its own thread
+            colorized.close()
+            frames.close()
+            encoder.kill()
+            encoder.wait()
+            raise e
+        encoder.stdin.close()
+        if encoder.wait() != 0:
+            raise Exception('ffmpeg exited with code {0} while encoding {1}'.format(encoder.returncode, result_path))
+        logging.info('Video created here: ' + str(result_path))
+        return result_path
+
     def colorize_from_url(
         self,
         source_url,
@@ -400,6 +614,10 @@ class VideoColorizer:
             raise Exception(
                 'Video at path specfied, ' + str(source_path) + ' could not be found.'
             )
+        if self.streaming:
+            return self._colorize_stream(
+                source_path, render_factor=render_factor, post_process=post_process, watermarked=watermarked
+            )
         self._extract_raw_frames(source_path)
         self._colorize_raw_frames(
             source_path, render_factor=render_factor,post_process=post_process,watermarked=watermarked
@@ -407,52 +625,127 @@ class VideoColorizer:
         return self._build_video(source_path)
 
 
-def get_video_colorizer(render_factor: int = 21) -> VideoColorizer:
-    return get_stable_video_colorizer(render_factor=render_factor)
+def get_video_colorizer(
+    render_factor: int = 21,
+    cache: ResultCache = None,
+    streaming: bool = False,
+    batch_size: int = 4,
+    workers: int = 2,
+) -> VideoColorizer:
+    """`streaming` colorizes videos through ffmpeg pipes, without extracting their frames to JPEGs first,
+    `batch_size` frames go through the model at a time, and `workers` threads post-process them
+    (see `VideoColorizer`)."""
+    return get_stable_video_colorizer(
+        render_factor=render_factor, cache=cache, streaming=streaming, batch_size=batch_size, workers=workers
+    )
 
 
 def get_artistic_video_colorizer(
     root_folder: Path = Path('./'),
     weights_name: str = 'ColorizeArtistic_gen',
     results_dir='result_images',
-    render_factor: int = 35
+    render_factor: int = 35,
+    cache: ResultCache = None,
+    streaming: bool = False,
+    batch_size: int = 4,
+    workers: int = 2,
 ) -> VideoColorizer:
-    learn = gen_inference_deep(root_folder=root_folder, weights_name=weights_name)
-    filtr = MasterFilter([ColorizerFilter(learn=learn)], render_factor=render_factor)
-    vis = ModelImageVisualizer(filtr, results_dir=results_dir)
-    return VideoColorizer(vis)
+    model = gen_model_deep(root_folder=root_folder, weights_name=weights_name)
+    filtr = MasterFilter([ColorizerFilter(model=model)], render_factor=render_factor)
+    vis = ModelImageVisualizer(filtr, results_dir=Path(root_folder) / results_dir, cache=cache, model_id=weights_name)
+    return VideoColorizer(
+        vis, workfolder=Path(root_folder) / 'video', streaming=streaming, batch_size=batch_size, workers=workers
+    )
 
 
 def get_stable_video_colorizer(
     root_folder: Path = Path('./'),
     weights_name: str = 'ColorizeVideo_gen',
     results_dir='result_images',
-    render_factor: int = 21
+    render_factor: int = 21,
+    cache: ResultCache = None,
+    streaming: bool = False,
+    batch_size: int = 4,
+    workers: int = 2,
 ) -> VideoColorizer:
-    learn = gen_inference_wide(root_folder=root_folder, weights_name=weights_name)
-    filtr = MasterFilter([ColorizerFilter(learn=learn)], render_factor=render_factor)
-    vis = ModelImageVisualizer(filtr, results_dir=results_dir)
-    return VideoColorizer(vis)
+    model = gen_model_wide(root_folder=root_folder, weights_name=weights_name)
+    filtr = MasterFilter([ColorizerFilter(model=model)], render_factor=render_factor)
+    vis = ModelImageVisualizer(filtr, results_dir=Path(root_folder) / results_dir, cache=cache, model_id=weights_name)
+    return VideoColorizer(
+        vis, workfolder=Path(root_folder) / 'video', streaming=streaming, batch_size=batch_size, workers=workers
+    )
 
 
 def get_image_colorizer(
-    root_folder: Path = Path('./'), render_factor: int = 35, artistic: bool = True
+    root_folder: Path = Path('./'),
+    render_factor: int = 35,
+    artistic: bool = True,
+    cache: ResultCache = None,
+    quantize: str = None,
+    backend: str = 'torch',
+    tile_size: int = None,
 ) -> ModelImageVisualizer:
+    """`quantize` selects an int8 CPU model: None, 'dynamic' or 'static' (see `deoldify.quantize`).
+    `backend='onnx'` runs the fp32 model on ONNX Runtime instead of PyTorch (see `deoldify.runtime`).
+    `tile_size` adds detail from overlapping tiles of that size for large images (see `ColorizerFilter`)."""
     if artistic:
-        return get_artistic_image_colorizer(root_folder=root_folder, render_factor=render_factor)
+        return get_artistic_image_colorizer(
+            root_folder=root_folder,
+            render_factor=render_factor,
+            cache=cache,
+            quantize=quantize,
+            backend=backend,
+            tile_size=tile_size,
+        )
     else:
-        return get_stable_image_colorizer(root_folder=root_folder, render_factor=render_factor)
+        return get_stable_image_colorizer(
+            root_folder=root_folder,
+            render_factor=render_factor,
+            cache=cache,
+            quantize=quantize,
+            backend=backend,
+            tile_size=tile_size,
+        )
+
+
+def _image_colorizer_model(
+    root_folder: Path, weights_name: str, artistic: bool, quantize: str, backend: str
+) -> Tuple[Any, str]:
+    "The colorizer model for the image factories and the result cache id of its outputs."
+    if backend == 'onnx':
+        if quantize is not None:
+            raise ValueError('The ONNX backend runs the fp32 model only')
+        return get_onnx_model(root_folder, weights_name, artistic=artistic), weights_name + '-onnx'
+    if quantize is not None:
+        model = get_quantized_model(root_folder, weights_name, artistic=artistic, mode=quantize)
+        return model, '{0}-int8-{1}'.format(weights_name, quantize)
+    gen_model = gen_model_deep if artistic else gen_model_wide
+    return gen_model(root_folder=root_folder, weights_name=weights_name), weights_name
+
+
+def _colorizer_filter(root_folder: Path, model: Any, model_id: str, tile_size: Optional[int]) -> ColorizerFilter:
+    "The filter for the image factories, checking requests against the model's memory table if it has one."
+    filtr = ColorizerFilter(model=model, tile_size=tile_size)
+    filtr.memory_estimator = MemoryEstimator.load(memory_table_path(root_folder, model_id, filtr.device.type))
+    return filtr
 
 
 def get_stable_image_colorizer(
     root_folder: Path = Path('./'),
     weights_name: str = 'ColorizeStable_gen',
     results_dir='result_images',
-    render_factor: int = 35
+    render_factor: int = 35,
+    cache: ResultCache = None,
+    quantize: str = None,
+    backend: str = 'torch',
+    tile_size: int = None
 ) -> ModelImageVisualizer:
-    learn = gen_inference_wide(root_folder=root_folder, weights_name=weights_name)
-    filtr = MasterFilter([ColorizerFilter(learn=learn)], render_factor=render_factor)
-    vis = ModelImageVisualizer(filtr, results_dir=results_dir)
+    model, model_id = _image_colorizer_model(root_folder, weights_name, False, quantize, backend)
+    colorizer = _colorizer_filter(root_folder, model, model_id, tile_size)
+    if tile_size is not None:
+        model_id += '-tiled{0}'.format(tile_size)
+    filtr = MasterFilter([colorizer], render_factor=render_factor)
+    vis = ModelImageVisualizer(filtr, results_dir=Path(root_folder) / results_dir, cache=cache, model_id=model_id)
     return vis
 
 
@@ -460,11 +753,18 @@ def get_artistic_image_colorizer(
     root_folder: Path = Path('./'),
     weights_name: str = 'ColorizeArtistic_gen',
     results_dir='result_images',
-    render_factor: int = 35
+    render_factor: int = 35,
+    cache: ResultCache = None,
+    quantize: str = None,
+    backend: str = 'torch',
+    tile_size: int = None
 ) -> ModelImageVisualizer:
-    learn = gen_inference_deep(root_folder=root_folder, weights_name=weights_name)
-    filtr = MasterFilter([ColorizerFilter(learn=learn)], render_factor=render_factor)
-    vis = ModelImageVisualizer(filtr, results_dir=results_dir)
+    model, model_id = _image_colorizer_model(root_folder, weights_name, True, quantize, backend)
+    colorizer = _colorizer_filter(root_folder, model, model_id, tile_size)
+    if tile_size is not None:
+        model_id += '-tiled{0}'.format(tile_size)
+    filtr = MasterFilter([colorizer], render_factor=render_factor)
+    vis = ModelImageVisualizer(filtr, results_dir=Path(root_folder) / results_dir, cache=cache, model_id=model_id)
     return vis
 
 
@@ -0,0 +1,123 @@
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Optional, Tuple
+from PIL import Image as PilImage
+import numpy as np
+import cv2
+import threading
+
+__all__ = ['Watermark']
+
+
+def _blend(pixels: np.ndarray, top: int, logo: np.ndarray, left: int, logo_top: int):
+    "Add half of `logo`, placed at (left, logo_top), to `pixels`: rows of the image starting at row `top`."
+    start, end = max(logo_top, top), min(logo_top + logo.shape[0], top + pixels.shape[0])
+    if start < end:
+        roi = pixels[start - top : end - top, left : left + logo.shape[1]]
+        cv2.addWeighted(logo[start - logo_top : end - logo_top], 0.5, roi, 1.0, 0, roi)
+
+
+# adapted from https://www.pyimagesearch.com/2016/04/25/watermarking-images-with-opencv-and-python/
+class Watermark:
+    """The logo at `path` as stamped on results: in the bottom left corner, 10 pixels from the edges,
+    sized from 5% of the image height, with half its colors added to the pixels under it.
+    The decoded logo is read once (again if the file changes) and its resized variants are kept for the
+    last `max_sizes` image heights, so stamping a frame only blends the pixels under the logo."""
+
+    pct = 0.05
+    margin = 10
+
+    def __init__(self, path: Path, max_sizes: int = 16):
+        self.path = Path(path)
+        self.max_sizes = max_sizes
+        self._logo = None
+        self._mtime = None
+        self._sized = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _decoded(self) -> Optional[np.ndarray]:
+        "The logo as RGB, or None if there is none. Call with the lock held."
+        try:
+            mtime = self.path.stat().st_mtime
+        except OSError:
+            mtime = None
+        if mtime != self._mtime:
+            self._mtime = mtime
+            self._sized.clear()
+            logo = None if mtime is None else cv2.imread(str(self.path), cv2.IMREAD_UNCHANGED)
+            if logo is not None:
+                # Only the colors are blended: the results have no alpha channel
+                channels = 1 if logo.ndim == 2 else logo.shape[2]
+                code = {1: cv2.COLOR_GRAY2RGB, 3: cv2.COLOR_BGR2RGB, 4: cv2.COLOR_BGRA2RGB}[channels]
+                logo = cv2.cvtColor(logo, code)
+            self._logo = logo
+        return self._logo
+
+    def logo(self, h: int) -> Optional[np.ndarray]:
+        "The logo as an RGB array sized for images `h` pixels high, or None if there is none."
+        with self._lock:
+            logo = self._decoded()
+            if logo is None:
+                return None
+            sized = self._sized.get(h)
+            if sized is None:
+                (fwH, fwW) = logo.shape[:2]
+                wH = int(self.pct * h)
+                wW = int((self.pct * h / fwH) * fwW)
+                if wH < 1 or wW < 1:
+                    return None
+                # Sized as it always has been: wH wide and wW high
+                sized = cv2.resize(logo, (wH, wW), interpolation=cv2.INTER_AREA)
+                self._sized[h] = sized
+                if len(self._sized) > self.max_sizes:
+                    self._sized.popitem(last=False)
+            else:
+                self._sized.move_to_end(h)
+            return sized
+
+    def _placed(self, size: Tuple[int, int]) -> Optional[Tuple[np.ndarray, int, int]]:
+        "The logo for an image of `size` (w, h) with its left and top, or None if there is none or it doesn't fit."
+        (w, h) = size
+        logo = self.logo(h)
+        if logo is None:
+            return None
+        (wH, wW) = logo.shape[:2]
+        left, top = self.margin, h - wH - self.margin
+        if top < 0 or left + wW > w:
+            return None
+        return logo, left, top
+
+    def box(self, size: Tuple[int, int]) -> Optional[Tuple[int, int, int, int]]:
+        "The (left, top, right, bottom) the logo covers on an image of `size` (w, h), or None if it doesn't fit."
+        placed = self._placed(size)
+        if placed is None:
+            return None
+        logo, left, top = placed
+        return left, top, left + logo.shape[1], top + logo.shape[0]
+
+    def stamp(self, pixels: np.ndarray, size: Tuple[int, int], top: int = 0):
+        """Blend the logo in place into `pixels`, RGB uint8 rows starting at row `top` of an image of `size`.
+        Only the rows and columns under the logo are touched."""
+        placed = self._placed(size)
+        if placed is not None:
+            _blend(pixels, top, *placed)
+
+    def stamper(self, size: Tuple[int, int]) -> Optional[Callable[[np.ndarray, int], None]]:
+        "`stamp` as a `ColorizerFilter` stamp for an image of `size` written strip by strip. None if there is no logo."
+        placed = self._placed(size)
+        if placed is None:
+            return None
+        # Every strip gets the same logo, even if the file changes halfway through
+        return lambda strip, strip_top: _blend(strip, strip_top, *placed)
+
+    def apply(self, image: PilImage.Image) -> PilImage.Image:
+        "A watermarked copy of `image`, blending only the region under the logo."
+        result = image.convert('RGB') if image.mode != 'RGB' else image.copy()
+        placed = self._placed(result.size)
+        if placed is not None:
+            logo, left, top = placed
+            box = (left, top, left + logo.shape[1], top + logo.shape[0])
+            region = np.array(result.crop(box))
+            cv2.addWeighted(logo, 0.5, region, 1.0, 0, region)
+            result.paste(PilImage.fromarray(region), box)
+        return result
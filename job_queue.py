@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Colorization Job Queue
+Run colorization jobs on background workers and track their status
+"""
+
+import heapq
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import Callable, Optional
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Job:
+    """A single colorization request and its lifecycle timestamps"""
+
+    def __init__(self, params: dict):
+        self.id = uuid.uuid4().hex
+        self.params = params
+        self.status = QUEUED
+        self.error = None
+        # Whatever the handler reports about its output
+        self.result = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def queue_time(self) -> Optional[float]:
+        """Seconds spent waiting for a worker"""
+        if self.started_at is None:
+            return None
+        return self.started_at - self.created_at
+
+    @property
+    def run_time(self) -> Optional[float]:
+        """Seconds spent colorizing"""
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+    def to_dict(self) -> dict:
+        return {
+            'id': self.id,
+            'status': self.status,
+            'error': self.error,
+            'result': self.result,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'queue_time': self.queue_time,
+            'run_time': self.run_time,
+        }
+
+
+class JobQueue:
+    """FIFO queue drained by a pool of worker threads
+
+    `handler(job)` does the actual work and returns True on success.
+    Finished jobs are kept for status polling until `max_history` is exceeded.
+    """
+
+    def __init__(self, handler: Callable[[Job], bool], num_workers: int = 1, max_history: int = 1000):
+        self.handler = handler
+        self.num_workers = num_workers
+        self.max_history = max_history
+        self._jobs = OrderedDict()
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._workers = []
+        self._running = 0
+
+    def _start_workers(self):
+        while len(self._workers) < self.num_workers:
+            worker = threading.Thread(
+                target=self._work, name=f'colorize-worker-{len(self._workers)}', daemon=True
+            )
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                job = self._pending.popleft()
+                job.status = RUNNING
+                job.started_at = time.time()
+                self._running += 1
+
+            try:
+                success = self.handler(job)
+                error = None if success else 'Colorization failed'
+            except Exception as e:
+                success, error = False, str(e)
+                print(f"❌ Job {job.id} failed: {e}")
+
+            with self._cond:
+                job.status = DONE if success else FAILED
+                job.error = error
+                job.finished_at = time.time()
+                self._running -= 1
+                self._trim_history()
+
+    def _trim_history(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in (DONE, FAILED)]
+        for job_id in finished[:max(0, len(finished) - self.max_history)]:
+            del self._jobs[job_id]
+
+    def submit(self, **params) -> Job:
+        """Enqueue a job and return it immediately"""
+        job = Job(params)
+        with self._cond:
+            self._start_workers()
+            self._jobs[job.id] = job
+            self._pending.append(job)
+            self._cond.notify()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def position(self, job: Job) -> Optional[int]:
+        """Number of jobs ahead of `job` in the queue, or None once it has started"""
+        with self._cond:
+            try:
+                return self._pending.index(job)
+            except ValueError:
+                return None
+
+    def depth(self) -> int:
+        """Number of jobs waiting for a worker"""
+        with self._cond:
+            return len(self._pending)
+
+    def expected_wait(self, estimate: Optional[Callable[[Job], Optional[float]]] = None) -> float:
+        """Rough seconds a job submitted now would wait for a worker. Each job ahead of it takes
+        `estimate(job)` seconds, or the average run time of recent jobs where that gives None,
+        and is handed to the first worker free, as the workers do."""
+        now = time.time()
+        with self._cond:
+            running = [job for job in self._jobs.values() if job.status == RUNNING]
+            pending = list(self._pending)
+            run_times = [job.run_time for job in self._jobs.values() if job.run_time is not None]
+        average = _mean(run_times[-10 * self.num_workers:]) or 0.0
+
+        def cost(job):
+            seconds = estimate(job) if estimate is not None else None
+            return average if seconds is None else seconds
+
+        # Seconds until each worker is free
+        free = [max(0.0, cost(job) - (now - job.started_at)) for job in running]
+        free += [0.0] * max(0, self.num_workers - len(free))
+        heapq.heapify(free)
+        for job in pending:
+            heapq.heapreplace(free, free[0] + cost(job))
+        return free[0]
+
+    def stats(self) -> dict:
+        with self._cond:
+            finished = [job for job in self._jobs.values() if job.run_time is not None]
+            return {
+                'queued': len(self._pending),
+                'running': self._running,
+                'workers': self.num_workers,
+                'done': sum(1 for job in finished if job.status == DONE),
+                'failed': sum(1 for job in finished if job.status == FAILED),
+                'avg_queue_time': _mean([job.queue_time for job in finished]),
+                'avg_run_time': _mean([job.run_time for job in finished]),
+            }
+
+
+def _mean(values) -> Optional[float]:
+    return sum(values) / len(values) if values else None
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+DeOldify int8 Model Quantizer
+Usage: python quantize_model.py --calibration_dir photos/ [--model artistic] [--mode static]
+
+Writes deoldify_core/models/<weights>_int8_<mode>.pth, used by `--quantize` in
+simple_colorizer.py and COLORIZER_QUANTIZE in the web app, and reports its latency,
+size and color deviation against the fp32 model on the calibration photos.
+"""
+
+import sys
+import os
+import argparse
+from pathlib import Path
+
+# Add DeOldify to path (resolved once, so nothing depends on the working directory)
+DEOLDIFY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'deoldify_core')
+if DEOLDIFY_PATH not in sys.path:
+    sys.path.insert(0, DEOLDIFY_PATH)
+
+WEIGHTS = {'artistic': 'ColorizeArtistic_gen', 'stable': 'ColorizeStable_gen'}
+
+
+def load_fp32(model_type):
+    """The optimized fp32 colorizer that quantization starts from"""
+    import torch
+    from deoldify.generators import gen_model_deep, gen_model_wide
+    from deoldify.optimize import optimize_for_inference
+
+    gen_model = gen_model_deep if model_type == 'artistic' else gen_model_wide
+    model = gen_model(root_folder=Path(DEOLDIFY_PATH), weights_name=WEIGHTS[model_type], device=torch.device('cpu'))
+    return optimize_for_inference(model, grayscale=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Quantize a DeOldify colorizer to int8 for CPU inference')
+    parser.add_argument('--model', choices=['artistic', 'stable'], default='artistic',
+                        help='Model type to quantize')
+    parser.add_argument('--mode', choices=['dynamic', 'static'], default='static',
+                        help='dynamic: 1x1 convs only, no calibration; static: every conv, calibrated')
+    parser.add_argument('--calibration_dir', required=True,
+                        help='Folder of representative photos (a few dozen is plenty)')
+    parser.add_argument('--render_factor', type=int, default=35,
+                        help='Render factor to calibrate and compare at (7-45)')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed forwards per photo for the report')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.calibration_dir):
+        print(f"Error: Calibration folder '{args.calibration_dir}' not found!")
+        return 1
+
+    from deoldify.quantize import (
+        calibration_images, quantization_report, quantize_dynamic, quantize_static,
+        quantized_model_path, save_quantized,
+    )
+
+    print(f"Loading {args.model} model...")
+    reference = load_fp32(args.model)
+    # Quantization modifies the model in place, so it gets its own copy of the weights
+    model = load_fp32(args.model)
+
+    print(f"Quantizing ({args.mode})...")
+    if args.mode == 'dynamic':
+        quantize_dynamic(model)
+    else:
+        quantize_static(model, calibration_images(args.calibration_dir, args.render_factor))
+
+    path = quantized_model_path(Path(DEOLDIFY_PATH), WEIGHTS[args.model], args.mode)
+    save_quantized(model, path, args.mode, artistic=args.model == 'artistic')
+    print(f"✅ Saved {path}")
+
+    report = quantization_report(
+        reference, model, calibration_images(args.calibration_dir, args.render_factor), repeat=args.repeat
+    )
+    print(f"📊 {report['images']} photos at render factor {args.render_factor}")
+    print(f"   latency: {report['fp32_latency'] * 1000:.0f} ms fp32 -> {report['int8_latency'] * 1000:.0f} ms int8 "
+          f"({report['fp32_latency'] / report['int8_latency']:.2f}x)")
+    print(f"   saved size: {report['fp32_size_bytes'] / 2 ** 20:.0f} MB fp32 -> "
+          f"{report['int8_size_bytes'] / 2 ** 20:.0f} MB int8")
+    print(f"   color deviation: mean {report['mean_abs_diff']:.2f}, max {report['max_abs_diff']:.2f} (0-255 levels)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
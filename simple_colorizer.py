@@ -9,8 +9,10 @@ import os
 import argparse
 from pathlib import Path
 
-# Add DeOldify to path
-sys.path.append('DeOldify')
+# Add DeOldify to path (resolved once, so nothing depends on the working directory)
+DEOLDIFY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'deoldify_core')
+if DEOLDIFY_PATH not in sys.path:
+    sys.path.insert(0, DEOLDIFY_PATH)
 
 class SimpleColorizer:
     """Simple wrapper for DeOldify colorization"""
@@ -18,7 +20,8 @@ class SimpleColorizer:
     def __init__(self):
         self.models = {}
     
-    def colorize(self, input_path, output_path=None, render_factor=35, model_type='artistic'):
+    def colorize(self, input_path, output_path=None, render_factor=35, model_type='artistic', cache_dir=None,
+                 quantize=None, backend='torch', tile_size=None):
         """
         Colorize a black and white image using DeOldify
         
@@ -27,10 +30,16 @@ class SimpleColorizer:
             output_path (str): Path for output image (optional)
             render_factor (int): Quality factor (7-45, higher = better quality but slower)
             model_type (str): 'artistic' or 'stable'
+            cache_dir (str): Directory for cached results (optional)
+            quantize (str): 'dynamic' or 'static' to run an int8 model on the CPU (optional)
+            backend (str): 'torch' or 'onnx' to run on ONNX Runtime
+            tile_size (int): Add detail from overlapping tiles of this size, for large scans (optional)
         """
-        return colorize_image(input_path, output_path, render_factor, model_type)
+        return colorize_image(input_path, output_path, render_factor, model_type, cache_dir, quantize, backend,
+                              tile_size)
 
-def colorize_image(input_path, output_path=None, render_factor=35, model_type='artistic'):
+def colorize_image(input_path, output_path=None, render_factor=35, model_type='artistic', cache_dir=None,
+                   quantize=None, backend='torch', tile_size=None):
     """
     Colorize a black and white image using DeOldify
     
@@ -39,38 +48,45 @@ def colorize_image(input_path, output_path=None, render_factor=35, model_type='a
         output_path (str): Path for output image (optional)
         render_factor (int): Quality factor (7-45, higher = better quality but slower)
         model_type (str): 'artistic' or 'stable'
+        cache_dir (str): Directory for cached results, reused across runs (optional)
+        quantize (str): 'dynamic' or 'static' to run an int8 model on the CPU (optional)
+        backend (str): 'torch' or 'onnx' to run on ONNX Runtime (exported on first use)
+        tile_size (int): Also colorize overlapping tiles of this size (a multiple of 16) at twice the
+            render size and blend in their detail, for large scans (optional)
     """
     try:
-        # Change to DeOldify directory and add to path
-        original_dir = os.getcwd()
-        deoldify_path = os.path.join(original_dir, 'deoldify_core')
-        os.chdir(deoldify_path)
-        sys.path.insert(0, deoldify_path)
-        
         # Import DeOldify modules (suppress IDE warnings with try/except)
         try:
             from deoldify.visualize import get_image_colorizer  # type: ignore
+            from deoldify.cache import ResultCache  # type: ignore
         except ImportError as ie:
             print(f"Failed to import DeOldify: {ie}")
-            print("Make sure you're running from the correct directory with DeOldify folder present.")
+            print("Make sure the deoldify_core folder is present next to this script.")
             return None
         
+        # Weights and result folders are resolved under deoldify_core without changing directory
+        root_folder = Path(DEOLDIFY_PATH)
+        
         print(f"Loading {model_type} model...")
+        cache = ResultCache(cache_dir) if cache_dir else None
         
         # Get colorizer based on model type with error handling
         try:
             if model_type.lower() == 'artistic':
-                colorizer = get_image_colorizer(artistic=True)
+                colorizer = get_image_colorizer(root_folder=root_folder, artistic=True, cache=cache, quantize=quantize,
+                                                backend=backend, tile_size=tile_size)
                 print("✅ Artistic model loaded successfully")
             else:
                 print("Loading Stable model...")
-                colorizer = get_image_colorizer(artistic=False)
+                colorizer = get_image_colorizer(root_folder=root_folder, artistic=False, cache=cache, quantize=quantize,
+                                                backend=backend, tile_size=tile_size)
                 print("✅ Stable model loaded successfully")
         except Exception as model_error:
             print(f"❌ Error loading {model_type} model: {model_error}")
             print("🔄 Falling back to Artistic model...")
             try:
-                colorizer = get_image_colorizer(artistic=True)
+                colorizer = get_image_colorizer(root_folder=root_folder, artistic=True, cache=cache, quantize=quantize,
+                                                backend=backend, tile_size=tile_size)
                 print("✅ Fallback to Artistic model successful")
                 model_type = 'artistic_fallback'
             except Exception as fallback_error:
@@ -80,55 +96,23 @@ def colorize_image(input_path, output_path=None, render_factor=35, model_type='a
         print(f"Colorizing image: {input_path}")
         print(f"Render factor: {render_factor}")
         
-        # Convert input path to relative path from DeOldify directory
-        input_rel_path = os.path.join('..', input_path)
-        
-        # Colorize the image
-        result_path = colorizer.plot_transformed_image(
-            path=input_rel_path, 
-            render_factor=render_factor,
-            display_render_factor=True,
-            figsize=(20,20)
-        )
-        
-        print(f"DeOldify result saved to: {result_path}")
+        # Colorize in memory; nothing is plotted or written to result_images
+        result = colorizer.colorize(input_path, render_factor=render_factor)
+        for degradation in result.info.get('degradations', []):
+            print(f"⚠️ Changed {degradation['setting']} from {degradation['from']} to {degradation['to']} "
+                  f"to fit in memory ({degradation['cause']})")
         
-        # Change back to original directory
-        os.chdir(original_dir)
-        
-        # If output path is specified, copy the result there
-        if output_path:
-            import shutil
-            # The result is usually in DeOldify/result_images/
-            deoldify_result = os.path.join('DeOldify', 'result_images', os.path.basename(input_path))
-            
-            if os.path.exists(deoldify_result):
-                # Create output directory if it doesn't exist
-                os.makedirs(os.path.dirname(output_path), exist_ok=True)
-                shutil.copy2(deoldify_result, output_path)
-                print(f"Result copied to: {output_path}")
-            elif result_path and os.path.exists(result_path):
-                os.makedirs(os.path.dirname(output_path), exist_ok=True)
-                shutil.copy2(result_path, output_path)
-                print(f"Result copied to: {output_path}")
-            else:
-                print(f"Warning: Could not find result file")
-                print(f"Check DeOldify/result_images/ folder for the output")
-        else:
-            # If no output path specified, show where the result is
-            deoldify_result = os.path.join('DeOldify', 'result_images', os.path.basename(input_path))
-            if os.path.exists(deoldify_result):
-                print(f"Result saved to: {deoldify_result}")
+        if not output_path:
+            output_path = os.path.join(DEOLDIFY_PATH, 'result_images', os.path.basename(input_path))
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        result.save(output_path)
+        result.close()
+        print(f"Result saved to: {output_path}")
         
         print("Colorization completed!")
-        return result_path
+        return output_path
         
     except Exception as e:
-        # Make sure to change back to original directory
-        try:
-            os.chdir(original_dir)
-        except:
-            pass
         print(f"Error during colorization: {str(e)}")
         print("Make sure you have all required dependencies installed.")
         return None
@@ -141,6 +125,14 @@ def main():
                        help='Render factor (7-45, higher = better quality but slower)')
     parser.add_argument('--model', choices=['artistic', 'stable'], default='artistic',
                        help='Model type to use')
+    parser.add_argument('--cache_dir', default=None,
+                       help='Reuse results for images colorized before with the same settings')
+    parser.add_argument('--quantize', choices=['dynamic', 'static'], default=None,
+                       help='Run an int8 model on the CPU (static needs quantize_model.py first)')
+    parser.add_argument('--backend', choices=['torch', 'onnx'], default='torch',
+                       help='Run the model on PyTorch or ONNX Runtime (CPU)')
+    parser.add_argument('--tile_size', type=int, default=None,
+                       help='Add detail from overlapping tiles of this size (e.g. 512) for large scans')
     
     args = parser.parse_args()
     
@@ -164,7 +156,11 @@ def main():
         input_path=args.input,
         output_path=output_path, 
         render_factor=args.render_factor,
-        model_type=args.model
+        model_type=args.model,
+        cache_dir=args.cache_dir,
+        quantize=args.quantize,
+        backend=args.backend,
+        tile_size=args.tile_size
     )
     
     return 0 if result else 1